@@ -0,0 +1,421 @@
+"""
+Benchmark for server.py. Builds a synthetic tree in a temp BASE_DIR, runs the server on a
+loopback port and measures:
+
+  listing      /files/<dir> latency vs number of entries (cold = first, listing cache empty)
+  download     /download/ throughput per file size, plus the server's peak RSS
+  upload       multipart /upload throughput per file size
+  concurrency  p50 / p99 latency and requests/s with N keep-alive clients
+
+Results go to stdout (or --out) as JSON so runs on different commits can be compared:
+
+    python bench.py --out before.json
+    python bench.py --quick --engine asyncio
+"""
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+HOST = "127.0.0.1"
+
+# ------------- Plans -------------
+FULL = dict(
+    listing=(1000, 10000, 100000),     # entries per listing folder
+    download=("1K", "1M", "100M", "1G"),
+    upload=("1K", "1M", "100M"),
+    concurrency=(1, 8, 32, 64),        # simultaneous clients
+    listing_repeat=20,                 # warm requests per folder (after the cold one)
+    transfer_repeat=3,                 # downloads / uploads per size
+    concurrency_requests=200,          # requests per client per concurrency level
+)
+QUICK = dict(listing=(1000, 10000), download=("1K", "1M", "64M"), upload=("1K", "1M", "64M"),
+             concurrency=(1, 8, 32), listing_repeat=5, transfer_repeat=2, concurrency_requests=50)
+READ_CHUNK = 1024 * 1024
+STARTUP_TIMEOUT = 30
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * pct // 100))
+    return values[int(rank) - 1]
+
+def summary_ms(seconds):
+    values = sorted(s * 1000 for s in seconds)
+    return {"n": len(values), "min_ms": round(values[0], 3), "p50_ms": round(percentile(values, 50), 3),
+            "p99_ms": round(percentile(values, 99), 3), "max_ms": round(values[-1], 3)}
+
+
+# ------------- Synthetic tree -------------
+def make_listing_dir(base, count):
+    """count small files (1 KB) in one folder, with a few subfolders like real trees have."""
+    path = os.path.join(base, f"list_{count}")
+    os.makedirs(path, exist_ok=True)
+    payload = os.urandom(1024)
+    for i in range(count):
+        if i % 100 == 0:
+            os.makedirs(os.path.join(path, f"dir_{i:07d}"), exist_ok=True)
+        else:
+            with open(os.path.join(path, f"file_{i:07d}.txt"), "wb") as f:
+                f.write(payload)
+    return os.path.basename(path)
+
+def make_blob(base, size, name):
+    """Random (incompressible) content; one random block repeated so GB sizes are quick to create."""
+    path = os.path.join(base, name)
+    block = os.urandom(min(size, 4 * 1024 * 1024))
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+    return path
+
+
+# ------------- Server process -------------
+def free_port():
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+class ServerProcess:
+    def __init__(self, base_dir, engine, processes, workers):
+        self.port = free_port()
+        cmd = [sys.executable, SERVER, "--host", HOST, "--port", str(self.port), "--dir", base_dir,
+               "--engine", engine, "--processes", str(processes)]
+        if workers:
+            cmd += ["--workers", str(workers)]
+        self.log = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(cmd, stdout=self.log, stderr=self.log)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                self.log.seek(0)
+                raise RuntimeError("server exited:\n" + self.log.read().decode(errors="replace"))
+            try:
+                conn = self.connect()
+                conn.request("GET", "/api/list/?limit=1")
+                conn.getresponse().read()
+                conn.close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("server did not start")
+
+    def connect(self, timeout=300):
+        return http.client.HTTPConnection(HOST, self.port, timeout=timeout)
+
+    def pids(self):
+        """Server process plus its pre-fork workers."""
+        pids = [self.proc.pid]
+        try:
+            with open(f"/proc/{self.proc.pid}/task/{self.proc.pid}/children") as f:
+                pids += [int(p) for p in f.read().split()]
+        except OSError:
+            pass
+        return pids
+
+    def rss_kb(self, field):
+        """Sum of VmRSS (current) or VmHWM (peak) over the server's processes; None off Linux."""
+        total = None
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith(field + ":"):
+                            total = (total or 0) + int(line.split()[1])
+            except OSError:
+                pass
+        return total
+
+    def reset_peak_rss(self):
+        """VmHWM starts over from the current RSS (Linux: "5" > clear_refs), so earlier phases don't show."""
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/clear_refs", "w") as f:
+                    f.write("5")
+            except OSError:
+                pass
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(60)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.log.close()
+
+
+# ------------- Benchmarks -------------
+def get(conn, path):
+    """Full GET; returns (status, body length). Reads in chunks so large bodies aren't held in memory."""
+    conn.request("GET", path)
+    resp = conn.getresponse()
+    size = 0
+    while True:
+        chunk = resp.read(READ_CHUNK)
+        if not chunk:
+            break
+        size += len(chunk)
+    return resp.status, size
+
+def bench_listing(server, folders, repeat):
+    results = []
+    for count, name in folders:
+        conn = server.connect()
+        started = time.perf_counter()
+        status, size = get(conn, f"/files/{name}")
+        cold = time.perf_counter() - started
+        warm = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            get(conn, f"/files/{name}")
+            warm.append(time.perf_counter() - started)
+        conn.close()
+        results.append({"entries": count, "status": status, "page_bytes": size,
+                        "cold_ms": round(cold * 1000, 3), "warm": summary_ms(warm)})
+    return results
+
+def bench_download(server, blobs, repeat):
+    results = []
+    for size, name in blobs:
+        server.reset_peak_rss()  # the listing phase (and the previous size) already set a higher peak
+        rss_before = server.rss_kb("VmRSS")
+        runs = []
+        for _ in range(repeat):
+            conn = server.connect()
+            started = time.perf_counter()
+            status, got = get(conn, f"/download/{name}")
+            runs.append(time.perf_counter() - started)
+            conn.close()
+            if got != size:
+                raise RuntimeError(f"download of {name}: got {got} of {size} bytes (status {status})")
+        best = min(runs)
+        results.append({"size": size, "runs": len(runs),
+                        "best_mb_s": round(size / best / 1e6, 2),
+                        "median_mb_s": round(size / sorted(runs)[len(runs) // 2] / 1e6, 2),
+                        "rss_before_kb": rss_before, "peak_rss_kb": server.rss_kb("VmHWM")})
+    return results
+
+def upload(conn, path, target_dir):
+    """Streaming multipart POST /upload (dir field first, then the file), like the upload page."""
+    boundary = uuid.uuid4().hex
+    name = os.path.basename(path)
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"dir\"\r\n\r\n{target_dir}\r\n"
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{name}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    size = os.path.getsize(path)
+
+    def body():
+        yield head
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(READ_CHUNK)
+                if not chunk:
+                    break
+                yield chunk
+        yield tail
+
+    conn.request("POST", "/upload", body=body(), headers={
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+        "Content-Length": str(len(head) + size + len(tail)),
+    })
+    resp = conn.getresponse()
+    resp.read()
+    return resp.status
+
+def bench_upload(server, base_dir, blobs, repeat):
+    target = "uploads"
+    os.makedirs(os.path.join(base_dir, target), exist_ok=True)
+    results = []
+    for size, path in blobs:
+        runs = []
+        for _ in range(repeat):
+            conn = server.connect()
+            started = time.perf_counter()
+            status = upload(conn, path, target)
+            runs.append(time.perf_counter() - started)
+            conn.close()
+            if status != 200:
+                raise RuntimeError(f"upload of {size} bytes failed with {status}")
+            os.remove(os.path.join(base_dir, target, os.path.basename(path)))
+        best = min(runs)
+        results.append({"size": size, "runs": len(runs),
+                        "best_mb_s": round(size / best / 1e6, 2),
+                        "median_mb_s": round(size / sorted(runs)[len(runs) // 2] / 1e6, 2)})
+    return results
+
+def bench_concurrency(server, levels, requests, paths):
+    """N clients, each on its own keep-alive connection, cycling through `paths`."""
+    results = []
+    for clients in levels:
+        latencies, errors = [], []
+        lock = threading.Lock()
+        start = threading.Barrier(clients + 1)
+
+        def client(offset):
+            conn = server.connect(timeout=60)
+            mine = []
+            start.wait()
+            for i in range(requests):
+                path = paths[(offset + i) % len(paths)]
+                began = time.perf_counter()
+                try:
+                    status, _ = get(conn, path)
+                    if status != 200:
+                        raise RuntimeError(f"{path}: {status}")
+                except Exception as e:
+                    with lock:
+                        errors.append(repr(e))
+                    conn.close()
+                    conn = server.connect(timeout=60)
+                    continue
+                mine.append(time.perf_counter() - began)
+            conn.close()
+            with lock:
+                latencies.extend(mine)
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+        for t in threads:
+            t.start()
+        start.wait()
+        began = time.perf_counter()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - began
+        row = {"clients": clients, "requests": len(latencies), "errors": len(errors),
+               "requests_per_s": round(len(latencies) / elapsed, 1)}
+        if latencies:
+            row.update(summary_ms(latencies))
+        if errors:
+            row["first_error"] = errors[0]
+        results.append(row)
+    return results
+
+
+# ------------- Main -------------
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(SERVER),
+                             capture_output=True, text=True, timeout=10)
+        commit = out.stdout.strip() or None
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", "server.py"], cwd=os.path.dirname(SERVER),
+                               capture_output=True, text=True, timeout=10).stdout.strip()
+        return commit, bool(dirty)
+    except (OSError, subprocess.SubprocessError):
+        return None, None
+
+def sizes_arg(text):
+    return tuple(s.strip() for s in text.split(",") if s.strip())
+
+def ints_arg(text):
+    return tuple(int(s) for s in text.split(",") if s.strip())
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark server.py on a synthetic tree")
+    parser.add_argument("--quick", action="store_true", help="smaller tree and fewer runs (~1 minute)")
+    parser.add_argument("--listing", type=ints_arg, help="entries per listing folder, e.g. 1000,10000,100000")
+    parser.add_argument("--download", type=sizes_arg, help="download file sizes, e.g. 1K,1M,100M,4G")
+    parser.add_argument("--upload", type=sizes_arg, help="upload file sizes, e.g. 1K,1M,100M")
+    parser.add_argument("--concurrency", type=ints_arg, help="client counts, e.g. 1,8,32,64")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--workers", type=int, help="server --workers (default: the server's own)")
+    parser.add_argument("--dir", help="build / reuse the tree here instead of a temp dir (kept afterwards)")
+    parser.add_argument("--out", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    plan = dict(QUICK if args.quick else FULL)
+    for key in ("listing", "download", "upload", "concurrency"):
+        if getattr(args, key):
+            plan[key] = getattr(args, key)
+    plan["download"] = tuple(parse_size(s) for s in plan["download"])
+    plan["upload"] = tuple(parse_size(s) for s in plan["upload"])
+
+    base_dir = args.dir or tempfile.mkdtemp(prefix="localserver-bench-")
+    os.makedirs(base_dir, exist_ok=True)
+    log = lambda msg: print(msg, file=sys.stderr, flush=True)
+    try:
+        log(f"Building tree in {base_dir}")
+        started = time.perf_counter()
+        folders = [(n, make_listing_dir(base_dir, n)) for n in plan["listing"]]
+        blobs_dir = os.path.join(base_dir, "blobs")
+        os.makedirs(blobs_dir, exist_ok=True)
+        downloads = []
+        for size in plan["download"]:
+            name = f"blob_{size}.bin"
+            path = os.path.join(blobs_dir, name)
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                make_blob(blobs_dir, size, name)
+            downloads.append((size, f"blobs/{name}"))
+        sources = tempfile.mkdtemp(prefix="localserver-bench-src-")
+        uploads = [(size, make_blob(sources, size, f"up_{size}.bin")) for size in plan["upload"]]
+        tree_seconds = time.perf_counter() - started
+
+        log(f"Starting server ({args.engine}, {args.processes} process(es))")
+        server = ServerProcess(base_dir, args.engine, args.processes, args.workers)
+        try:
+            result = {"meta": {
+                "commit": None, "server_py_modified": None,
+                "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+                "python": platform.python_version(), "platform": platform.platform(),
+                "cpus": os.cpu_count(), "engine": args.engine, "processes": args.processes,
+                "workers": args.workers, "tree_build_s": round(tree_seconds, 2), "plan": plan,
+            }}
+            result["meta"]["commit"], result["meta"]["server_py_modified"] = git_commit()
+            result["meta"]["server_rss_start_kb"] = server.rss_kb("VmRSS")
+
+            log("listing")
+            result["listing"] = bench_listing(server, folders, plan["listing_repeat"])
+            log("download")
+            result["download"] = bench_download(server, downloads, plan["transfer_repeat"])
+            log("upload")
+            result["upload"] = bench_upload(server, base_dir, uploads, plan["transfer_repeat"])
+            log("concurrency")
+            small = [name for size, name in downloads if size <= 64 * 1024] or [downloads[0][1]]
+            paths = [f"/files/{folders[0][1]}", f"/download/{small[0]}", f"/api/list/{folders[0][1]}?limit=100"]
+            result["concurrency"] = bench_concurrency(server, plan["concurrency"],
+                                                      plan["concurrency_requests"], paths)
+            result["concurrency_paths"] = paths
+        finally:
+            server.stop()
+        shutil.rmtree(sources, ignore_errors=True)
+    finally:
+        if not args.dir:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    text = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+        log(f"Wrote {args.out}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
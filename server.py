@@ -4,560 +4,4865 @@ import os
 import urllib
 import json
 import datetime
+import argparse
+import queue
+import threading
+import socket
+import stat
+import email.utils
+import email.parser
+import email.message
+import uuid
+import collections
+import time
+import base64
+import hashlib
+import zlib
+import re
+import shutil
+import errno
+import bisect
+import heapq
+import array
+import zipfile
+import mimetypes
+import http.client
+import asyncio
+import concurrent.futures
+import io
+import sys
+import traceback
+import signal
+import selectors
+import subprocess
+import sqlite3
+import random
+import atexit
+import contextlib
+from html import escape
+
+try:
+    import brotli
+except ImportError:  # optional: pip install brotli
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional: pip install zstandard
+    zstandard = None
+
+try:
+    import ssl
+except ImportError:  # Python built without OpenSSL
+    ssl = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, and no multi-process mode either
+    fcntl = None
 
 HOST = ""   # all interfaces
 PORT = 8080
 BASE_DIR = "/home"  # <- your Folder location where to save.
+STATE_DIR_NAME = ".localserver"  # server's own bookkeeping inside BASE_DIR (hidden, not downloadable)
+
+# ------------- Concurrency -------------
+SERVER_ENGINE = "threaded"  # "threaded" (thread pool per connection) or "asyncio" (event loop)
+MAX_WORKERS = 32          # worker threads serving connections
+ACCEPT_BACKLOG = 128      # listen() backlog + accepted connections waiting for a worker
+KEEPALIVE_TIMEOUT = 15    # seconds an idle keep-alive connection may wait for its next request
+SOCKET_TIMEOUT = 120      # seconds without progress before an active transfer is dropped
+PROCESSES = 1             # >1 => pre-fork: a supervisor plus this many worker processes on one port
+DRAIN_TIMEOUT = 30        # seconds a stopping worker gets to finish in-flight requests
+WORKER_RESTART_DELAY = 1  # seconds between restarts of a worker that keeps crashing
+CHANGE_FEED_INTERVAL = 0.5            # pre-fork: seconds before a worker sees changes made through its siblings
+CHANGE_FEED_MAX_BYTES = 1024 * 1024   # .localserver/changes/ starts a new segment past this size ...
+CHANGE_FEED_SEGMENTS = 4              # ... and keeps this many
+
+# ------------- Transfers -------------
+COPY_CHUNK_SIZE = 256 * 1024   # read/write size when sendfile can't be used (e.g. TLS sockets)
+MAX_RANGES = 16                # more ranges than this in one request => whole file is sent instead
+
+ZIP_BUFFER_SIZE = 256 * 1024   # /zip/ output is sent in pieces of about this size
+
+# ------------- Bandwidth shaping -------------
+# Token-bucket limits in bytes per second, 0 = unlimited. "down" = responses, "up" = request bodies.
+# With --processes N the global and per-route budgets are split evenly between the workers.
+RATE_LIMIT_DOWN = 0
+RATE_LIMIT_UP = 0
+CLIENT_RATE_LIMIT_DOWN = 0      # per client IP
+CLIENT_RATE_LIMIT_UP = 0
+ROUTE_RATE_LIMITS = {}          # BULK_ROUTES route -> bytes/s, e.g. {"/download": 20 * 1024 * 1024, "/upload": 5 * 1024 * 1024}
+RATE_BURST = 0.5                # seconds of traffic an idle bucket may save up
+SHAPE_SLICE = 64 * 1024         # throttled transfers wait for tokens this many bytes at a time
+BULK_ROUTES = ("/download", "/zip", "/upload")  # only these wait; everything else goes ahead of them
+PRIORITY_BYTES = 64 * 1024      # the first bytes of a bulk request/response go ahead too (small files, headers)
+CLIENT_BUCKET_IDLE = 60         # seconds before an idle per-client bucket is dropped
+
+# ------------- Uploads -------------
+UPLOAD_BUFFER_SIZE = 256 * 1024   # bytes read from the socket per step while parsing multipart bodies
+MAX_PART_HEADER_SIZE = 16 * 1024  # headers of a single multipart part
+MAX_FIELD_SIZE = 64 * 1024        # plain (non-file) form fields are kept in memory, so cap them
+UPLOAD_WRITE_SIZE = 1024 * 1024   # uploaded files hit the disk in writes of this size (at aligned offsets)
+UPLOAD_PREALLOCATE_MIN = 4 * 1024 * 1024   # bodies at least this big are posix_fallocate'd as they arrive
+UPLOAD_PREALLOCATE_STEP = 64 * 1024 * 1024 # ... this much at a time, never further ahead than that
+UPLOAD_FSYNC = "off"              # --fsync: "off", "file" (data before the rename) or "full" (+ the folder after it)
+UPLOAD_TMP_SUFFIX = ".upload-tmp" # in-progress upload: hidden ".<name>.<id>.upload-tmp" next to its target
+UPLOAD_TMP_MAX_AGE = 3600         # untouched this long => left behind by a crash, removed by the search walker
+
+# ------------- Resumable uploads -------------
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024            # default chunk size for /upload/session
+UPLOAD_MIN_CHUNK_SIZE = 256 * 1024
+UPLOAD_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+UPLOAD_CHUNKED_THRESHOLD = 16 * 1024 * 1024    # the upload page uses sessions for files bigger than this
+UPLOAD_PARALLEL_CHUNKS = 4                     # chunks the upload page sends at the same time
+UPLOAD_SESSION_TTL = 24 * 3600                 # sessions idle longer than this are garbage-collected
+UPLOAD_GC_INTERVAL = 600
+
+# ------------- Delta sync -------------
+DELTA_BLOCK_SIZE = 64 * 1024              # default block size of /upload/delta/ signatures
+DELTA_MIN_BLOCK_SIZE = 1024
+DELTA_MAX_BLOCK_SIZE = 16 * 1024 * 1024
+DELTA_MAX_RECIPE = 16 * 1024 * 1024       # the JSON recipe line at the start of a delta upload
+
+# ------------- Dedup store -------------
+DEDUP = False               # --dedup: keep each uploaded content once, link it into place
+DEDUP_TMP_MAX_AGE = 3600    # seconds before an abandoned temp upload in the store is removed
+FICLONE = 0x40049409        # Linux ioctl: reflink (btrfs, xfs, ...)
+
+# ------------- Search -------------
+SEARCH_RESCAN_INTERVAL = 300   # seconds between mtime-based reconcile passes (changes made outside the server)
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 500
+SEARCH_COMPACT_MIN = 10000     # removed names kept as dead ids before the index is renumbered
+
+# ------------- Folder sizes -------------
+FOLDER_SIZES_RESCAN_INTERVAL = 300  # seconds between mtime checks of every folder (changes made outside the server)
+FOLDER_SIZES_SAVE_INTERVAL = 30     # changed totals are written to .localserver at most this often
+
+# ------------- HTTP caching -------------
+# Cache-Control per route. Validators (ETag / Last-Modified) are always sent, so
+# "no-cache" still lets browsers revalidate with a cheap 304.
+CACHE_CONTROL = {
+    "files": "no-cache",               # HTML listings and card fragments
+    "api": "no-cache",                 # /api/list/
+    "download": "private, no-cache",   # file bodies
+    "upload": "no-cache",              # upload page
+    "asset": "public, max-age=31536000, immutable",  # /static/: URL changes whenever the content does
+}
+
+# ------------- Compression -------------
+COMPRESS_MIN_SIZE = 1024                    # smaller static bodies / downloads go out as-is
+COMPRESS_CACHE_MAX_FILE = 8 * 1024 * 1024   # text downloads up to this size are compressed once and cached
+COMPRESS_CACHE_MAX_BYTES = 64 * 1024 * 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+
+# ------------- File types -------------
+VIDEO_EXTS = (".mp4", ".mkv", ".avi", ".mov")
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp")
+AUDIO_EXTS = (".mp3", ".wav", ".ogg")
+# already compressed => recompressing only burns CPU
+PRECOMPRESSED_EXTS = VIDEO_EXTS + IMAGE_EXTS + AUDIO_EXTS + (
+    ".pdf", ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".br", ".7z", ".rar", ".webm", ".m4a", ".flac", ".docx", ".xlsx")
+TEXT_EXTS = (".txt", ".log", ".md", ".csv", ".tsv", ".json", ".py", ".js", ".css", ".html", ".xml", ".svg",
+             ".yml", ".yaml", ".ini", ".cfg", ".conf", ".sh", ".sql", ".srt")
+COMPRESSIBLE_TYPES = {"application/json", "application/javascript", "application/xml", "image/svg+xml",
+                      "application/x-sh", "application/x-python-code"}
+
+# ------------- Listing cache -------------
+LISTING_CACHE_MAX_BYTES = 64 * 1024 * 1024  # rough memory budget for cached directory listings
+LISTING_CACHE_MAX_AGE = 60                  # seconds; also catches in-place edits that don't touch the folder mtime
+LISTING_CACHE_RACY_WINDOW = 2               # folders modified this recently aren't cached (coarse mtime clocks)
+LISTING_PAGE_SIZE = 500     # entries per page in the HTML view, and the /api/list/ default
+API_MAX_PAGE_SIZE = 5000    # largest ?limit= accepted by /api/list/
+LISTING_BATCH = 200         # cards rendered per chunk while streaming a listing page
+
+# ------------- Metrics -------------
+METRIC_ROUTES = ("/files", "/download", "/upload", "/delete", "/zip", "/search", "/api/list", "/metrics", "/static")
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+THROUGHPUT_BUCKETS = tuple(2 ** i * 1024 * 1024 for i in range(11))  # 1 MB/s .. 1 GB/s
+THROUGHPUT_MIN_BYTES = 1024 * 1024  # smaller transfers say more about latency than throughput
+METRICS_FLUSH_INTERVAL = 5          # seconds; pre-fork workers share their counters this often
+
+# ------------- Access log -------------
+ACCESS_LOG = "-"                    # --access-log: JSON-lines file, "-" = stderr, "off" = none
+ACCESS_LOG_BUFFER = 10000           # records waiting for the writer; beyond this new ones are dropped (and counted)
+ACCESS_LOG_BATCH = 500              # the writer is woken early once this many records are waiting
+ACCESS_LOG_FLUSH_INTERVAL = 1       # seconds between batched writes otherwise
+ACCESS_LOG_MAX_BYTES = 64 * 1024 * 1024   # rotate the file past this size ...
+ACCESS_LOG_MAX_AGE = 24 * 3600            # ... or this many seconds after it was opened
+ACCESS_LOG_BACKUPS = 5              # rotated files kept: access.log.1 .. access.log.N
+ACCESS_LOG_SAMPLE = {}              # route -> fraction of requests logged, e.g. {"/files": 0.1}; errors always are
+
+def _safe_join(rel_path: str) -> str:
+    """
+    BASE_DIR + rel_path ko normalize karke ensure karta hai ke path BASE_DIR ke andar hi rahe.
+    """
+    rel_path = rel_path.strip().lstrip("/")  # sanitize
+    base_norm = os.path.abspath(BASE_DIR)
+    abs_path = os.path.normpath(os.path.join(base_norm, rel_path))
+    if os.path.commonpath([abs_path, base_norm]) != base_norm:
+        raise PermissionError("Path outside base dir")
+    state_dir = os.path.join(base_norm, STATE_DIR_NAME)
+    if abs_path == state_dir or abs_path.startswith(state_dir + os.sep):
+        raise PermissionError("Path inside server state dir")
+    return abs_path
+
+def _rel_from_base(abs_path):
+    rel = os.path.relpath(abs_path, BASE_DIR).replace("\\", "/")
+    return "" if rel == "." else rel
+
+def _state_path(*parts):
+    """Path inside BASE_DIR/.localserver (created on demand)."""
+    path = os.path.join(BASE_DIR, STATE_DIR_NAME, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _is_upload_temp(name):
+    return name.startswith(".") and name.endswith(UPLOAD_TMP_SUFFIX)
+
+def _hidden(name, at_root):
+    """Server-internal names that listings, search and ZIPs leave out."""
+    return (at_root and name == STATE_DIR_NAME) or _is_upload_temp(name)
+
+def _reserved_name(name, target_dir):
+    """True for upload names that can't be a visible file in target_dir."""
+    at_root = os.path.normpath(target_dir) == os.path.normpath(BASE_DIR)
+    return name in (".", "..") or _hidden(name, at_root)
+
+def _upload_failed(e):
+    """(status, message) for a failed upload; OS errors are logged here and not shown with their paths."""
+    if isinstance(e, OSError):
+        print(f"upload failed: {e}", file=sys.stderr)
+        return 500, f"Upload failed: {e.strerror or 'could not write the file'}"
+    return 400, f"Upload failed: {e}"
+
+def _fsync_file(fd):
+    if UPLOAD_FSYNC != "off":
+        os.fsync(fd)
+
+def _fsync_dir(path):
+    """Makes a rename into `path` durable (UPLOAD_FSYNC = "full")."""
+    if UPLOAD_FSYNC != "full":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _preallocate(fd, offset, length):
+    """
+    posix_fallocate for big uploads, so the filesystem can hand out contiguous extents.
+    Callers reserve at most UPLOAD_PREALLOCATE_STEP just ahead of data that is arriving:
+    a claimed size alone reserves nothing. False when skipped or unsupported.
+    """
+    if length < UPLOAD_PREALLOCATE_MIN or not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        st = os.fstatvfs(fd)
+        if st.f_bavail * st.f_frsize < length:
+            return False  # leave the disk's last free space to writes that actually happen
+        os.posix_fallocate(fd, offset, length)
+    except OSError:
+        return False  # e.g. not supported by the filesystem; plain writes still work
+    return True
+
+def _atomic_move(src, dst):
+    """os.replace, plus a same-directory temp copy when src lives on another filesystem."""
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        tmp = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.{uuid.uuid4().hex}.tmp")
+        try:
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        os.remove(src)
+
+class RequestError(Exception):
+    """Error that maps straight onto an HTTP status (used by code shared between engines)."""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def _guess_type(path):
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+def _open_regular(file_path):
+    """(open file, fstat) for a regular file, else RequestError 404 / 403."""
+    started = time.perf_counter()
+    try:
+        f = open(file_path, "rb")
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        raise RequestError(404, "File Not Found")
+    except PermissionError:
+        raise RequestError(403, "Forbidden")
+    finally:
+        metrics.fs("open", started)
+    st = os.fstat(f.fileno())
+    if not stat.S_ISREG(st.st_mode):
+        f.close()
+        raise RequestError(404, "File Not Found")
+    return f, st
+
+def _delete_path(rel):
+    """/delete: removes a file or an empty folder. Returns (status, message)."""
+    if not isinstance(rel, str):
+        return 400, "Invalid filename"
+    rel = urllib.parse.unquote(rel).lstrip("/")
+    try:
+        target = _safe_join(rel)
+    except PermissionError:
+        return 403, "Access denied"
+
+    if not os.path.exists(target):
+        return 200, f"{rel} not found"
+    try:
+        if os.path.isdir(target):
+            # Only remove empty folder to stay safe
+            os.rmdir(target)
+            message = f"{rel} folder deleted"
+        else:
+            os.remove(target)
+            message = f"{rel} deleted successfully"
+    except OSError:
+        return 200, f"Cannot delete '{rel}': folder not empty or in use"
+    _on_tree_change(target)
+    return 200, message
+
+def _flock(fd):
+    """Exclusive advisory lock between worker processes; released when fd is closed."""
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+def _can_sendfile(sock):
+    if not hasattr(os, "sendfile"):
+        return False
+    if ssl is not None and isinstance(sock, ssl.SSLSocket):
+        return False  # encryption happens in userspace, bytes must pass through Python
+    return isinstance(sock, socket.socket)
+
+def _copy_chunked(f, out, offset, count):
+    """Fallback copy loop: one reusable buffer, so memory stays at COPY_CHUNK_SIZE per transfer."""
+    f.seek(offset)
+    buf = memoryview(bytearray(COPY_CHUNK_SIZE))
+    sent = 0
+    while sent < count:
+        n = f.readinto(buf[:min(COPY_CHUNK_SIZE, count - sent)])
+        if not n:
+            break
+        out.write(buf[:n])
+        sent += n
+    return sent
+
+def _file_validators(st):
+    """(ETag, Last-Modified) for a stat result; ETag changes whenever inode, size or mtime does."""
+    etag = f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+    return etag, email.utils.formatdate(st.st_mtime, usegmt=True)
+
+# ------------- Metrics -------------
+# name -> (type, help); histograms also get _bucket / _sum / _count series
+METRIC_FAMILIES = {
+    "localserver_requests_total": ("counter", "HTTP requests by route, method and status."),
+    "localserver_request_duration_seconds": ("histogram", "Time from request line to the last byte sent."),
+    "localserver_request_bytes_total": ("counter", "Request body bytes (Content-Length) by route."),
+    "localserver_response_bytes_total": ("counter", "Response bytes sent, headers included, by route."),
+    "localserver_transfer_bytes_per_second": ("histogram", "Per-request upload / download throughput."),
+    "localserver_connections_total": ("counter", "Client connections accepted."),
+    "localserver_active_connections": ("gauge", "Client connections currently open."),
+    "localserver_listing_cache_hits_total": ("counter", "Folder listings served from the listing cache."),
+    "localserver_listing_cache_misses_total": ("counter", "Folder listings that needed a scandir."),
+    "localserver_listing_cache_bytes": ("gauge", "Approximate size of the cached listings."),
+    "localserver_listing_cache_entries": ("gauge", "Folders in the listing cache."),
+    "localserver_fs_calls_total": ("counter", "Filesystem calls on the request path, by operation."),
+    "localserver_fs_seconds_total": ("counter", "Time spent in those filesystem calls."),
+    "localserver_dedup_uploads_total": ("counter", "--dedup uploads by whether their content was new."),
+    "localserver_dedup_bytes_saved_total": ("counter", "Bytes not stored again thanks to --dedup."),
+    "localserver_shaping_delay_seconds_total": ("counter", "Time bulk transfers waited for rate-limit tokens."),
+    "localserver_access_log_dropped_total": ("counter", "Access log records dropped because the buffer was full."),
+}
+HISTOGRAM_BUCKETS = {
+    "localserver_request_duration_seconds": LATENCY_BUCKETS,
+    "localserver_transfer_bytes_per_second": THROUGHPUT_BUCKETS,
+}
+
+def _route_label(path):
+    """Bounded route label for a request path (query string ignored)."""
+    path = path.split("?", 1)[0]
+    if path == "/":
+        return "/files"
+    for route in METRIC_ROUTES:
+        if path == route or path.startswith(route + "/"):
+            return route
+    return "other"
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _sample(name, labels, value):
+    if labels:
+        name += "{" + ",".join(f'{k}="{_label_value(v)}"' for k, v in labels) + "}"
+    return f"{name} {value if isinstance(value, int) else repr(float(value))}"
+
+class Metrics:
+    """
+    Lock-light counters. Each thread writes to its own shard (a plain dict), so the hot path
+    takes no lock; /metrics sums the shards. Gauges are counters that also go down.
+    Under --processes every worker also saves its totals to the state dir and /metrics
+    adds up the live workers' files, so any worker answers for the whole server.
+    Keys: (name, labels) or, for histogram buckets, (name, labels, bucket index).
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()  # only taken when a thread creates its shard
+        self.shared_dir = None
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = collections.defaultdict(int)
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def inc(self, name, labels=(), value=1):
+        self._shard()[(name, labels)] += value
+
+    def observe(self, name, labels, value):
+        shard = self._shard()
+        shard[(name, labels, bisect.bisect_left(HISTOGRAM_BUCKETS[name], value))] += 1
+        shard[(name + "_sum", labels)] += value
+        shard[(name + "_count", labels)] += 1
+
+    def fs(self, op, started):
+        """One filesystem call that began at `started` (a time.perf_counter() value)."""
+        shard = self._shard()
+        shard[("localserver_fs_calls_total", (("op", op),))] += 1
+        shard[("localserver_fs_seconds_total", (("op", op),))] += time.perf_counter() - started
+
+    def observe_request(self, method, path, status, seconds, bytes_in, bytes_out):
+        route = _route_label(path)
+        labels = (("route", route),)
+        self.inc("localserver_requests_total", (("route", route), ("method", method), ("status", str(status or 0))))
+        self.observe("localserver_request_duration_seconds", labels, seconds)
+        if bytes_in:
+            self.inc("localserver_request_bytes_total", labels, bytes_in)
+        self.inc("localserver_response_bytes_total", labels, bytes_out)
+        size = bytes_in if route == "/upload" else bytes_out
+        if route in ("/upload", "/download") and size >= THROUGHPUT_MIN_BYTES and seconds > 0:
+            self.observe("localserver_transfer_bytes_per_second", (("direction", route[1:]),), size / seconds)
+
+    def snapshot(self):
+        with self._lock:
+            shards = list(self._shards)
+        totals = collections.defaultdict(int)
+        for shard in shards:
+            for key, value in shard.copy().items():  # dict.copy() is atomic under the GIL
+                totals[key] += value
+        return totals
+
+    def save(self):
+        """This worker's totals -> <state>/metrics/<pid>.json (pre-fork mode)."""
+        path = os.path.join(self.shared_dir, f"{os.getpid()}.json")
+        rows = [[key[0], [list(pair) for pair in key[1]], *key[2:], value] for key, value in self.snapshot().items()]
+        with open(path + ".tmp", "w") as f:
+            json.dump(rows, f)
+        os.replace(path + ".tmp", path)
+
+    def flush_forever(self, interval=METRICS_FLUSH_INTERVAL):
+        while True:
+            time.sleep(interval)
+            self.save()
+
+    def _add_other_workers(self, totals):
+        for name in os.listdir(self.shared_dir):
+            pid = name[:-len(".json")]
+            if not name.endswith(".json") or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            path = os.path.join(self.shared_dir, name)
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                # worker gone: its counters go with it, which Prometheus treats as a counter reset
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(path) as f:
+                    rows = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for row in rows:
+                name, labels, value = row[0], tuple(tuple(pair) for pair in row[1]), row[-1]
+                totals[(name, labels, *row[2:-1])] += value
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        totals = self.snapshot()
+        if self.shared_dir:
+            self._add_other_workers(totals)
+        totals[("localserver_listing_cache_bytes", ())] = listing_cache.nbytes
+        totals[("localserver_listing_cache_entries", ())] = len(listing_cache)
+        for name in ("localserver_connections_total", "localserver_active_connections",
+                     "localserver_listing_cache_hits_total", "localserver_listing_cache_misses_total"):
+            totals[(name, ())] += 0  # unlabelled series are always present
+
+        plain = collections.defaultdict(dict)  # family -> {labels: value}
+        hist = collections.defaultdict(lambda: collections.defaultdict(dict))  # family -> labels -> {bucket: n}
+        for key, value in totals.items():
+            if len(key) == 3:
+                hist[key[0]][key[1]][key[2]] = value
+            elif key[0] in METRIC_FAMILIES:
+                plain[key[0]][key[1]] = value
+
+        lines = []
+        for family, (kind, text) in METRIC_FAMILIES.items():
+            lines += [f"# HELP {family} {text}", f"# TYPE {family} {kind}"]
+            if kind != "histogram":
+                lines += [_sample(family, labels, value) for labels, value in sorted(plain[family].items())]
+                continue
+            bounds = HISTOGRAM_BUCKETS[family]
+            for labels, counts in sorted(hist[family].items()):
+                cumulative = 0
+                for i, bound in enumerate(bounds):
+                    cumulative += counts.get(i, 0)
+                    lines.append(_sample(family + "_bucket", labels + (("le", repr(float(bound))),), cumulative))
+                cumulative += counts.get(len(bounds), 0)
+                lines.append(_sample(family + "_bucket", labels + (("le", "+Inf"),), cumulative))
+                lines.append(_sample(family + "_sum", labels, totals[(family + "_sum", labels)]))
+                lines.append(_sample(family + "_count", labels, totals[(family + "_count", labels)]))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# ------------- Bandwidth shaping -------------
+def _parse_rate(text):
+    """"512K" / "10M" / "1.5G" / "1000" -> bytes per second."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    try:
+        if text[-1:].upper() in units:
+            return int(float(text[:-1]) * units[text[-1].upper()])
+        return int(float(text))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid rate: {text!r}")
+
+def _parse_route_rate(text):
+    """"/download=10M" -> ("/download", bytes per second)."""
+    route, sep, rate = text.partition("=")
+    if not sep or route not in BULK_ROUTES:  # other routes never wait, so a limit would do nothing
+        raise argparse.ArgumentTypeError(f"expected ROUTE=RATE with ROUTE one of {', '.join(BULK_ROUTES)}")
+    return route, _parse_rate(rate)
+
+class TokenBucket:
+    """
+    `rate` bytes/s, at most `burst` seconds worth saved up. take() never blocks: it charges
+    the bytes (the balance may go negative) and returns how long the caller has to wait,
+    so concurrent callers line up behind each other in the order they asked.
+    """
+    def __init__(self, rate, burst=RATE_BURST):
+        self.rate = rate
+        self.burst = max(rate * burst, SHAPE_SLICE)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, n):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+class Shaper:
+    """
+    Global, per-client-IP and per-route token buckets for both directions ("down" / "up").
+    With `share` worker processes each one enforces 1/share of every limit, the per-client
+    ones too: a client's connections may land on any worker.
+    """
+    def __init__(self, down=0, up=0, client_down=0, client_up=0, routes=None, share=1):
+        self.globals = {d: TokenBucket(rate / share) for d, rate in (("down", down), ("up", up)) if rate}
+        self.client_rates = {d: rate / share for d, rate in (("down", client_down), ("up", client_up)) if rate}
+        self.routes = {route: TokenBucket(rate / share) for route, rate in (routes or {}).items() if rate}
+        self.enabled = bool(self.globals or self.client_rates or self.routes)
+        self._clients = {}
+        self._pruned = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _client(self, direction, ip):
+        rate = self.client_rates.get(direction)
+        if not rate:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            if now - self._pruned > CLIENT_BUCKET_IDLE:
+                self._clients = {k: b for k, b in self._clients.items() if now - b.stamp < CLIENT_BUCKET_IDLE}
+                self._pruned = now
+            bucket = self._clients.get((direction, ip))
+            if bucket is None:
+                bucket = self._clients[(direction, ip)] = TokenBucket(rate)
+            return bucket
+
+    def charge(self, direction, ip, route, n):
+        """Charges n bytes to every bucket they count against; returns seconds to wait before moving them."""
+        wait = 0.0
+        for bucket in (self.globals.get(direction), self._client(direction, ip), self.routes.get(route)):
+            if bucket is not None:
+                wait = max(wait, bucket.take(n))
+        return wait
+
+shaper = Shaper()  # replaced by main() when rate limits are given
+
+class _Flow:
+    """
+    One request's traffic through the shaper. Two classes: bytes of non-bulk routes
+    (listings, JSON, pages) and the first PRIORITY_BYTES of each bulk transfer are
+    charged but never wait, so they go out ahead; the rest of a bulk transfer waits
+    for its tokens, SHAPE_SLICE at a time, behind whatever was charged before it.
+    """
+    def __init__(self, ip, path):
+        self.ip = ip
+        self.route = _route_label(path)
+        allowance = PRIORITY_BYTES if self.route in BULK_ROUTES else float("inf")
+        self.allowance = {"down": allowance, "up": allowance}
+
+    def delay(self, direction, n):
+        wait = shaper.charge(direction, self.ip, self.route, n)
+        if self.allowance[direction] >= n:
+            self.allowance[direction] -= n
+            return 0.0
+        self.allowance[direction] = 0
+        if wait:
+            metrics.inc("localserver_shaping_delay_seconds_total", (("direction", direction),), wait)
+        return wait
+
+class _ShapedReader:
+    """rfile wrapper: each read waits for its tokens first, so the unread body stays in the socket."""
+    def __init__(self, raw, throttle):
+        self.raw = raw
+        self.throttle = throttle
+
+    def read(self, n=-1):
+        if n and n > 0:
+            self.throttle("up", n)
+        return self.raw.read(n)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+# ------------- Access log -------------
+ACCESS_LOG_PATH_ROUTES = ("/files/", "/download/", "/zip/", "/api/list/", "/upload/delta/")
+
+def _parse_sample(text):
+    """"/files=0.1" -> ("/files", 0.1)."""
+    route, sep, rate = text.partition("=")
+    try:
+        rate = float(rate)
+    except ValueError:
+        sep = ""
+    if not sep or route not in METRIC_ROUTES or not 0 <= rate <= 1:
+        raise argparse.ArgumentTypeError(f"expected ROUTE=FRACTION with ROUTE one of {', '.join(METRIC_ROUTES)}")
+    return route, rate
+
+def _logged_file(target):
+    """The path under BASE_DIR a request was about, if its URL names one."""
+    path = target.split("?", 1)[0]
+    for prefix in ACCESS_LOG_PATH_ROUTES:
+        if path.startswith(prefix):
+            try:
+                return _safe_join(urllib.parse.unquote(path[len(prefix):]))
+            except PermissionError:
+                return None
+    return None
+
+class AccessLog:
+    """
+    JSON-lines access log that never blocks request threads. A finished request
+    only appends one small dict to a bounded in-memory buffer (full => dropped and counted);
+    a background thread formats, writes and flushes them in batches, and rotates the file
+    by size / age. Sampled routes log a fraction of their successful requests.
+    """
+    def __init__(self, path=ACCESS_LOG, sample=None, capacity=ACCESS_LOG_BUFFER):
+        self.path = None if path in (None, "", "off") else path
+        self.sample = dict(ACCESS_LOG_SAMPLE if sample is None else sample)
+        self.capacity = capacity
+        self._buf = collections.deque()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()  # one flush at a time (writer thread / exit)
+        self.f = None
+        self.opened = 0
+
+    def _put(self, rec):
+        if len(self._buf) >= self.capacity:
+            metrics.inc("localserver_access_log_dropped_total")
+            return
+        self._buf.append(rec)
+        if len(self._buf) >= ACCESS_LOG_BATCH:
+            self._wake.set()
+
+    def record(self, client, method, target, status, seconds, bytes_in, bytes_out):
+        """One finished request (request thread side: no formatting, no I/O)."""
+        if self.path is None:
+            return
+        route = _route_label(target)
+        rate = self.sample.get(route, 1.0)
+        if rate < 1.0 and (status or 0) < 400 and random.random() >= rate:
+            return
+        self._put({"ts": time.time(), "client": client, "method": method, "path": target, "route": route,
+                   "status": status, "bytes_in": bytes_in, "bytes_out": bytes_out,
+                   "duration_ms": round(seconds * 1000, 3), "sample_rate": rate})
+
+    def message(self, client, text):
+        """Free-form server messages (log_message: errors etc.) go the same way."""
+        if self.path is not None:
+            self._put({"ts": time.time(), "client": client, "message": text})
+
+    # --- writer side ---
+    def _format(self, rec):
+        rec["ts"] = datetime.datetime.fromtimestamp(rec["ts"], datetime.timezone.utc).isoformat(timespec="milliseconds")
+        if "path" in rec:
+            file_path = _logged_file(rec["path"])
+            if file_path is not None:
+                rec["file"] = file_path
+        if rec.get("sample_rate") == 1.0:
+            del rec["sample_rate"]
+        return json.dumps(rec, ensure_ascii=False, separators=(",", ":"))
+
+    def _open(self):
+        self.f = open(self.path, "a", encoding="utf-8", errors="surrogateescape")
+        self.opened = time.time()
+
+    def _rotate_if_due(self):
+        st = os.fstat(self.f.fileno())
+        if st.st_size < ACCESS_LOG_MAX_BYTES and time.time() - self.opened < ACCESS_LOG_MAX_AGE:
+            return
+        # pre-fork workers share the file: whoever gets the lock first rotates, the rest just reopen
+        with open(self.path + ".lock", "a") as lock:
+            _flock(lock.fileno())
+            try:
+                current = os.stat(self.path)
+            except FileNotFoundError:
+                current = None
+            if current is not None and (current.st_dev, current.st_ino) == (st.st_dev, st.st_ino):
+                if ACCESS_LOG_BACKUPS:
+                    for i in range(ACCESS_LOG_BACKUPS - 1, 0, -1):
+                        if os.path.exists(f"{self.path}.{i}"):
+                            os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+                    os.replace(self.path, f"{self.path}.1")
+                else:
+                    os.remove(self.path)
+            self.f.close()
+            self._open()
+
+    def flush(self):
+        with self._lock:
+            batch = []
+            while self._buf:
+                batch.append(self._buf.popleft())
+            if not batch:
+                return
+            lines = "".join(self._format(rec) + "\n" for rec in batch)
+            if self.path == "-":
+                sys.stderr.write(lines)
+                sys.stderr.flush()
+                return
+            if self.f is None:
+                self._open()
+            self.f.write(lines)
+            self.f.flush()
+            self._rotate_if_due()
+
+    def run_forever(self):
+        while True:
+            self._wake.wait(ACCESS_LOG_FLUSH_INTERVAL)
+            self._wake.clear()
+            try:
+                self.flush()
+            except (OSError, ValueError) as e:
+                print(f"access log: {e}", file=sys.stderr)
+                time.sleep(ACCESS_LOG_FLUSH_INTERVAL)
+
+access_log = AccessLog()  # replaced by main() from --access-log / --log-sample
+
+# ------------- Compression -------------
+ENCODING_PREFERENCE = [enc for enc, available in
+                       (("zstd", zstandard is not None), ("br", brotli is not None), ("gzip", True)) if available]
+
+def _compressible(ctype, name=""):
+    name = name.lower()
+    if name.endswith(PRECOMPRESSED_EXTS):
+        return False
+    ctype = (ctype or "").split(";")[0].strip()
+    return ctype.startswith("text/") or ctype in COMPRESSIBLE_TYPES or name.endswith(TEXT_EXTS)
+
+def _negotiate_encoding(accept):
+    """Best supported encoding by Accept-Encoding q-values; None => identity."""
+    qualities = {}
+    for item in accept.split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qualities[coding] = q
+    best, best_q = None, 0.0
+    for enc in ENCODING_PREFERENCE:
+        q = qualities.get(enc, qualities.get("*", 0.0))
+        if q > best_q:
+            best, best_q = enc, q
+    return best
+
+def _variant_etag(etag, encoding):
+    """Compressed variants need their own ETag: "abc" -> "abc-gzip"."""
+    if not etag or not encoding:
+        return etag
+    return etag[:-1] + f'-{encoding}"'
+
+class _Encoder:
+    """Same compress / flush / finish interface over zlib (gzip), brotli and zstandard."""
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        elif encoding == "br":
+            self._c = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._c = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self._c.process(data)
+        return self._c.compress(data)
+
+    def flush(self):
+        """Everything fed so far becomes decodable by the client (used between streamed chunks)."""
+        if self.encoding == "gzip":
+            return self._c.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == "br":
+            return self._c.flush()
+        return self._c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self._c.finish()
+        return self._c.flush()
+
+def _compress(data, encoding):
+    enc = _Encoder(encoding)
+    return enc.compress(data) + enc.finish()
+
+class CompressedCache:
+    """
+    LRU cache of compressed variants, key = (ETag, encoding).
+    Popular text files / pages get compressed once instead of on every request.
+    """
+    def __init__(self, max_bytes=COMPRESS_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            self._items[key] = data
+            self.nbytes += len(data)
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+compressed_cache = CompressedCache()
+
+def _compressed_body(f, etag, encoding):
+    """Whole compressed variant of an open file, via compressed_cache (keyed by etag + encoding)."""
+    key = (etag, encoding)
+    body = compressed_cache.get(key)
+    if body is None:
+        enc = _Encoder(encoding)
+        parts = [enc.compress(chunk) for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b"")]
+        parts.append(enc.finish())
+        body = b"".join(parts)
+        compressed_cache.put(key, body)
+    return body
+
+def _etag_matches(header, etag):
+    """If-None-Match check with weak comparison (W/ prefixes ignored), "*" matches anything."""
+    if header.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == bare:
+            return True
+    return False
+
+def _not_modified_since(header, mtime):
+    try:
+        since = email.utils.parsedate_to_datetime(header)
+    except (TypeError, ValueError, IndexError):
+        return False
+    if since is None:
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=datetime.timezone.utc)
+    return int(mtime) <= since.timestamp()
+
+def _cache_headers(route, etag=None, mtime=None, encoding=None, vary=False):
+    headers = [("Cache-Control", CACHE_CONTROL[route])]
+    if vary:
+        headers.append(("Vary", "Accept-Encoding"))
+    if etag:
+        headers.append(("ETag", _variant_etag(etag, encoding)))
+    if mtime:
+        headers.append(("Last-Modified", email.utils.formatdate(mtime, usegmt=True)))
+    return headers
+
+def _content_disposition(filename):
+    """attachment header value: an ASCII fallback name plus the real one as RFC 5987 filename*."""
+    fallback = "".join(c if " " <= c < "\x7f" and c not in '"\\' else "_" for c in filename)
+    encoded = urllib.parse.quote(filename.encode("utf-8", "surrogateescape"), safe="")
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{encoded}"
+
+def _is_fresh(req_headers, response_headers, mtime):
+    """True when If-None-Match / If-Modified-Since say the client's copy is current (=> 304)."""
+    etag = dict(response_headers).get("ETag")
+    inm = req_headers.get("If-None-Match")
+    if inm is not None:
+        return etag is not None and _etag_matches(inm, etag)
+    ims = req_headers.get("If-Modified-Since")
+    return ims is not None and mtime is not None and _not_modified_since(ims, mtime)
+
+def _pick_encoding(req_headers, ctype, name="", size=None):
+    """Content-Encoding for a response (None => identity), from Accept-Encoding and the type."""
+    if not _compressible(ctype, name) or (size is not None and size < COMPRESS_MIN_SIZE):
+        return None
+    return _negotiate_encoding(req_headers.get("Accept-Encoding", ""))
+
+def _select_ranges(req_headers, size, etag, last_modified):
+    """Ranges to serve: None => whole body, [] => 416, else [(start, end), ...]."""
+    range_header = req_headers.get("Range")
+    if not range_header:
+        return None
+    if_range = req_headers.get("If-Range")
+    # If-Range: only honour Range when the client's copy is still current
+    if if_range is not None and if_range.strip() not in (etag, last_modified):
+        return None
+    return _parse_range(range_header, size)
+
+def _byteranges(ranges, ctype, size):
+    """multipart/byteranges framing: (content type, part heads, tail, total length)."""
+    boundary = uuid.uuid4().hex
+    heads = [
+        (f"\r\n--{boundary}\r\nContent-Type: {ctype}\r\n"
+         f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode()
+        for start, end in ranges
+    ]
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    length = sum(len(h) for h in heads) + sum(e - s + 1 for s, e in ranges) + len(tail)
+    return f"multipart/byteranges; boundary={boundary}", heads, tail, length
+
+def _parse_range(header, size):
+    """
+    Parses a Range header like "bytes=0-99,200-".
+    Returns None when the header should be ignored (bad syntax / too many ranges),
+    [] when nothing is satisfiable (=> 416), else sorted, merged [(start, end_inclusive), ...].
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, dash, last = part.partition("-")
+        if not dash:
+            return None
+        first, last = first.strip(), last.strip()
+        try:
+            if not first:               # suffix range: last N bytes
+                n = int(last)
+                if n <= 0:
+                    continue
+                start, end = max(0, size - n), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if start < 0 or (last and end < start):
+                    return None
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+class MultipartError(ValueError):
+    pass
+
+class MultipartParser:
+    """
+    Streaming multipart/form-data parser. feed() the body in chunks of any size; boundaries
+    split across chunks are still found, and memory stays at about one chunk.
+
+    part_factory(headers) is called at the start of every part with its parsed headers
+    (an email.message.Message) and returns a sink with write(bytes) and close().
+    """
+    _PREAMBLE, _HEADERS, _BODY, _AFTER_DELIMITER, _DONE = range(5)
+
+    def __init__(self, boundary, part_factory):
+        if not boundary:
+            raise MultipartError("Missing boundary")
+        self.delimiter = b"\r\n--" + boundary
+        self.part_factory = part_factory
+        self.part = None
+        # leading CRLF lets the first boundary match the same delimiter as all the others
+        self._buf = bytearray(b"\r\n")
+        self._state = self._PREAMBLE
+
+    @property
+    def finished(self):
+        return self._state == self._DONE
+
+    def feed(self, data):
+        self._buf += data
+        while self._step():
+            pass
+
+    def _step(self):
+        buf = self._buf
+        if self._state == self._PREAMBLE:
+            idx = buf.find(self.delimiter)
+            if idx < 0:
+                del buf[:max(0, len(buf) - len(self.delimiter) + 1)]
+                return False
+            del buf[:idx + len(self.delimiter)]
+            self._state = self._AFTER_DELIMITER
+            return True
+
+        if self._state == self._AFTER_DELIMITER:
+            if len(buf) < 2:
+                return False
+            if buf[:2] == b"--":
+                self._state = self._DONE
+                buf.clear()
+                return False
+            end = buf.find(b"\r\n")
+            if end < 0:
+                if len(buf) > MAX_PART_HEADER_SIZE:
+                    raise MultipartError("Malformed boundary line")
+                return False
+            del buf[:end + 2]  # transport padding + CRLF after the boundary
+            self._state = self._HEADERS
+            return True
+
+        if self._state == self._HEADERS:
+            end = buf.find(b"\r\n\r\n")
+            if end < 0:
+                if len(buf) > MAX_PART_HEADER_SIZE:
+                    raise MultipartError("Part headers too large")
+                return False
+            raw = bytes(buf[:end]).decode("utf-8", errors="replace")
+            del buf[:end + 4]
+            self.part = self.part_factory(email.parser.HeaderParser().parsestr(raw))
+            self._state = self._BODY
+            return True
+
+        if self._state == self._BODY:
+            idx = buf.find(self.delimiter)
+            if idx < 0:
+                # keep a tail that could be the start of a split delimiter
+                keep = len(self.delimiter) - 1
+                if len(buf) > keep:
+                    self.part.write(bytes(buf[:len(buf) - keep]))
+                    del buf[:len(buf) - keep]
+                return False
+            if idx:
+                self.part.write(bytes(buf[:idx]))
+            del buf[:idx + len(self.delimiter)]
+            self.part.close()
+            self.part = None
+            self._state = self._AFTER_DELIMITER
+            return True
+
+        buf.clear()  # epilogue after the closing boundary is ignored
+        return False
+
+def _header_param(value, param):
+    """One parameter (quoted or not) of a Content-Type / Content-Disposition header."""
+    msg = email.message.Message()
+    msg["content-type"] = value
+    return msg.get_param(param)
+
+class MultipartUpload:
+    """
+    State of one multipart POST /upload: files stream to disk, fields stay in memory.
+    Pure feed()-driven, so both serving engines drive it with their own reads.
+    """
+    def __init__(self, content_type, length=0):
+        if not content_type.startswith('multipart/form-data'):
+            raise MultipartError("Bad Request")
+        boundary = (_header_param(content_type, "boundary") or "").encode()
+        self.fields, self.saved = {}, []
+        self.remaining = length  # body bytes not fed yet: an upper bound for the next file's size
+        self.parser = MultipartParser(boundary, self._part_factory)
+
+    def _part_factory(self, headers):
+        name = headers.get_param("name", header="content-disposition") or ""
+        filename = headers.get_filename()
+        # Paths sanitize
+        filename = os.path.basename((filename or "").replace("\\", "/"))
+        if not filename:
+            return _FieldSink(name, self.fields)  # plain field, or an empty <input type=file>
+        # an optional "dir" field sent before the files picks the folder (relative to BASE_DIR)
+        try:
+            target_dir = _safe_join(self.fields["dir"]) if self.fields.get("dir") else BASE_DIR
+        except PermissionError:
+            raise MultipartError("Access denied")
+        if not os.path.isdir(target_dir):
+            raise MultipartError("Folder not found")
+        if _reserved_name(filename, target_dir):
+            raise MultipartError(f"Invalid filename '{filename}'")
+        sink = (_DedupSink if dedup_store is not None else _FileSink)(os.path.join(target_dir, filename),
+                                                                      self.remaining)
+        self.saved.append(sink)
+        return sink
+
+    def feed(self, chunk):
+        self.parser.feed(chunk)
+        self.remaining -= len(chunk)
+
+    def finish(self):
+        """Saved files (relative paths); MultipartError if the body was cut short."""
+        if not self.parser.finished:
+            raise MultipartError("Upload ended before the closing boundary")
+        for sink in self.saved:
+            _on_tree_change(sink.path)
+        return [sink.rel_path for sink in self.saved]
+
+    def fail(self):
+        """Drops the half-written part; returns the files that did complete."""
+        if self.parser.part is not None:
+            self.parser.part.abort()
+        for sink in self.saved:
+            _on_tree_change(sink.path)
+        return [sink.rel_path for sink in self.saved if sink.done]
+
+class _FieldSink:
+    """Plain form field, collected in memory (bounded)."""
+    def __init__(self, name, fields):
+        self.name, self.fields, self.data = name, fields, bytearray()
+
+    def write(self, data):
+        self.data += data
+        if len(self.data) > MAX_FIELD_SIZE:
+            raise MultipartError(f"Field '{self.name}' too large")
+
+    def close(self):
+        self.fields[self.name] = self.data.decode("utf-8", errors="replace")
+
+    def abort(self):
+        pass
+
+class _FileSink:
+    """
+    File part. Streams into a hidden temp file next to the target, UPLOAD_WRITE_SIZE
+    at a time, then os.replace()s it into place: nobody sees a half-written file, a
+    failed upload leaves the old file alone, and of two uploads to the same name the
+    one that finishes last wins, whole.
+    """
+    def __init__(self, path, size_hint=0):
+        self.path = path
+        self.rel_path = os.path.relpath(path, BASE_DIR).replace("\\", "/")
+        self.done = False
+        self.size = 0
+        self._buf = bytearray()
+        self.tmp = self._temp_path()
+        self.f = open(self.tmp, "xb", buffering=0)
+        # size_hint is the rest of the request body, so the tail is trimmed once the real size is known
+        self._hint = size_hint if size_hint >= UPLOAD_PREALLOCATE_MIN else 0
+        self._reserved = 0
+
+    def _temp_path(self):
+        folder, name = os.path.split(self.path)
+        return os.path.join(folder, f".{name}.{uuid.uuid4().hex[:12]}{UPLOAD_TMP_SUFFIX}")
+
+    def write(self, data):
+        self._buf += data
+        if len(self._buf) >= UPLOAD_WRITE_SIZE:
+            self._flush(len(self._buf) - len(self._buf) % UPLOAD_WRITE_SIZE)
+
+    def _flush(self, n):
+        if self.size + n > self._reserved and self._reserved < self._hint:
+            step = max(n, min(UPLOAD_PREALLOCATE_STEP, self._hint - self._reserved))
+            if _preallocate(self.f.fileno(), self._reserved, step):
+                self._reserved += step
+            else:
+                self._hint = 0  # no point asking again
+        started = time.perf_counter()
+        with memoryview(self._buf) as view:
+            done = 0
+            while done < n:
+                done += self.f.write(view[done:n])
+        del self._buf[:n]
+        self.size += n
+        metrics.fs("write", started)
+
+    def _finish(self):
+        """Last partial block out, preallocated tail trimmed, data synced per UPLOAD_FSYNC; closes the file."""
+        if self._buf:
+            self._flush(len(self._buf))
+        if self._reserved > self.size:
+            self.f.truncate(self.size)
+        _fsync_file(self.f.fileno())
+        self.f.close()
+
+    def close(self):
+        self._finish()
+        os.replace(self.tmp, self.path)
+        _fsync_dir(os.path.dirname(self.path))
+        self.done = True
+
+    def abort(self):
+        self.f.close()
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+
+class _DedupSink(_FileSink):
+    """File part for --dedup: streams into the store's temp dir, hashing as it goes."""
+    def __init__(self, path, size_hint=0):
+        self.sha256 = hashlib.sha256()
+        super().__init__(path, size_hint)
+
+    def _temp_path(self):
+        return dedup_store.temp_path()
+
+    def write(self, data):
+        self.sha256.update(data)
+        super().write(data)
+
+    def close(self):
+        self._finish()
+        dedup_store.add(self.tmp, self.sha256.hexdigest(), self.path)
+        _fsync_dir(os.path.dirname(self.path))
+        self.done = True
+
+# changes whenever this file changes, so rendered pages from an older build never validate
+with open(__file__, "rb") as _source:
+    _BUILD_ID = hashlib.sha1(_source.read()).hexdigest()[:8]
+
+# ------------- Listing engine -------------
+# folders: size = recursive bytes, files = recursive file count (None until the totals are known)
+Entry = collections.namedtuple("Entry", "name is_dir size mtime files", defaults=(None,))
+
+def _scan_dir(abs_path):
+    """One os.scandir pass, one stat per entry. Folders first, then by name."""
+    entries = []
+    at_root = os.path.normpath(abs_path) == os.path.normpath(BASE_DIR)
+    rel_dir = "" if at_root else _rel_from_base(abs_path)
+    started = time.perf_counter()
+    with os.scandir(abs_path) as it:
+        for e in it:
+            if _hidden(e.name, at_root):
+                continue
+            try:
+                st = e.stat()
+            except OSError:
+                continue  # broken symlink / vanished while listing
+            if stat.S_ISDIR(st.st_mode):
+                size, files = folder_sizes.get(f"{rel_dir}/{e.name}" if rel_dir else e.name)
+                entries.append(Entry(e.name, True, size, st.st_mtime, files))
+            else:
+                entries.append(Entry(e.name, False, st.st_size, st.st_mtime))
+    metrics.fs("scandir", started)
+    entries.sort(key=lambda x: (not x.is_dir, x.name.lower()))
+    return entries
+
+class Listing:
+    """Cached snapshot of one folder. version changes whenever the folder's mtime does."""
+    __slots__ = ("path", "version", "entries", "orders", "nbytes", "created", "_validators")
+
+    def __init__(self, path, version, entries):
+        self.path = path
+        self.version = version
+        self.entries = entries
+        self.orders = {}  # (sort, desc) -> (entries in that order, name -> index)
+        self._validators = None
+        self.nbytes = 200 + sum(120 + len(e.name) for e in entries)  # rough estimate
+        self.created = time.monotonic()
+
+    def validators(self):
+        """(weak ETag, newest of folder and entry mtimes), computed once per snapshot."""
+        if self._validators is None:
+            h = hashlib.blake2b(_BUILD_ID.encode(), digest_size=8)
+            newest = self.version[1] / 1e9  # a rename or delete only moves the folder's own mtime
+            for e in self.entries:
+                h.update(f"{e.name}\0{e.is_dir:d}\0{e.size}\0{e.mtime}\0{e.files}\n".encode("utf-8", "surrogateescape"))
+                newest = max(newest, e.mtime)
+            self._validators = (f'W/"{h.hexdigest()}"', newest)
+        return self._validators
+
+class ListingCache:
+    """
+    In-process LRU cache of folder listings, key = path + folder mtime.
+    Unchanged folders cost one stat() per view; evicts least recently used past max_bytes.
+    """
+    def __init__(self, max_bytes=LISTING_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, abs_path):
+        """Listing for abs_path; raises FileNotFoundError / NotADirectoryError like scandir."""
+        started = time.perf_counter()
+        st = os.stat(abs_path)
+        metrics.fs("stat", started)
+        if not stat.S_ISDIR(st.st_mode):
+            raise NotADirectoryError(abs_path)
+        version = (st.st_ino, st.st_mtime_ns)
+        now = time.monotonic()
+        with self._lock:
+            hit = self._items.get(abs_path)
+            if hit is not None and hit.version == version and now - hit.created < LISTING_CACHE_MAX_AGE:
+                self._items.move_to_end(abs_path)
+                metrics.inc("localserver_listing_cache_hits_total")
+                return hit
+
+        metrics.inc("localserver_listing_cache_misses_total")
+        listing = Listing(abs_path, version, _scan_dir(abs_path))
+        if time.time() - st.st_mtime < LISTING_CACHE_RACY_WINDOW or listing.nbytes > self.max_bytes:
+            return listing  # may still change within the same mtime tick / too big to keep
+        with self._lock:
+            old = self._items.pop(abs_path, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._items[abs_path] = listing
+            self.nbytes += listing.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return listing
+
+    def __len__(self):
+        return len(self._items)
+
+    def invalidate(self, abs_path):
+        with self._lock:
+            old = self._items.pop(os.path.normpath(abs_path), None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+listing_cache = ListingCache()
+
+SORT_KEYS = {
+    "name": lambda e: e.name.lower(),
+    "size": lambda e: e.size,
+    "date": lambda e: e.mtime,
+}
+SORT_KEY_TYPES = {"name": str, "size": int, "date": (int, float)}  # for keys read back from a cursor
+DEFAULT_ORDER = {"name": "asc", "size": "desc", "date": "desc"}  # same as the old client-side sort
+
+def _ordered(listing, sort, desc):
+    """Entries sorted by one field (folders always first); computed once per cached listing."""
+    key = (sort, desc)
+    cached = listing.orders.get(key)
+    if cached is None:
+        ordered = sorted(listing.entries, key=SORT_KEYS[sort], reverse=desc)
+        ordered.sort(key=lambda e: not e.is_dir)  # stable, keeps the field order inside each group
+        cached = listing.orders[key] = (ordered, {e.name: i for i, e in enumerate(ordered)})
+    return cached
+
+def _get_listing(rel_path):
+    """(listing, None) or (None, (status, message)) for a folder under BASE_DIR."""
+    try:
+        return listing_cache.get(_safe_join(rel_path)), None
+    except PermissionError:
+        return None, (403, "Access denied")
+    except (FileNotFoundError, NotADirectoryError):
+        return None, (404, "Folder not found")
+
+def _page_args(params, default_limit):
+    try:
+        limit = int(params.get("limit", default_limit))
+    except ValueError:
+        raise ValueError("Invalid limit")
+    return dict(sort=params.get("sort", "name"), order=params.get("order"), q=params.get("q", ""),
+                cursor=params.get("cursor"), limit=max(1, min(limit, API_MAX_PAGE_SIZE)))
+
+def _encode_cursor(entry, sort, offset):
+    data = {"after": entry.name, "o": offset, "d": entry.is_dir, "k": SORT_KEYS[sort](entry)}
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+def _decode_cursor(cursor):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(data["after"]), int(data["o"]), data.get("d"), data.get("k")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise ValueError("Invalid cursor")
+
+def _resume_at(ordered, sort, desc, name, is_dir, key):
+    """First position in ordered that sorts after the (now gone) entry a cursor points at."""
+    def before_or_at(e):
+        if e.is_dir != is_dir:
+            return e.is_dir
+        k = SORT_KEYS[sort](e)
+        if k != key:
+            return k > key if desc else k < key
+        return e.name.lower() <= name.lower()  # ties keep _scan_dir's order
+    lo, hi = 0, len(ordered)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if before_or_at(ordered[mid]):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def _list_page(listing, sort="name", order=None, q="", cursor=None, limit=LISTING_PAGE_SIZE):
+    """
+    One page of a listing: (entries, next_cursor, total_matching).
+    The cursor remembers the last entry returned, so pages stay consistent while files are
+    added or removed; if that entry vanished, the page resumes where it would have sorted.
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Unknown sort '{sort}'")
+    order = order or DEFAULT_ORDER[sort]
+    if order not in ("asc", "desc"):
+        raise ValueError(f"Unknown order '{order}'")
+    ordered, index = _ordered(listing, sort, order == "desc")
+    if q:
+        q = q.lower()
+        ordered = [e for e in ordered if q in e.name.lower()]
+        index = None
+
+    start = 0
+    if cursor:
+        after, offset, is_dir, key = _decode_cursor(cursor)
+        if index is None:
+            index = {e.name: i for i, e in enumerate(ordered)}
+        if after in index:
+            start = index[after] + 1
+        elif isinstance(is_dir, bool) and isinstance(key, SORT_KEY_TYPES[sort]):
+            start = _resume_at(ordered, sort, order == "desc", after, is_dir, key)
+        else:
+            start = offset
+    page = ordered[start:start + limit]
+    end = start + len(page)
+    next_cursor = _encode_cursor(page[-1], sort, end) if page and end < len(ordered) else None
+    return page, next_cursor, len(ordered)
+
+# ------------- Search index -------------
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def _remove_stale_upload_temp(entry):
+    """An upload temp file nobody has written to for UPLOAD_TMP_MAX_AGE was left behind by a crash."""
+    if not _is_upload_temp(entry.name):
+        return
+    try:
+        if time.time() - entry.stat(follow_symlinks=False).st_mtime > UPLOAD_TMP_MAX_AGE:
+            os.remove(entry.path)
+    except OSError:
+        pass
+
+class SearchIndex:
+    """
+    In-memory name index of every file and folder under BASE_DIR.
+    Trigram postings answer substring queries, a name-sorted id list answers short prefix queries.
+    Built in the background, updated by the server's own uploads/deletes, and reconciled by
+    re-listing folders whose mtime changed. Removed ids go dead until compact() renumbers.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = []              # id -> (rel_path, lowercase name, is_dir); kept after removal
+        self._alive = bytearray()     # id -> 1 while the name exists
+        self._dead = 0
+        self._trigrams = {}           # trigram -> array of ids (dead ones included until compact())
+        self._prefix = array.array("I")   # ids sorted by lowercase name
+        self._unsorted = []           # ids added during a walk, sorted into _prefix once it ends
+        self._walking = 0
+        self._dirs = {"": {}}         # rel_dir -> {name: id}
+        self._dir_mtime = {}          # rel_dir -> st_mtime_ns when last listed
+        self.ready = False
+
+    def __len__(self):
+        return len(self._items) - self._dead
+
+    def _bisect(self, lower):
+        """First position in _prefix whose name is >= lower (lock held)."""
+        lo, hi = 0, len(self._prefix)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._items[self._prefix[mid]][1] < lower:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # --- mutations (lock held) ---
+    def _add(self, rel_dir, name, is_dir):
+        children = self._dirs.setdefault(rel_dir, {})
+        if name in children:
+            return
+        rel = f"{rel_dir}/{name}" if rel_dir else name
+        lower = name.lower()
+        i = len(self._items)
+        self._items.append((rel, lower, is_dir))
+        self._alive.append(1)
+        for t in _trigrams(lower):
+            ids = self._trigrams.get(t)
+            if ids is None:
+                ids = self._trigrams[t] = array.array("I")
+            ids.append(i)
+        if self._walking:
+            self._unsorted.append(i)  # one sort at the end beats an insert per name
+        else:
+            self._prefix.insert(self._bisect(lower), i)
+        children[name] = i
+        if is_dir:
+            self._dirs.setdefault(rel, {})
+
+    def _remove(self, rel_dir, name):
+        i = self._dirs.get(rel_dir, {}).pop(name, None)
+        if i is None:
+            return
+        rel, lower, is_dir = self._items[i]
+        self._alive[i] = 0
+        self._dead += 1
+        if is_dir:
+            for child in list(self._dirs.get(rel, {})):
+                self._remove(rel, child)
+            self._dirs.pop(rel, None)
+            self._dir_mtime.pop(rel, None)
+
+    def _sort_unsorted(self):
+        if self._walking or not self._unsorted:
+            return
+        key = lambda i: self._items[i][1]
+        added = sorted(self._unsorted, key=key)
+        self._unsorted = []
+        self._prefix = array.array("I", heapq.merge(self._prefix, added, key=key))
+
+    def compact(self):
+        """Renumber the live names, dropping dead ids from every structure."""
+        with self._lock:
+            if self._dead <= max(SEARCH_COMPACT_MIN, len(self)) or self._walking:
+                return
+            new_id = {}
+            items = []
+            for i, item in enumerate(self._items):
+                if self._alive[i]:
+                    new_id[i] = len(items)
+                    items.append(item)
+            trigrams = {}
+            for t, ids in self._trigrams.items():
+                live = array.array("I", [new_id[i] for i in ids if i in new_id])
+                if live:
+                    trigrams[t] = live
+            self._trigrams = trigrams
+            self._prefix = array.array("I", [new_id[i] for i in self._prefix if i in new_id])
+            self._dirs = {rel: {name: new_id[i] for name, i in children.items()}
+                          for rel, children in self._dirs.items()}
+            self._items = items
+            self._alive = bytearray(b"\1") * len(items)
+            self._dead = 0
+
+    def _list(self, rel_dir):
+        """(mtime_ns, {name: is_dir}) for a folder, or None if it is gone."""
+        abs_dir = os.path.join(BASE_DIR, rel_dir) if rel_dir else BASE_DIR
+        try:
+            mtime = os.stat(abs_dir).st_mtime_ns
+            children = {}
+            with os.scandir(abs_dir) as it:
+                for e in it:
+                    if _hidden(e.name, not rel_dir):
+                        _remove_stale_upload_temp(e)
+                        continue
+                    try:
+                        children[e.name] = e.is_dir()
+                    except OSError:
+                        continue
+        except OSError:
+            return None
+        return mtime, children
+
+    def _sync_dir(self, rel_dir, listed):
+        """Bring one folder in line with a fresh listing; returns the subfolders that are new."""
+        mtime, children = listed
+        new_dirs = []
+        with self._lock:
+            known = self._dirs.setdefault(rel_dir, {})
+            for name in [n for n in known if n not in children]:
+                self._remove(rel_dir, name)
+            for name, is_dir in children.items():
+                if name not in known:
+                    self._add(rel_dir, name, is_dir)
+                    if is_dir:
+                        new_dirs.append(f"{rel_dir}/{name}" if rel_dir else name)
+            self._dir_mtime[rel_dir] = mtime
+        return new_dirs
+
+    def _walk(self, rel_dir):
+        with self._lock:
+            self._walking += 1
+        try:
+            stack = [rel_dir]
+            while stack:
+                rel = stack.pop()
+                listed = self._list(rel)
+                if listed is not None:
+                    stack.extend(self._sync_dir(rel, listed))
+        finally:
+            with self._lock:
+                self._walking -= 1
+                self._sort_unsorted()
+
+    # --- public API ---
+    def build(self):
+        self._walk("")
+        self.ready = True
+
+    def reconcile(self):
+        """One stat() per known folder; only folders whose mtime moved are listed again."""
+        with self._lock:
+            dirs = list(self._dirs)
+        for rel_dir in dirs:
+            abs_dir = os.path.join(BASE_DIR, rel_dir) if rel_dir else BASE_DIR
+            try:
+                mtime = os.stat(abs_dir).st_mtime_ns
+            except OSError:
+                continue  # removed; its parent's changed mtime takes care of it
+            if self._dir_mtime.get(rel_dir) == mtime:
+                continue
+            listed = self._list(rel_dir)
+            if listed is not None:
+                for new_dir in self._sync_dir(rel_dir, listed):
+                    self._walk(new_dir)
+        self.compact()
+
+    def run_forever(self, interval=SEARCH_RESCAN_INTERVAL):
+        self.build()
+        while True:
+            time.sleep(interval)
+            self.reconcile()
+
+    def update(self, rel_path):
+        """Called after the server itself created / removed rel_path."""
+        rel_dir, name = os.path.split(rel_path)
+        abs_path = os.path.join(BASE_DIR, rel_path)
+        with self._lock:
+            if os.path.lexists(abs_path):
+                self._add(rel_dir, name, os.path.isdir(abs_path))
+            else:
+                self._remove(rel_dir, name)
+
+    def search(self, q, limit=SEARCH_DEFAULT_LIMIT):
+        """(total, [(rel_path, is_dir), ...]) - name prefix matches first, then other substring matches."""
+        q = q.strip().lower()
+        if not q:
+            return 0, []
+        # the lock only covers picking candidate ids (an array copy); checking and ranking
+        # them runs without it. Items are append-only, so the snapshot stays valid.
+        with self._lock:
+            items, alive = self._items, self._alive
+            if len(q) >= 3:
+                postings = [self._trigrams.get(t) for t in _trigrams(q)]
+                if not all(postings):
+                    return 0, []
+                # the rarest trigram's ids are a superset of the matches; `q in name` does the rest
+                candidates = min(postings, key=len)[:]
+            else:
+                # 1-2 letters: prefix matches only, straight from the sorted name list
+                candidates = self._prefix[self._bisect(q):self._bisect(q + "\uffff")]
+        matches = [item for i, item in zip(candidates, map(items.__getitem__, candidates))
+                   if q in item[1] and alive[i]]
+        # prefix matches rank first: only when there are fewer than `limit` of those do the rest get looked at
+        prefixed = [m for m in matches if m[1].startswith(q)]
+        best = heapq.nsmallest(limit, prefixed, key=lambda m: (len(m[0]), m[0]))
+        if len(best) < limit:
+            rest = (m for m in matches if not m[1].startswith(q))
+            best += heapq.nsmallest(limit - len(best), rest, key=lambda m: (len(m[0]), m[0]))
+        return len(matches), [(rel, is_dir) for rel, _, is_dir in best]
+
+search_index = SearchIndex()
+
+# ------------- Folder sizes -------------
+def _parent(rel):
+    return rel.rpartition("/")[0]
+
+def _child(rel, name):
+    return f"{rel}/{name}" if rel else name
+
+class FolderSizes:
+    """
+    Recursive size and file count of every folder (apparent sizes, like du -b), for the listings.
+    Walked once in the background - or, when totals saved by the last run exist, just
+    checked folder by folder against their mtimes - then kept current: a change only
+    re-lists the folder it happened in and pushes the difference up to the root.
+    Only the folder-sizes thread writes; request threads just read through get().
+    """
+    def __init__(self):
+        self._dirs = {}      # rel_dir -> [mtime_ns, own bytes, own files, total bytes, total files]
+        self._children = {}  # rel_dir -> set of subfolder names
+        self._pending = set()
+        self._cond = threading.Condition()
+        self.ready = False
+        self.dirty = False
+
+    def get(self, rel_dir):
+        """(total bytes, total files); (0, None) while unknown."""
+        node = self._dirs.get(rel_dir) if self.ready else None
+        return (node[3], node[4]) if node is not None else (0, None)
+
+    def changed(self, abs_dir):
+        """Something in abs_dir was created / removed; it's re-listed by the background thread."""
+        with self._cond:
+            self._pending.add(_rel_from_base(abs_dir))
+            self._cond.notify()
+
+    # --- background thread only ---
+    def _scan(self, rel):
+        """(mtime_ns, own bytes, own files, subfolder names), or None if the folder is gone."""
+        abs_dir = os.path.join(BASE_DIR, rel) if rel else BASE_DIR
+        own_bytes = own_files = 0
+        subdirs = set()
+        try:
+            mtime = os.stat(abs_dir).st_mtime_ns
+            with os.scandir(abs_dir) as it:
+                for e in it:
+                    if _hidden(e.name, not rel):
+                        continue
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            subdirs.add(e.name)
+                        elif e.is_file(follow_symlinks=False):
+                            own_bytes += e.stat(follow_symlinks=False).st_size
+                            own_files += 1
+                    except OSError:
+                        continue
+        except OSError:
+            return None
+        return mtime, own_bytes, own_files, subdirs
+
+    def _walk(self, rel):
+        """Lists rel and everything below it (children before parents); returns rel's totals."""
+        stack = [(rel, False)]
+        while stack:
+            d, listed = stack.pop()
+            if listed:
+                node = self._dirs[d]
+                # subfolders that vanished before they were listed don't count
+                children = self._children[d] = {name for name in self._children[d] if _child(d, name) in self._dirs}
+                node[3] = node[1] + sum(self._dirs[_child(d, name)][3] for name in children)
+                node[4] = node[2] + sum(self._dirs[_child(d, name)][4] for name in children)
+                continue
+            scanned = self._scan(d)
+            if scanned is None:
+                continue
+            mtime, own_bytes, own_files, subdirs = scanned
+            self._dirs[d] = [mtime, own_bytes, own_files, own_bytes, own_files]
+            self._children[d] = subdirs
+            stack.append((d, True))
+            stack.extend((_child(d, name), False) for name in subdirs)
+        node = self._dirs.get(rel)
+        return (node[3], node[4]) if node is not None else (0, 0)
+
+    def _drop(self, rel):
+        """Forgets rel and everything below it; returns the totals it had."""
+        node = self._dirs.get(rel)
+        if node is None:
+            return 0, 0
+        stack = [rel]
+        while stack:
+            d = stack.pop()
+            self._dirs.pop(d, None)
+            stack.extend(_child(d, name) for name in self._children.pop(d, ()))
+        return node[3], node[4]
+
+    def _add_up(self, rel, nbytes, nfiles):
+        """Adds the difference to rel and every ancestor; the listings showing them are refreshed."""
+        d = rel
+        while True:
+            node = self._dirs.get(d)
+            if node is not None:
+                node[3] += nbytes
+                node[4] += nfiles
+            if not d:
+                break
+            d = _parent(d)
+            listing_cache.invalidate(os.path.join(BASE_DIR, d) if d else BASE_DIR)
+        self.dirty = True
+
+    def refresh(self, rel):
+        """Re-lists one folder: new subfolders are walked, vanished ones dropped."""
+        node = self._dirs.get(rel)
+        if node is None:
+            if rel:
+                self.refresh(_parent(rel))  # new to us: found (and walked) from the nearest known parent
+            return
+        scanned = self._scan(rel)
+        if scanned is None:
+            return  # gone: the parent's refresh drops it
+        mtime, own_bytes, own_files, subdirs = scanned
+        nbytes, nfiles = own_bytes - node[1], own_files - node[2]
+        known = self._children[rel]
+        for name in subdirs - known:
+            b, f = self._walk(_child(rel, name))
+            nbytes, nfiles = nbytes + b, nfiles + f
+        for name in known - subdirs:
+            b, f = self._drop(_child(rel, name))
+            nbytes, nfiles = nbytes - b, nfiles - f
+        node[0], node[1], node[2] = mtime, own_bytes, own_files
+        self._children[rel] = subdirs
+        self.dirty = True
+        if nbytes or nfiles:
+            self._add_up(rel, nbytes, nfiles)
+
+    def reconcile(self):
+        """One stat() per known folder; only folders whose mtime moved are listed again."""
+        for rel in list(self._dirs):
+            node = self._dirs.get(rel)
+            abs_dir = os.path.join(BASE_DIR, rel) if rel else BASE_DIR
+            try:
+                mtime = os.stat(abs_dir).st_mtime_ns
+            except OSError:
+                continue  # removed; its parent's changed mtime takes care of it
+            if node is not None and node[0] != mtime:
+                self.refresh(rel)
+
+    def load(self, path):
+        """Totals saved by an earlier run: {rel_dir: [mtime_ns, own bytes, own files]}."""
+        with open(path) as f:
+            saved = json.load(f)
+        self._dirs = {rel: [m, b, n, b, n] for rel, (m, b, n) in saved.items()}
+        self._children = {rel: set() for rel in self._dirs}
+        for rel in self._dirs:
+            if rel:
+                self._children.setdefault(_parent(rel), set()).add(rel.rpartition("/")[2])
+        if "" not in self._dirs:
+            raise ValueError("no root folder")
+        for rel in sorted(self._dirs, key=lambda r: r.count("/") + (r != ""), reverse=True):
+            if rel:  # children first, so each total is complete before it is added to the parent's
+                parent = self._dirs.get(_parent(rel))
+                if parent is None:
+                    raise ValueError(f"orphan folder {rel!r}")
+                parent[3] += self._dirs[rel][3]
+                parent[4] += self._dirs[rel][4]
+
+    def save(self, path):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({rel: node[:3] for rel, node in self._dirs.items()}, f, separators=(",", ":"))
+        os.replace(tmp, path)
+        self.dirty = False
+
+    def run_forever(self):
+        path = os.path.join(_state_path(), "folder_sizes.json")
+        try:
+            self.load(path)
+        except (OSError, ValueError, TypeError):
+            self._walk("")
+            self.dirty = True
+        else:
+            self.reconcile()
+        self.ready = True
+        listing_cache.clear()  # listings cached so far were built without the totals
+        next_reconcile = time.monotonic() + FOLDER_SIZES_RESCAN_INTERVAL
+        next_save = time.monotonic()
+        while True:
+            with self._cond:
+                if not self._pending:
+                    self._cond.wait(max(0, min(next_reconcile, next_save) - time.monotonic()))
+                pending, self._pending = self._pending, set()
+            # deepest first, so a parent re-listed in the same batch sees its children's new totals
+            for rel in sorted(pending, key=lambda r: r.count("/") + (r != ""), reverse=True):
+                self.refresh(rel)
+            now = time.monotonic()
+            if now >= next_reconcile:
+                self.reconcile()
+                next_reconcile = now + FOLDER_SIZES_RESCAN_INTERVAL
+            if now >= next_save:
+                if self.dirty:
+                    try:
+                        self.save(path)
+                    except OSError:
+                        pass  # e.g. read-only folder: totals just aren't kept across restarts
+                next_save = now + FOLDER_SIZES_SAVE_INTERVAL
 
-if not os.path.exists(BASE_DIR):
-    os.makedirs(BASE_DIR)
+folder_sizes = FolderSizes()
 
-def _safe_join(rel_path: str) -> str:
+# ------------- Change feed -------------
+class ChangeFeed:
     """
-    BASE_DIR + rel_path ko normalize karke ensure karta hai ke path BASE_DIR ke andar hi rahe.
+    Pre-fork: every worker has its own listing cache, folder totals and search index. A change
+    made through one worker is appended to .localserver/changes/ and the others replay it
+    within CHANGE_FEED_INTERVAL. The log is a series of numbered segments: appends go to the
+    newest one (under a lock file), and a reader moves on only once it has read its segment
+    to the end, so a burst of changes can't slip past it.
     """
-    rel_path = rel_path.strip().lstrip("/")  # sanitize
-    abs_path = os.path.normpath(os.path.join(BASE_DIR, rel_path))
-    base_norm = os.path.normpath(BASE_DIR)
-    if not abs_path.startswith(base_norm):
-        raise PermissionError("Path outside base dir")
-    return abs_path
+    def __init__(self):
+        self.dir = None  # single process: nothing to share
+        self._rf = None
+        self._seq = 0
+        self._tail = b""
+
+    def _segment(self, seq):
+        return os.path.join(self.dir, f"{seq:010d}.log")
+
+    def _newest(self):
+        seqs = [int(name[:-4]) for name in os.listdir(self.dir) if name.endswith(".log") and name[:-4].isdigit()]
+        return max(seqs, default=0)
+
+    def start(self):
+        self.dir = _state_path("changes")
+        with open(os.path.join(self.dir, "lock"), "a") as lock:
+            _flock(lock.fileno())
+            self._seq = self._newest()
+            self._rf = open(self._segment(self._seq), "ab+")
+        self._rf.seek(0, os.SEEK_END)  # this worker's own walks cover everything before now
+
+    def publish(self, abs_path):
+        if self.dir is None:
+            return
+        line = (json.dumps([os.getpid(), abs_path]) + "\n").encode("ascii")
+        try:
+            with open(os.path.join(self.dir, "lock"), "a") as lock:
+                _flock(lock.fileno())
+                seq = self._newest()
+                try:
+                    full = os.stat(self._segment(seq)).st_size > CHANGE_FEED_MAX_BYTES
+                except FileNotFoundError:
+                    full = False
+                if full:
+                    seq += 1
+                    try:
+                        # a reader this far behind has missed changes anyway; its reconcile catches up
+                        os.remove(self._segment(seq - CHANGE_FEED_SEGMENTS))
+                    except FileNotFoundError:
+                        pass
+                with open(self._segment(seq), "ab") as f:
+                    f.write(line)
+        except OSError:
+            pass  # siblings catch up at their next reconcile instead
+
+    def poll(self):
+        """Changes appended by other workers since the last call, as absolute paths."""
+        data = self._rf.read()
+        while os.path.exists(self._segment(self._seq + 1)):
+            # nothing is appended to a segment once the next one exists
+            data += self._rf.read()
+            self._rf.close()
+            self._seq += 1
+            try:
+                self._rf = open(self._segment(self._seq), "rb")
+            except FileNotFoundError:
+                self._seq = self._newest()  # fell too far behind
+                self._rf = open(self._segment(self._seq), "rb")
+            data += self._rf.read()
+        *lines, self._tail = (self._tail + data).split(b"\n")
+        changed = []
+        for line in lines:
+            try:
+                pid, abs_path = json.loads(line)
+            except ValueError:
+                continue
+            if pid != os.getpid():
+                changed.append(abs_path)
+        return changed
+
+    def run_forever(self):
+        while True:
+            time.sleep(CHANGE_FEED_INTERVAL)
+            try:
+                changed = self.poll()
+            except OSError:
+                continue
+            for abs_path in changed:
+                _update_views(abs_path)
+
+change_feed = ChangeFeed()  # started by start_background_services() in pre-fork workers
+
+def _on_tree_change(abs_path):
+    """The server itself created or removed abs_path: update caches and indexes right away."""
+    _forget_signatures(abs_path)
+    if dedup_store is not None:
+        dedup_store.check(abs_path)
+    _update_views(abs_path)
+    change_feed.publish(abs_path)
+
+def _update_views(abs_path):
+    """This process's in-memory views of the tree; also run for changes sibling workers made."""
+    listing_cache.invalidate(abs_path)
+    listing_cache.invalidate(os.path.dirname(abs_path))
+    folder_sizes.changed(os.path.dirname(abs_path))
+    rel = _rel_from_base(abs_path)
+    if rel:
+        search_index.update(rel)
+
+# ------------- Dedup store -------------
+def _clone_file(src, dst):
+    """
+    dst as src's blocks, shared: a reflink, else a hardlink (src must be read-only: the
+    server only ever replaces paths, never writes through them), else a plain copy.
+    dst is replaced atomically. Returns the method.
+    """
+    tmp = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        method = "reflink"
+        try:
+            with open(src, "rb") as s, open(tmp, "wb") as d:
+                if fcntl is None:
+                    raise OSError(errno.EOPNOTSUPP, "no ioctl")
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            os.remove(tmp)
+            method = "hardlink"  # e.g. ext4: no reflinks
+            try:
+                os.link(src, tmp)
+            except OSError:
+                method = "copy"  # links not supported either
+                shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return method
+
+class DedupStore:
+    """
+    Content-addressed upload store (--dedup). Uploads are hashed as they stream in; the bytes are
+    kept once, read-only, as .localserver/blobs/<sha[:2]>/<sha>, and every visible file is a
+    reflink or hardlink of its blob (a hardlinked file is read-only too, and uploads replace
+    it rather than write into it). An sqlite index maps visible paths to hashes; a blob goes
+    when the last path using it is deleted.
+    """
+    _SHA = re.compile(r"^[0-9a-f]{64}$")
+
+    def __init__(self):
+        self.dir = _state_path("blobs")
+        self.tmp_dir = _state_path("blobs", "tmp")
+        self._db_path = os.path.join(self.dir, "index.sqlite3")
+        self._local = threading.local()
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")  # readers don't block the writer (other workers too)
+            db.execute("CREATE TABLE IF NOT EXISTS blobs (sha TEXT PRIMARY KEY, size INTEGER NOT NULL)")
+            if "mtime_ns" not in [row[1] for row in db.execute("PRAGMA table_info(blobs)")]:
+                db.execute("ALTER TABLE blobs ADD COLUMN mtime_ns INTEGER")
+            db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, sha TEXT NOT NULL, "
+                       "dev INTEGER NOT NULL, ino INTEGER NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS files_sha ON files (sha)")
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self._db_path, timeout=30)
+        return db
+
+    def blob_path(self, sha):
+        return os.path.join(self.dir, sha[:2], sha)
+
+    def lookup(self, sha):
+        """(size, refs) if the store has this content, else None."""
+        if not self._SHA.match(sha or ""):
+            return None
+        row = self._db().execute(
+            "SELECT size, (SELECT COUNT(*) FROM files WHERE sha = ?) FROM blobs WHERE sha = ?", (sha, sha)).fetchone()
+        if row is None or not os.path.exists(self.blob_path(sha)):
+            return None
+        return row
+
+    def temp_path(self):
+        """Where an upload streams to until its hash is known."""
+        return os.path.join(self.tmp_dir, uuid.uuid4().hex)
+
+    def add(self, tmp_path, sha, target):
+        """Finished upload: keep its bytes as the blob (unless already there) and link it to target."""
+        blob = self.blob_path(sha)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        size = os.path.getsize(tmp_path)
+        os.chmod(tmp_path, 0o444)
+        try:
+            os.link(tmp_path, blob)  # atomic "create if absent"; a concurrent identical upload is fine
+            new = True
+        except FileExistsError:
+            new = False
+            if not self._intact(sha, size):
+                os.replace(tmp_path, blob)  # the stored blob was changed; these bytes hash to sha
+                new = True
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+        if new:
+            with self._db() as db:
+                db.execute("INSERT OR REPLACE INTO blobs (sha, size, mtime_ns) VALUES (?, ?, ?)",
+                           (sha, size, os.stat(blob).st_mtime_ns))
+        method = self.link(sha, target)
+        metrics.inc("localserver_dedup_uploads_total", (("result", "new" if new else "duplicate"),))
+        if not new and method != "copy":
+            metrics.inc("localserver_dedup_bytes_saved_total", value=size)
+        return method
+
+    def _intact(self, sha, size):
+        """The blob on disk is still the one recorded: same size and mtime, still read-only."""
+        row = self._db().execute("SELECT size, mtime_ns FROM blobs WHERE sha = ?", (sha,)).fetchone()
+        try:
+            st = os.stat(self.blob_path(sha))
+        except OSError:
+            return False
+        return (row is not None and row[0] == size == st.st_size and row[1] in (None, st.st_mtime_ns)
+                and not st.st_mode & 0o222)
+
+    def link(self, sha, target):
+        """Visible copy of a stored blob at target (replacing whatever was there)."""
+        method = _clone_file(self.blob_path(sha), target)
+        st = os.stat(target)
+        with self._db() as db:
+            old = db.execute("SELECT sha FROM files WHERE path = ?", (target,)).fetchone()
+            db.execute("INSERT OR REPLACE INTO files (path, sha, dev, ino) VALUES (?, ?, ?, ?)",
+                       (target, sha, st.st_dev, st.st_ino))
+        if old and old[0] != sha:
+            self._release(old[0])
+        return method
+
+    def check(self, abs_path):
+        """abs_path changed: if it no longer is the file we linked there, drop that reference."""
+        db = self._db()
+        row = db.execute("SELECT sha, dev, ino FROM files WHERE path = ?", (abs_path,)).fetchone()
+        if row is None:
+            return
+        try:
+            st = os.stat(abs_path)
+            if (st.st_dev, st.st_ino) == (row[1], row[2]):
+                return
+        except OSError:
+            pass  # deleted
+        with db:
+            db.execute("DELETE FROM files WHERE path = ? AND ino = ?", (abs_path, row[2]))
+        self._release(row[0])
+
+    def _release(self, sha):
+        with self._db() as db:
+            if db.execute("SELECT 1 FROM files WHERE sha = ? LIMIT 1", (sha,)).fetchone():
+                return
+            db.execute("DELETE FROM blobs WHERE sha = ?", (sha,))
+        try:
+            os.remove(self.blob_path(sha))
+        except OSError:
+            pass
+
+    def reconcile(self):
+        """Startup pass: forget paths changed behind our back, drop unused blobs and stale temp files."""
+        db = self._db()
+        for path, sha, dev, ino in db.execute("SELECT path, sha, dev, ino FROM files").fetchall():
+            self.check(path)
+        for (sha,) in db.execute("SELECT sha FROM blobs WHERE sha NOT IN (SELECT sha FROM files)").fetchall():
+            self._release(sha)
+        cutoff = time.time() - DEDUP_TMP_MAX_AGE
+        for name in os.listdir(self.tmp_dir):
+            path = os.path.join(self.tmp_dir, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+dedup_store = None  # DedupStore, created at startup with --dedup
+
+# ------------- Resumable upload sessions -------------
+class UploadError(RequestError):
+    pass
+
+def _upload_target(filename, rel_dir):
+    """(sanitised filename, target folder) for a JSON upload API request, else UploadError."""
+    filename = os.path.basename((filename or "").replace("\\", "/"))
+    if not filename:
+        raise UploadError(400, "Filename missing")
+    try:
+        target_dir = _safe_join(rel_dir or "")
+    except PermissionError:
+        raise UploadError(403, "Access denied")
+    if not os.path.isdir(target_dir):
+        raise UploadError(404, "Folder not found")
+    if _reserved_name(filename, target_dir):
+        raise UploadError(400, f"Invalid filename '{filename}'")
+    return filename, target_dir
+
+class UploadSession:
+    """One resumable upload: a sparse .part file (preallocated chunk by chunk) plus the set of chunk indices received."""
+    def __init__(self, sid, filename, target_dir, size, chunk_size, received=(), updated=None):
+        self.id = sid
+        self.filename = filename
+        self.target_dir = target_dir
+        self.size = size
+        self.chunk_size = chunk_size
+        self.received = set(received)
+        self.updated = updated or time.time()
+        self.lock = threading.Lock()
+
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def to_json(self):
+        return {"id": self.id, "filename": self.filename, "size": self.size, "chunk_size": self.chunk_size,
+                "dir": _rel_from_base(self.target_dir),
+                "received": sorted(self.received)}
+
+class UploadSessions:
+    """
+    Chunked, resumable uploads. Chunks are positionally written (os.pwrite) into
+    BASE_DIR/.localserver/uploads/<id>.part in any order and in parallel; commit
+    atomically renames the finished file into place. Session state is saved next to the
+    .part file, so uploads survive a server restart. Idle sessions are garbage-collected.
+    The saved state is the source of truth: with --processes the chunks of one session
+    arrive at different worker processes, which serialise their updates with flock.
+    """
+    _ID = re.compile(r"^[0-9a-f]{32}$")
+
+    def __init__(self):
+        self.dir = _state_path("uploads")
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _paths(self, sid):
+        base = os.path.join(self.dir, sid)
+        return base + ".part", base + ".json"
+
+    def _read(self, sid):
+        """Saved state of one session, or None if it's gone (committed / aborted / never existed)."""
+        part, meta = self._paths(sid)
+        try:
+            with open(meta) as f:
+                meta = json.load(f)
+            session = UploadSession(meta["id"], meta["filename"], meta["target_dir"], meta["size"],
+                                    meta["chunk_size"], meta["received"], meta["updated"])
+        except (OSError, ValueError, KeyError):
+            return None
+        return session if os.path.exists(part) else None
+
+    def _load_all(self):
+        for name in os.listdir(self.dir):
+            if name.endswith(".json") and self._ID.match(name[:-5]):
+                session = self._read(name[:-5])
+                if session is not None:
+                    yield session
+
+    def _load(self):
+        for session in self._load_all():
+            self._sessions[session.id] = session
+
+    def _refresh(self, session):
+        """Picks up chunks other worker processes saved; call with session.lock held."""
+        saved = self._read(session.id)
+        if saved is None:
+            raise UploadError(404, "Upload session not found")
+        session.received |= saved.received
+        session.updated = max(session.updated, saved.updated)
+
+    def _save(self, session):
+        part, meta = self._paths(session.id)
+        tmp = meta + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"id": session.id, "filename": session.filename, "target_dir": session.target_dir,
+                       "size": session.size, "chunk_size": session.chunk_size,
+                       "received": sorted(session.received), "updated": session.updated}, f)
+        os.replace(tmp, meta)
+
+    def get(self, sid):
+        if not self._ID.match(sid or ""):
+            raise UploadError(404, "Upload session not found")
+        with self._lock:
+            session = self._sessions.get(sid)
+        if session is None:
+            # created by another worker process (or before a restart)
+            session = self._read(sid)
+            if session is None:
+                raise UploadError(404, "Upload session not found")
+            with self._lock:
+                session = self._sessions.setdefault(sid, session)
+        else:
+            with session.lock:
+                try:
+                    self._refresh(session)
+                except UploadError:
+                    with self._lock:
+                        self._sessions.pop(sid, None)
+                    raise
+        return session
+
+    def create(self, filename, rel_dir, size, chunk_size=None):
+        filename, target_dir = _upload_target(filename, rel_dir)
+        try:
+            size = int(size)
+            chunk_size = int(chunk_size or UPLOAD_CHUNK_SIZE)
+        except (TypeError, ValueError):
+            raise UploadError(400, "Invalid size")
+        if size < 0:
+            raise UploadError(400, "Invalid size")
+        chunk_size = max(UPLOAD_MIN_CHUNK_SIZE, min(chunk_size, UPLOAD_MAX_CHUNK_SIZE))
+
+        session = UploadSession(uuid.uuid4().hex, filename, target_dir, size, chunk_size)
+        part, _ = self._paths(session.id)
+        try:
+            with open(part, "wb") as f:
+                f.truncate(size)  # sparse; chunks fill it in any order
+        except OSError as e:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(part)
+            if e.errno == errno.EFBIG:
+                raise UploadError(413, "File too large for this filesystem")
+            raise
+        self._save(session)
+        with self._lock:
+            self._sessions[session.id] = session
+        return session
+
+    def write_chunk(self, session, index, length, rfile):
+        """Copies one chunk from rfile straight to its offset, UPLOAD_BUFFER_SIZE at a time."""
+        if not 0 <= index < session.chunk_count:
+            raise UploadError(400, "Chunk index out of range")
+        if length != session.chunk_length(index):
+            raise UploadError(400, f"Chunk {index} must be {session.chunk_length(index)} bytes")
+        part, _ = self._paths(session.id)
+        offset = index * session.chunk_size
+        try:
+            fd = os.open(part, os.O_WRONLY)
+        except FileNotFoundError:
+            raise UploadError(404, "Upload session not found")
+        try:
+            _preallocate(fd, offset, length)
+            remaining = length
+            while remaining > 0:
+                data = rfile.read(min(remaining, UPLOAD_BUFFER_SIZE))
+                if not data:
+                    raise UploadError(400, "Chunk ended early")
+                started = time.perf_counter()
+                os.pwrite(fd, data, offset)
+                metrics.fs("write", started)
+                offset += len(data)
+                remaining -= len(data)
+            with session.lock:
+                _flock(fd)  # released by the close below
+                self._refresh(session)
+                session.received.add(index)
+                session.updated = time.time()
+                self._save(session)
+        finally:
+            os.close(fd)
+
+    def commit(self, session):
+        part, meta = self._paths(session.id)
+        try:
+            fd = os.open(part, os.O_RDONLY)
+        except FileNotFoundError:
+            raise UploadError(404, "Upload session not found")
+        with session.lock:
+            try:
+                _flock(fd)
+                self._refresh(session)
+                missing = [i for i in range(session.chunk_count) if i not in session.received]
+                if missing:
+                    raise UploadError(409, f"{len(missing)} chunk(s) missing")
+                if not os.path.isdir(session.target_dir):
+                    raise UploadError(404, "Folder not found")
+                target = os.path.join(session.target_dir, session.filename)
+                _fsync_file(fd)
+                _atomic_move(part, target)
+                _fsync_dir(session.target_dir)
+                os.remove(meta)
+            finally:
+                os.close(fd)
+        with self._lock:
+            self._sessions.pop(session.id, None)
+        _on_tree_change(target)
+        return target
+
+    def abort(self, session):
+        with self._lock:
+            self._sessions.pop(session.id, None)
+        for path in self._paths(session.id):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def collect_garbage(self, ttl=UPLOAD_SESSION_TTL):
+        cutoff = time.time() - ttl
+        # judged by the saved state, which other worker processes keep current too
+        for session in list(self._load_all()):
+            if session.updated < cutoff:
+                self.abort(session)
+        with self._lock:
+            for sid in [sid for sid in self._sessions if not os.path.exists(self._paths(sid)[0])]:
+                del self._sessions[sid]
+
+    def gc_forever(self, interval=UPLOAD_GC_INTERVAL):
+        while True:
+            self.collect_garbage()
+            time.sleep(interval)
+
+upload_sessions = None  # UploadSessions, created by main() once BASE_DIR is known
+
+# ------------- Delta sync -------------
+def _delta_block_size(value):
+    try:
+        block_size = int(value)
+    except (TypeError, ValueError):
+        raise UploadError(400, "Invalid block_size")
+    if not DELTA_MIN_BLOCK_SIZE <= block_size <= DELTA_MAX_BLOCK_SIZE:
+        raise UploadError(400, f"block_size must be {DELTA_MIN_BLOCK_SIZE}..{DELTA_MAX_BLOCK_SIZE}")
+    return block_size
+
+def _signature_prefix(rel):
+    return hashlib.blake2b(rel.encode("utf-8", "surrogateescape"), digest_size=8).hexdigest()
+
+def _delta_signature(file_path, block_size):
+    """
+    Block signature of a file as cached JSON: (path of the JSON, its ETag).
+    Each file version (ETag) + block size is hashed only once: signatures live in
+    a folder per file path, named by version + block size, so a changed file simply misses.
+    """
+    f, st = _open_regular(file_path)
+    with f:
+        version, _ = _file_validators(st)
+        prefix = _signature_prefix(_rel_from_base(file_path))
+        key = hashlib.blake2b(f"{version}\0{block_size}".encode(), digest_size=8).hexdigest()
+        sig_path = os.path.join(_state_path("delta", prefix), f"{key}.json")
+        etag = f'"{prefix}-{key}"'
+        if os.path.exists(sig_path):
+            return sig_path, etag
+        weak, strong = [], []
+        buf = memoryview(bytearray(block_size))
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            block = buf[:n]
+            weak.append(zlib.adler32(block))
+            strong.append(hashlib.blake2b(block, digest_size=16).hexdigest())
+    sig = {"path": _rel_from_base(file_path), "version": version, "size": st.st_size,
+           "block_size": block_size, "weak": weak, "strong": strong}
+    tmp = f"{sig_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as out:
+        json.dump(sig, out, separators=(",", ":"))
+    os.replace(tmp, sig_path)
+    _forget_signatures(file_path, keep=sig_path)
+    return sig_path, etag
+
+def _forget_signatures(file_path, keep=None):
+    """Drops cached signatures of file_path (all of them, or all but `keep`)."""
+    sig_dir = os.path.join(BASE_DIR, STATE_DIR_NAME, "delta", _signature_prefix(_rel_from_base(file_path)))
+    try:
+        names = os.listdir(sig_dir)
+    except OSError:
+        return  # never signed
+    for name in names:
+        path = os.path.join(sig_dir, name)
+        if path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    if keep is None:
+        try:
+            os.rmdir(sig_dir)
+        except OSError:
+            pass
+
+def _apply_delta(file_path, recipe, rfile, body_left):
+    """
+    Builds the new version of file_path from a delta recipe and swaps it in; returns its size.
+    Ops run in order: [first_block, count] copies blocks of the current version,
+    an integer n takes the next n literal bytes from the request body.
+    """
+    try:
+        version, size, ops = recipe["version"], recipe["size"], recipe["ops"]
+    except (KeyError, TypeError):
+        raise UploadError(400, "Recipe needs version, block_size, size and ops")
+    block_size = _delta_block_size(recipe.get("block_size"))
+    checksum = recipe.get("sha256")
+    if not isinstance(size, int) or size < 0 or not isinstance(ops, list):
+        raise UploadError(400, "Invalid recipe")
+    f, st = _open_regular(file_path)
+    with f:
+        if _file_validators(st)[0] != version:
+            raise UploadError(409, "File changed since its signature was taken")
+        sink = (_DedupSink if dedup_store is not None else _FileSink)(file_path, size)
+        sha256 = hashlib.sha256() if checksum else None
+        written = 0
+        try:
+            for op in ops:
+                if isinstance(op, int) and not isinstance(op, bool):
+                    if not 0 <= op <= body_left:
+                        raise UploadError(400, "Literal runs past the end of the body")
+                    pieces = _read_literal(rfile, op)
+                    body_left -= op
+                elif (isinstance(op, list) and len(op) == 2
+                      and all(isinstance(v, int) and not isinstance(v, bool) for v in op)):
+                    first, count = op
+                    offset = first * block_size
+                    if first < 0 or count <= 0 or offset >= st.st_size:
+                        raise UploadError(400, f"Block range {op} is outside the current file")
+                    pieces = _read_blocks(f.fileno(), offset, min(count * block_size, st.st_size - offset))
+                else:
+                    raise UploadError(400, f"Invalid op {op!r}")
+                for piece in pieces:
+                    written += len(piece)
+                    if written > size:
+                        raise UploadError(400, "Recipe builds more than size bytes")
+                    if sha256:
+                        sha256.update(piece)
+                    sink.write(piece)
+            if written != size:
+                raise UploadError(400, f"Recipe builds {written} bytes, expected {size}")
+            if body_left:
+                raise UploadError(400, f"{body_left} literal bytes left over")
+            if sha256 and sha256.hexdigest() != str(checksum).lower():
+                raise UploadError(400, "sha256 of the rebuilt file doesn't match")
+            sink.close()
+        except BaseException:
+            sink.abort()
+            raise
+    return size
+
+def _read_literal(rfile, count):
+    while count > 0:
+        data = rfile.read(min(count, UPLOAD_BUFFER_SIZE))
+        if not data:
+            raise UploadError(400, "Body ended early")
+        count -= len(data)
+        yield data
+
+def _read_blocks(fd, offset, count):
+    while count > 0:
+        data = os.pread(fd, min(count, COPY_CHUNK_SIZE), offset)
+        if not data:
+            raise UploadError(409, "File changed while applying the delta")
+        offset += len(data)
+        count -= len(data)
+        yield data
+
+class _ChunkedWriter:
+    """
+    File-like writer for a chunked response body. Small writes are gathered up to
+    `buffer_size` before going out as one chunk (buffer_size=0 => every write is a chunk).
+    """
+    def __init__(self, wfile, chunked=True, buffer_size=0):
+        self.wfile = wfile
+        self.chunked = chunked
+        self.buffer_size = buffer_size
+        self._buf = bytearray()
+
+    def write(self, data):
+        if not data:
+            return 0
+        if self.buffer_size:
+            self._buf += data
+            if len(self._buf) >= self.buffer_size:
+                self.flush()
+        else:
+            self._send(data)
+        return len(data)
+
+    def _send(self, data):
+        if self.chunked:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def flush(self):
+        if self._buf:
+            self._send(bytes(self._buf))
+            self._buf.clear()
+
+    def close(self):
+        self.flush()
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+def _iter_tree(abs_dir):
+    """(abs_path, rel_path, DirEntry) for everything under abs_dir, depth-first; symlinked folders aren't followed."""
+    at_root = os.path.normpath(abs_dir) == os.path.normpath(BASE_DIR)
+    stack = [(abs_dir, "", at_root)]
+    while stack:
+        path, rel, root = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        for e in entries:
+            if _hidden(e.name, root):
+                continue
+            child_rel = f"{rel}/{e.name}" if rel else e.name
+            yield e.path, child_rel, e
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    stack.append((e.path, child_rel, False))
+            except OSError:
+                continue
+
+def _write_zip(out, abs_dir):
+    """
+    Streams abs_dir to `out` as a ZIP archive, without a temp file.
+    out is not seekable, so zipfile uses data descriptors; ZIP64 kicks in for big files / archives.
+    Memory stays at one copy buffer no matter how big the folder is.
+    """
+    with zipfile.ZipFile(out, "w", allowZip64=True) as zf:
+        for path, rel, entry in _iter_tree(abs_dir):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    info = zipfile.ZipInfo.from_file(path, rel, strict_timestamps=False)
+                    zf.writestr(info, b"")
+                    continue
+                if not entry.is_file():
+                    continue
+                src = open(path, "rb")
+            except OSError:
+                continue  # vanished / unreadable: leave it out
+            with src:
+                info = zipfile.ZipInfo.from_file(path, rel, strict_timestamps=False)
+                info.file_size = os.fstat(src.fileno()).st_size
+                # media / archives are already compressed: store them, deflate everything else
+                info.compress_type = zipfile.ZIP_STORED if rel.lower().endswith(PRECOMPRESSED_EXTS) else zipfile.ZIP_DEFLATED
+                with zf.open(info, "w", force_zip64=info.file_size >= zipfile.ZIP64_LIMIT) as dest:
+                    shutil.copyfileobj(src, dest, COPY_CHUNK_SIZE)
+
+class _CountingWriter:
+    """
+    wfile wrapper that counts the bytes written (for the response byte metrics).
+    With a throttle, big writes go out SHAPE_SLICE at a time, each after its tokens.
+    """
+    def __init__(self, raw, throttle=None):
+        self.raw = raw
+        self.throttle = throttle
+        self.written = 0
+        self.discard = False  # set after the headers of a HEAD response: the body is dropped
+
+    def write(self, data):
+        if self.discard:
+            return len(data)
+        self.written += len(data)
+        if self.throttle is None:
+            return self.raw.write(data)
+        view = memoryview(data)
+        for i in range(0, len(view), SHAPE_SLICE):
+            piece = view[i:i + SHAPE_SLICE]
+            self.throttle("down", len(piece))
+            self.raw.write(piece)
+        return len(data)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+class ThreadPoolHTTPServer(socketserver.TCPServer):
+    """
+    TCPServer that hands accepted connections to a fixed size worker pool.
+    A slow download doesn't block other clients, and the thread count stays bounded.
+    Between requests a kept-alive connection waits in a selector, not on a worker: only
+    sockets with a new request on them are handed back to the pool.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, workers=MAX_WORKERS, backlog=ACCEPT_BACKLOG, sock=None):
+        self.request_queue_size = backlog
+        # put() blocks when every worker is busy and the queue is full, so the
+        # accept loop stops and further clients wait in the kernel backlog
+        self._pending = queue.Queue(maxsize=backlog)
+        self._workers = []
+        self.draining = False
+        self._idle_new = []   # parked by workers, not yet registered with the selector
+        self._idle_lock = threading.Lock()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        super().__init__(server_address, handler_class, bind_and_activate=sock is None)
+        if sock is not None:
+            # already bound and listening (inherited from the pre-fork supervisor)
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self._worker, name=f"http-worker-{i}", daemon=True)
+            t.start()
+            self._workers.append(t)
+        threading.Thread(target=self._idle_loop, name="http-idle", daemon=True).start()
+
+    def process_request(self, request, client_address):
+        metrics.inc("localserver_connections_total")
+        metrics.inc("localserver_active_connections")
+        self._pending.put((request, client_address))
+
+    def finish_request(self, request, client_address):
+        """True when the connection stays open and should wait for its next request."""
+        handler = self.RequestHandlerClass(request, client_address, self)
+        return getattr(handler, "keep_alive", False)
+
+    def _worker(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            request, client_address = item
+            keep = False
+            try:
+                keep = self.finish_request(request, client_address) and not self.draining
+            except Exception:
+                self.handle_error(request, client_address)
+            if keep:
+                self._park(request, client_address)
+            else:
+                self._close(request)
+
+    def _close(self, request):
+        self.shutdown_request(request)
+        metrics.inc("localserver_active_connections", value=-1)
+
+    def _park(self, request, client_address):
+        with self._idle_lock:
+            self._idle_new.append((request, client_address))
+        self._park_wake()
+
+    def _park_wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except BlockingIOError:
+            pass  # a wake-up is already pending
+
+    def _idle_loop(self):
+        """Kept-alive connections between requests: readable => back to the pool, idle too long => closed."""
+        sel = selectors.DefaultSelector()
+        sel.register(self._wake_r, selectors.EVENT_READ)
+        idle = {}  # socket -> (client_address, parked at)
+        while True:
+            ready = []
+            for key, _ in sel.select(timeout=1):
+                if key.fileobj is self._wake_r:
+                    try:
+                        self._wake_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    sel.unregister(key.fileobj)
+                    ready.append((key.fileobj, idle.pop(key.fileobj)[0]))
+            now = time.monotonic()
+            with self._idle_lock:
+                new, self._idle_new = self._idle_new, []
+            for request, client_address in new:
+                try:
+                    sel.register(request, selectors.EVENT_READ)
+                    idle[request] = (client_address, now)
+                except (ValueError, OSError):
+                    self._close(request)  # closed meanwhile
+            for request, (client_address, since) in list(idle.items()):
+                if self.draining or now - since > KEEPALIVE_TIMEOUT:
+                    sel.unregister(request)
+                    del idle[request]
+                    self._close(request)
+            for request, client_address in ready:
+                if self.draining:
+                    self._close(request)  # like any idle keep-alive close: clients retry on a new connection
+                else:
+                    # the request (or EOF) is already there, so a worker only reads, never waits
+                    self._pending.put((request, client_address))
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """
+        After serve_forever() returned: finish queued and in-flight connections (no new
+        requests on kept-alive ones), waiting at most `timeout` seconds.
+        """
+        self.draining = True
+        self._park_wake()
+        deadline = time.monotonic() + timeout
+        for _ in self._workers:
+            self._pending.put(None)
+        for t in self._workers:
+            t.join(max(0, deadline - time.monotonic()))
+        self._workers = []
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._workers:
+            self._pending.put(None)
+        for t in self._workers:
+            t.join(timeout=1)
+
+
+# ------------- Pages & static assets -------------
+class StaticAsset:
+    """
+    Static body served from memory. The URL carries a content hash, so it can be
+    cached forever; every compressed variant is built once, up front.
+    """
+    def __init__(self, name, ctype, text):
+        self.name = name
+        self.body = text.encode("utf-8")
+        digest = hashlib.sha256(self.body).hexdigest()[:16]
+        stem, ext = os.path.splitext(name)
+        self.url = f"/static/{stem}.{digest}{ext}"
+        self.ctype = ctype
+        self.etag = f'"{digest}"'
+        self.variants = {enc: _compress(self.body, enc) for enc in ENCODING_PREFERENCE}
+
+    def response(self, req_headers, route="asset"):
+        """(body, headers) for this request: compressed variant picked by Accept-Encoding."""
+        encoding = _pick_encoding(req_headers, self.ctype, size=len(self.body))
+        headers = _cache_headers(route, self.etag, encoding=encoding, vary=True)
+        if encoding:
+            headers.append(("Content-Encoding", encoding))
+        return (self.variants[encoding] if encoding else self.body), headers
+
+class PageTemplate:
+    """
+    Page compiled once: literal fragments with {{slot}} holes in between.
+    Slots known at startup (asset URLs, settings) are folded into the literals
+    right away; render() only fills the per-request ones and joins once.
+    """
+    def __init__(self, source, **fixed):
+        parts = re.split(r"\{\{(\w+)\}\}", source)
+        self.fragments, self.slots = [parts[0]], []
+        for slot, text in zip(parts[1::2], parts[2::2]):
+            if slot in fixed:
+                self.fragments[-1] += str(fixed[slot]) + text
+            else:
+                self.slots.append(slot)
+                self.fragments.append(text)
+
+    def render(self, **values):
+        out = [self.fragments[0]]
+        for slot, text in zip(self.slots, self.fragments[1:]):
+            out.append(values[slot])
+            out.append(text)
+        return "".join(out)
+
+LISTING_CSS = """\
+:root {
+    --bg: #f4f6f9;
+    --text: #222;
+    --card: #fff;
+}
+body {
+    font-family: Arial, sans-serif;
+    background: var(--bg);
+    color: var(--text);
+    text-align: center;
+    padding: 20px;
+    transition: background 0.3s, color 0.3s;
+}
+h2 { color: var(--text); }
+.file-card {
+    background: var(--card);
+    margin: 10px auto;
+    padding: 15px;
+    border-radius: 12px;
+    box-shadow: 0 4px 6px rgba(0,0,0,0.1);
+    width: 90%;
+    max-width: 600px;
+    display: flex;
+    justify-content: space-between;
+    align-items: center;
+    transition: 0.2s;
+}
+.file-card:hover {
+    transform: scale(1.02);
+    box-shadow: 0 6px 12px rgba(0,0,0,0.15);
+}
+a {
+    text-decoration: none;
+    color: #007bff;
+    font-weight: bold;
+}
+a:hover { color: #0056b3; }
+.delete-btn {
+    background: #ff4d4d;
+    border: none;
+    padding: 8px 12px;
+    border-radius: 8px;
+    color: white;
+    font-weight: bold;
+    cursor: pointer;
+}
+.delete-btn:hover { background: #cc0000; }
+.zip-link {
+    margin-right: 8px;
+    font-weight: normal;
+}
+.upload-link {
+    display: inline-block;
+    margin-top: 20px;
+    padding: 12px 20px;
+    background: #28a745;
+    color: white;
+    border-radius: 10px;
+    text-decoration: none;
+    font-weight: bold;
+}
+.upload-link:hover { background: #218838; }
+.theme-toggle {
+    margin: 20px;
+    padding: 10px 18px;
+    background: #333;
+    color: white;
+    border: none;
+    border-radius: 10px;
+    cursor: pointer;
+}
+.load-more {
+    margin: 10px;
+    padding: 10px 18px;
+    border: none;
+    border-radius: 10px;
+    background: #007bff;
+    color: white;
+    cursor: pointer;
+}
+.search-bar, .sort-select {
+    margin: 10px;
+    padding: 10px;
+    border-radius: 8px;
+    border: 1px solid #ccc;
+    width: 200px;
+}
+"""
+
+LISTING_JS = """\
+// folder bigger than one page => search / sort / paging go through the server
+const partial = nextCursor !== "";
+let currentSort = "name", currentQuery = "", searchTimer = null;
+
+async function loadPage(reset) {
+  const params = new URLSearchParams({ fragment: "1", sort: currentSort, q: currentQuery });
+  if (!reset && nextCursor) params.set("cursor", nextCursor);
+  let res = await fetch("/files/" + folder + "?" + params);
+  let html = await res.text();
+  let list = document.getElementById("file-list");
+  if (reset) list.innerHTML = "";
+  list.insertAdjacentHTML("beforeend", html);
+  nextCursor = res.headers.get("X-Next-Cursor") || "";
+  document.getElementById("load-more").hidden = !nextCursor;
+}
+
+const root = document.documentElement;
+function setTheme(dark) {
+  if (dark) {
+    root.style.setProperty('--bg', '#121212');
+    root.style.setProperty('--text', '#f1f1f1');
+    root.style.setProperty('--card', '#1e1e1e');
+    document.querySelector('.theme-toggle').innerText = "☀️ Light Mode";
+  } else {
+    root.style.setProperty('--bg', '#f4f6f9');
+    root.style.setProperty('--text', '#222');
+    root.style.setProperty('--card', '#fff');
+    document.querySelector('.theme-toggle').innerText = "🌙 Dark Mode";
+  }
+  localStorage.setItem("darkmode", dark);
+}
+function toggleTheme() {
+  const isDark = localStorage.getItem("darkmode") === "true";
+  setTheme(!isDark);
+}
+window.onload = () => {
+  const isDark = localStorage.getItem("darkmode") === "true";
+  setTheme(isDark);
+};
+
+async function deleteFile(filename) {
+  if (!confirm("Are you sure you want to delete " + filename + "?")) return;
+  let res = await fetch("/delete", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ "filename": filename })
+  });
+  let data = await res.json();
+  alert(data.message);
+  location.reload();
+}
+
+let globalTimer = null;
+function searchEverywhere(q) {
+  clearTimeout(globalTimer);
+  let box = document.getElementById("global-results");
+  if (q.length < 2) { box.innerHTML = ""; return; }
+  globalTimer = setTimeout(async () => {
+    let res = await fetch("/search?q=" + encodeURIComponent(q));
+    let data = await res.json();
+    box.innerHTML = data.results.length ? "<h4>Everywhere (" + data.total + ")</h4>" : "";
+    data.results.forEach(r => {
+      let card = document.createElement("div");
+      card.className = "file-card";
+      let a = document.createElement("a");
+      let url = r.path.split("/").map(encodeURIComponent).join("/");
+      a.href = (r.type == "dir" ? "/files/" : "/download/") + url;
+      a.innerText = (r.type == "dir" ? "📂 " : "📄 ") + r.path;
+      card.appendChild(a);
+      box.appendChild(card);
+    });
+  }, 250);
+}
+
+function searchFiles() {
+  let input = document.querySelector(".search-bar").value.toLowerCase();
+  searchEverywhere(input);
+  if (partial) {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => { currentQuery = input; loadPage(true); }, 250);
+    return;
+  }
+  document.querySelectorAll("#file-list .file-card").forEach(card => {
+    card.style.display = card.dataset.name.includes(input) ? "flex" : "none";
+  });
+}
+
+function sortFiles(type) {
+  if (partial) { currentSort = type; loadPage(true); return; }
+  let list = document.getElementById("file-list");
+  let cards = Array.from(list.children);
+  cards.sort((a,b) => {
+    if (type=="name") return a.dataset.name.localeCompare(b.dataset.name);
+    if (type=="size") return b.dataset.size - a.dataset.size;
+    if (type=="date") return b.dataset.date - a.dataset.date;
+  });
+  list.innerHTML="";
+  cards.forEach(c=>list.appendChild(c));
+}
+"""
+
+UPLOAD_CSS = """\
+:root { --bg:#f4f6f9; --text:#222; }
+body {
+    font-family: Arial, sans-serif;
+    background: var(--bg);
+    color: var(--text);
+    text-align: center;
+    padding: 40px;
+    transition: background 0.3s, color 0.3s;
+}
+h2 { color: var(--text); }
+input[type=file], button {
+    margin: 10px;
+    padding: 12px;
+    border-radius: 10px;
+    border: 1px solid #ccc;
+}
+button {
+    background: #28a745;
+    color: white;
+    font-weight: bold;
+    border: none;
+    cursor: pointer;
+}
+button:hover { background: #218838; }
+.drop-zone {
+    margin: 20px auto;
+    padding: 40px;
+    border: 2px dashed #aaa;
+    border-radius: 15px;
+    background: #fafafa;
+    color: #666;
+    cursor: pointer;
+    max-width: 700px;
+}
+.drop-zone.dragover {
+    background: #dff0d8;
+    border-color: #28a745;
+}
+.progress-container {
+    width: 80%;
+    margin: 10px auto;
+    text-align: left;
+    max-width: 700px;
+}
+.progress {
+    width: 100%;
+    background: #ddd;
+    border-radius: 10px;
+    height: 25px;
+    overflow: hidden;
+    margin-bottom: 5px;
+}
+.progress-bar {
+    height: 100%;
+    width: 0;
+    background: #28a745;
+    text-align: center;
+    color: white;
+    line-height: 25px;
+}
+.theme-toggle {
+    margin: 20px;
+    padding: 10px 18px;
+    background: #333;
+    color: white;
+    border: none;
+    border-radius: 10px;
+    cursor: pointer;
+}
+"""
+
+UPLOAD_JS = """\
+const root = document.documentElement;
+function setTheme(dark) {
+  if (dark) {
+    root.style.setProperty('--bg', '#121212');
+    root.style.setProperty('--text', '#f1f1f1');
+    document.querySelector('.theme-toggle').innerText = "☀️ Light Mode";
+  } else {
+    root.style.setProperty('--bg', '#f4f6f9');
+    root.style.setProperty('--text', '#222');
+    document.querySelector('.theme-toggle').innerText = "🌙 Dark Mode";
+  }
+  localStorage.setItem("darkmode", dark);
+}
+function toggleTheme() {
+  const isDark = localStorage.getItem("darkmode") === "true";
+  setTheme(!isDark);
+}
+window.onload = () => {
+  const isDark = localStorage.getItem("darkmode") === "true";
+  setTheme(isDark);
+};
+
+function addProgress(label) {
+  let container = document.createElement("div");
+  container.className="progress-container";
+  container.innerHTML = `<b></b>
+    <div class="progress"><div class="progress-bar">0%</div></div>`;
+  container.querySelector("b").innerText = label;
+  document.getElementById("progressArea").appendChild(container);
+  let bar = container.querySelector(".progress-bar");
+  return percent => { bar.style.width = percent + "%"; bar.innerText = Math.round(percent) + "%"; };
+}
+
+function uploadFiles(files=null) {
+  files = files || document.getElementById("fileInput").files;
+  if (!files.length) { alert("Select files first!"); return; }
+  document.getElementById("progressArea").innerHTML = "";
+  const dir = new URLSearchParams(location.search).get("dir") || "";
+  const small = [...files].filter(f => f.size <= CHUNKED_THRESHOLD);
+  const large = [...files].filter(f => f.size > CHUNKED_THRESHOLD);
+  if (small.length) uploadBatch(small, dir);
+  large.forEach(file => {
+    const show = addProgress(file.name);
+    uploadChunked(file, dir, show).catch(e => alert(file.name + ": " + e.message));
+  });
+}
+
+function uploadBatch(files, dir) {
+  const show = addProgress(`${files.length} file(s): ${files.map(f => f.name).join(", ")}`);
+  // whole batch goes in one multipart request
+  const xhr = new XMLHttpRequest();
+  xhr.upload.addEventListener("progress", e => {
+    if (e.lengthComputable) show((e.loaded / e.total) * 100);
+  });
+  xhr.onload = () => {
+    let data = JSON.parse(xhr.responseText || "{}");
+    if (xhr.status==200) console.log(data.files.join(", ")+" uploaded");
+    else alert(data.message || "Upload failed");
+  };
+  xhr.open("POST","/upload");
+  const formData = new FormData();
+  if (dir) formData.append("dir", dir);  // must come before the files
+  files.forEach(file => formData.append("file", file));
+  xhr.send(formData);
+}
+
+// big files: resumable session, several chunks in flight, survives reloads / dropped connections
+async function uploadChunked(file, dir, show) {
+  const key = "upload:" + dir + "|" + file.name + "|" + file.size + "|" + file.lastModified;
+  let session = null;
+  const saved = localStorage.getItem(key);
+  if (saved) {
+    let res = await fetch("/upload/session/" + saved);
+    if (res.ok) session = await res.json();
+  }
+  if (!session) {
+    let res = await fetch("/upload/session", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ filename: file.name, size: file.size, dir: dir })
+    });
+    session = await res.json();
+    if (!res.ok) throw new Error(session.message);
+    localStorage.setItem(key, session.id);
+  }
+  const total = Math.max(1, Math.ceil(file.size / session.chunk_size));
+  const done = new Set(session.received);
+  const todo = [...Array(total).keys()].filter(i => !done.has(i));
+  show(done.size / total * 100);
+
+  async function worker() {
+    while (todo.length) {
+      const i = todo.shift();
+      const blob = file.slice(i * session.chunk_size, Math.min(file.size, (i + 1) * session.chunk_size));
+      for (let attempt = 0; ; attempt++) {
+        try {
+          let res = await fetch(`/upload/session/${session.id}/${i}`, { method: "PUT", body: blob });
+          if (!res.ok) throw new Error((await res.json()).message);
+          break;
+        } catch (e) {
+          if (attempt >= 4) throw e;
+          await new Promise(r => setTimeout(r, 1000 * (attempt + 1)));
+        }
+      }
+      done.add(i);
+      show(done.size / total * 100);
+    }
+  }
+  await Promise.all(Array.from({ length: PARALLEL_CHUNKS }, worker));
+
+  let res = await fetch(`/upload/session/${session.id}/commit`, { method: "POST" });
+  let data = await res.json();
+  if (!res.ok) throw new Error(data.message);
+  localStorage.removeItem(key);
+  console.log(data.message);
+}
+
+let dropZone = document.getElementById("dropZone");
+dropZone.addEventListener("dragover", e => {
+  e.preventDefault(); dropZone.classList.add("dragover");
+});
+dropZone.addEventListener("dragleave", e => {
+  dropZone.classList.remove("dragover");
+});
+dropZone.addEventListener("drop", e => {
+  e.preventDefault(); dropZone.classList.remove("dragover");
+  uploadFiles(e.dataTransfer.files);
+});
+"""
+
+_assets = (
+    StaticAsset("listing.css", "text/css; charset=utf-8", LISTING_CSS),
+    StaticAsset("listing.js", "application/javascript; charset=utf-8", LISTING_JS),
+    StaticAsset("upload.css", "text/css; charset=utf-8", UPLOAD_CSS),
+    StaticAsset("upload.js", "application/javascript; charset=utf-8", UPLOAD_JS),
+)
+ASSETS = {asset.url: asset for asset in _assets}          # /static/<name>.<hash>.<ext> -> asset
+ASSET_URLS = {asset.name: asset.url for asset in _assets}
+
+# listing page = head + cards (streamed in batches) + tail
+LISTING_HEAD = PageTemplate("""\
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>File Server</title>
+    <link rel="stylesheet" href="{{css}}">
+</head>
+<body>
+    <h2>📂 Available Files {{title}}</h2>
+
+    <input type="text" class="search-bar" placeholder="🔍 Search files..." onkeyup="searchFiles()">
+    <select class="sort-select" onchange="sortFiles(this.value)">
+        <option value="name">Sort by Name</option>
+        <option value="size">Sort by Size</option>
+        <option value="date">Sort by Date</option>
+    </select>
+
+    <div id="global-results"></div>
+{{back_button}}
+    <div id="file-list">
+""", css=ASSET_URLS["listing.css"])
+
+LISTING_BACK = PageTemplate("""
+    <div class="file-card">
+        <a href='/files/{{parent}}'>⬅️ Back</a>
+    </div>
+""")
+
+LISTING_TAIL = PageTemplate("""\
+    </div>
+    <button class="load-more" id="load-more" onclick="loadPage(false)"{{more_hidden}}>More files…</button>
+
+    <br>
+    <a class="upload-link" href="/upload{{upload_query}}">⬆️ Upload Files</a>
+    <a class="upload-link" href="/zip/{{folder}}" download>🗜 Download folder as ZIP</a>
+    <br>
+    <button class="theme-toggle" onclick="toggleTheme()">🌙 Dark Mode</button>
+
+    <script>
+      const folder = "{{folder}}";
+      let nextCursor = "{{next_cursor}}";
+    </script>
+    <script src="{{js}}"></script>
+</body>
+</html>
+""", js=ASSET_URLS["listing.js"])
+
+# nothing per-request on the upload page => rendered once, served like an asset
+UPLOAD_PAGE = StaticAsset("upload.html", "text/html; charset=utf-8", PageTemplate("""\
+<!DOCTYPE html>
+<html>
+<head>
+<meta charset="UTF-8">
+<title>Upload Files</title>
+<link rel="stylesheet" href="{{css}}">
+</head>
+<body>
+    <h2>⬆️ Upload Files</h2>
+    <input type="file" id="fileInput" multiple><br>
+    <div class="drop-zone" id="dropZone">Drag & Drop Files Here</div>
+    <button onclick="uploadFiles()">Upload</button>
+    <div id="progressArea"></div>
+    <br>
+    <a href="/"><button>⬅ Back</button></a>
+    <br>
+    <button class="theme-toggle" onclick="toggleTheme()">🌙 Dark Mode</button>
+    <script>
+      const CHUNKED_THRESHOLD = {{chunked_threshold}};
+      const PARALLEL_CHUNKS = {{parallel_chunks}};
+    </script>
+    <script src="{{js}}"></script>
+</body>
+</html>
+""", css=ASSET_URLS["upload.css"], js=ASSET_URLS["upload.js"], chunked_threshold=UPLOAD_CHUNKED_THRESHOLD,
+     parallel_chunks=UPLOAD_PARALLEL_CHUNKS).render())
+
+class PageRenderer:
+    """Listing page HTML. Mixed into both serving engines' request handlers."""
 
-class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     # ------------- UI Helpers -------------
-    def get_icon(self, name, full_path):
-        if os.path.isdir(full_path):
+    def get_icon(self, name, is_dir):
+        if is_dir:
             return "📂"
         ext = name.lower()
-        if ext.endswith((".mp4", ".mkv", ".avi", ".mov")):
+        if ext.endswith(VIDEO_EXTS):
             return "🎬"
-        elif ext.endswith((".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp")):
+        elif ext.endswith(IMAGE_EXTS):
             return "🖼️"
         elif ext.endswith(".py"):
             return "🐍"
         elif ext.endswith(".pdf"):
             return "📕"
-        elif ext.endswith((".mp3", ".wav", ".ogg")):
+        elif ext.endswith(AUDIO_EXTS):
             return "🎵"
         else:
             return "📄"
 
-    def format_size(self, size):
-        for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-            if size < 1024:
-                return f"{size:.2f} {unit}"
-            size /= 1024
-        return f"{size:.2f} PB"
+    def format_size(self, size):
+        for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+            if size < 1024:
+                return f"{size:.2f} {unit}"
+            size /= 1024
+        return f"{size:.2f} PB"
+
+    def format_date(self, timestamp):
+        return datetime.datetime.fromtimestamp(timestamp).strftime("%d-%m-%Y %H:%M")
+
+    # ------------- Listing (with folders) -------------
+    def render_card(self, entry, rel_path):
+        name, is_dir = entry.name, entry.is_dir
+        rel_child = os.path.join(rel_path, name).replace("\\", "/").lstrip("/")
+        safe_rel = urllib.parse.quote(rel_child)
+        icon = self.get_icon(name, is_dir)
+
+        if is_dir:
+            size_str = "" if entry.files is None else f" ({self.format_size(entry.size)}, {entry.files} files)"
+            link = f"/files/{safe_rel}"
+            download_attr = ""
+        else:
+            size_str = f" ({self.format_size(entry.size)})"
+            link = f"/download/{safe_rel}"
+            download_attr = " download"
+
+        date_str = self.format_date(entry.mtime)
+        actions = f"""<button class="delete-btn" onclick="deleteFile('{safe_rel}')">🗑 Delete</button>"""
+        if is_dir:
+            actions = f"""<span><a class="zip-link" href="/zip/{safe_rel}" download>🗜 ZIP</a> {actions}</span>"""
+        return f"""
+            <div class="file-card" data-name="{escape(name.lower())}" data-size="{entry.size}" data-date="{entry.mtime}">
+                <a href="{link}"{download_attr}>{icon} {escape(name)}{size_str} – <small>{date_str}</small></a>
+                {actions}
+            </div>
+            """
+
+    def iter_cards(self, entries, rel_path):
+        # one join per batch instead of growing a single string card by card
+        for i in range(0, len(entries), LISTING_BATCH):
+            yield "".join(self.render_card(e, rel_path) for e in entries[i:i + LISTING_BATCH])
+
+    def list_files(self, rel_path, listing):
+        """Listing page as a stream of HTML pieces; the first page of entries is rendered inline."""
+        entries, next_cursor, _ = _list_page(listing)
+        folder = urllib.parse.quote(rel_path)
+
+        back_button = ""
+        # Back button if not root
+        if rel_path:
+            back_button = LISTING_BACK.render(parent=urllib.parse.quote(os.path.dirname(rel_path)))
+
+        html = LISTING_HEAD.render(title=escape("/" + rel_path) if rel_path else "", back_button=back_button)
+        if not entries:
+            yield html + "<p>No files here.</p>"
+        else:
+            yield html
+            yield from self.iter_cards(entries, rel_path)
+
+        yield LISTING_TAIL.render(more_hidden="" if next_cursor else " hidden",
+                                  upload_query=f"?dir={folder}" if rel_path else "",
+                                  folder=folder, next_cursor=next_cursor or "")
+
+class MyHTTPRequestHandler(PageRenderer, http.server.SimpleHTTPRequestHandler):
+    # HTTP/1.1 => persistent connections; every response needs a Content-Length
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+    # headers and chunked pieces are separate small writes; with Nagle each one after the
+    # first waits for the client's delayed ACK (~40 ms) on a kept-alive connection
+    disable_nagle_algorithm = True
+    flow = None  # _Flow of the current request when rate limits are on
+
+    def setup(self):
+        super().setup()
+        self._buffered = self.rfile  # before shaping wraps it: what _has_pipelined peeks at
+        self.wfile = _CountingWriter(self.wfile, self.throttle if shaper.enabled else None)
+        if shaper.enabled:
+            self.rfile = _ShapedReader(self.rfile, self.throttle)
+
+    def handle(self):
+        """
+        Requests that are already here (pipelined) are served right away; otherwise the worker
+        is given back and the server parks the connection until the next one arrives.
+        """
+        self.keep_alive = False
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self._has_pipelined():
+                self.keep_alive = True
+                return
+            self.handle_one_request()
+
+    def _has_pipelined(self):
+        """Non-blocking check for bytes of a next request (in rfile's buffer or on the socket)."""
+        self.connection.settimeout(0)
+        try:
+            return bool(self._buffered.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(KEEPALIVE_TIMEOUT)
+
+    def handle_one_request(self):
+        # the request line of a parked connection is already arriving; a client that stalls
+        # halfway through it still only holds the worker for the short idle timeout
+        self.connection.settimeout(KEEPALIVE_TIMEOUT)
+        self.metered(super().handle_one_request)
+        if self.server.draining:
+            self.close_connection = True
+
+    def metered(self, handle, started=None):
+        """Runs one request and records it in metrics once it has begun (request line read)."""
+        self.started, self.status, self.sendfile_bytes, self.flow = started, None, 0, None
+        self.wfile.discard = False
+        written = self.wfile.written
+        try:
+            handle()
+        finally:
+            if self.started is not None:
+                try:
+                    bytes_in = int(self.headers.get("Content-Length") or 0)
+                except (AttributeError, ValueError):
+                    bytes_in = 0
+                seconds, bytes_out = time.perf_counter() - self.started, self.wfile.written - written + self.sendfile_bytes
+                metrics.observe_request(self.command or "-", self.path, self.status, seconds, bytes_in, bytes_out)
+                access_log.record(self.address_string(), self.command or "-", self.path, self.status,
+                                  seconds, bytes_in, bytes_out)
+
+    def address_string(self):
+        return (self.client_address or ("-",))[0]
+
+    def log_request(self, code="-", size="-"):
+        pass  # the access log gets the whole request once it is done (see metered)
+
+    def log_message(self, format, *args):
+        access_log.message(self.address_string(), format % args)
+
+    def parse_request(self):
+        self.started = time.perf_counter()
+        ok = super().parse_request()
+        # request line arrived; the transfer itself gets the longer timeout
+        self.connection.settimeout(SOCKET_TIMEOUT)
+        self.start_flow(ok)
+        return ok
+
+    def start_flow(self, ok):
+        if ok and shaper.enabled:
+            self.flow = _Flow(self.client_address[0], self.path)
+
+    def throttle(self, direction, n):
+        """Sleeps until the shaper lets n more bytes of this request through."""
+        if self.flow is not None:
+            wait = self.flow.delay(direction, n)
+            if wait:
+                time.sleep(wait)
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
+    def end_headers(self):
+        super().end_headers()
+        if self.command == "HEAD":
+            self.wfile.discard = True
+
+    def send_body(self, body, content_type="text/html; charset=utf-8", status=200, headers=(), encoding=None):
+        if encoding:
+            body = _compress(body, encoding)
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        for name, value in headers:
+            self.send_header(name, value)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, obj, status=200, headers=(), encoding=None):
+        self.send_body(json.dumps(obj).encode(), "application/json", status, headers, encoding)
+
+    def pick_encoding(self, ctype, name="", size=None):
+        return _pick_encoding(self.headers, ctype, name, size)
+
+    def cache_headers(self, route, etag=None, mtime=None, encoding=None, vary=False):
+        return _cache_headers(route, etag, mtime, encoding, vary)
+
+    def send_asset(self, asset, route="asset"):
+        body, headers = asset.response(self.headers, route)
+        if self.check_not_modified(headers, None):
+            return
+        self.send_body(body, asset.ctype, headers=headers)
+
+    def check_not_modified(self, headers, mtime):
+        """
+        Sends a 304 when If-None-Match / If-Modified-Since say the client is current.
+        Returns True when the 304 was sent and the caller must not send a body.
+        """
+        if not _is_fresh(self.headers, headers, mtime):
+            return False
+        self.send_response(304)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        return True
+
+    def start_chunked(self, content_type, status=200, headers=()):
+        """Sends the headers and returns a _ChunkedWriter; the body size needn't be known up front."""
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        for name, value in headers:
+            self.send_header(name, value)
+        chunked = self.request_version != "HTTP/1.0"
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Connection", "close")  # HTTP/1.0: end of body = end of connection
+        self.end_headers()
+        return _ChunkedWriter(self.wfile, chunked)
+
+    def send_chunked(self, chunks, content_type="text/html; charset=utf-8", status=200, headers=(), encoding=None):
+        """
+        Sends the body piece by piece as it is produced (Transfer-Encoding: chunked),
+        so time-to-first-byte doesn't depend on how big the page ends up being.
+        With an encoding every piece is compressed and flushed on its own, so it still renders progressively.
+        """
+        encoder = None
+        if encoding:
+            headers = list(headers) + [("Content-Encoding", encoding)]
+            encoder = _Encoder(encoding)
+        out = self.start_chunked(content_type, status, headers)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if encoder and chunk:
+                chunk = encoder.compress(chunk) + encoder.flush()
+            out.write(chunk)
+        if encoder:
+            out.write(encoder.finish())
+        out.close()
+
+    def send_file_range(self, f, offset, count):
+        """
+        Sends bytes [offset, offset+count) of f without reading the whole file into memory:
+        sendfile on plain sockets (page cache -> socket), else fixed size chunks.
+        """
+        if count <= 0 or self.command == "HEAD":
+            return
+        if _can_sendfile(self.connection):
+            # shaped: one sendfile per SHAPE_SLICE, each after its tokens
+            step = SHAPE_SLICE if self.flow is not None else count
+            sent = 0
+            while sent < count:
+                n = min(step, count - sent)
+                self.throttle("down", n)
+                done = self.connection.sendfile(f, offset + sent, n)
+                sent += done
+                if done < n:
+                    break
+            self.sendfile_bytes += sent
+        else:
+            sent = _copy_chunked(f, self.wfile, offset, count)
+        if sent < count:
+            # file shrank while sending; the declared Content-Length is now a lie
+            self.close_connection = True
+
+    def send_download(self, rel_path):
+        """/download/: full file, a single byte range (206) or several (multipart/byteranges)."""
+        try:
+            file_path = _safe_join(rel_path)
+        except PermissionError:
+            self.send_error(403, "Forbidden")
+            return
+
+        try:
+            f, st = _open_regular(file_path)
+        except RequestError as e:
+            self.send_error(e.status, str(e))
+            return
+        with f:
+            size = st.st_size
+            etag, last_modified = _file_validators(st)
+            ctype = _guess_type(file_path)
+            compressible = _compressible(ctype, file_path)
+            # byte ranges always refer to the identity (uncompressed) body
+            encoding = self.pick_encoding(ctype, file_path, size) if "Range" not in self.headers else None
+            validators = self.cache_headers("download", etag, st.st_mtime, encoding, vary=compressible)
+            if self.check_not_modified(validators, st.st_mtime):
+                return
+
+            if encoding:
+                self.send_compressed_file(f, file_path, ctype, size, etag, encoding, validators)
+                return
+
+            ranges = _select_ranges(self.headers, size, etag, last_modified)
+            if ranges == []:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            status = 200 if ranges is None else 206
+            self.send_response(status)
+            self.send_header("Content-Disposition", _content_disposition(os.path.basename(file_path)))
+            self.send_header("Accept-Ranges", "bytes")
+            for name, value in validators:
+                self.send_header(name, value)
 
-    def format_date(self, path):
-        timestamp = os.path.getmtime(path)
-        return datetime.datetime.fromtimestamp(timestamp).strftime("%d-%m-%Y %H:%M")
+            if ranges is None:
+                self.send_header("Content-type", ctype)
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+                self.send_file_range(f, 0, size)
+                return
 
-    # ------------- Listing (with folders) -------------
-    def list_files(self, rel_path=""):
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_header("Content-type", ctype)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                self.send_header("Content-Length", str(end - start + 1))
+                self.end_headers()
+                self.send_file_range(f, start, end - start + 1)
+                return
+
+            # multipart/byteranges: part headers are tiny, the bodies still stream from disk
+            multipart_type, heads, tail, length = _byteranges(ranges, ctype, size)
+            self.send_header("Content-type", multipart_type)
+            self.send_header("Content-Length", str(length))
+            self.end_headers()
+            for head, (start, end) in zip(heads, ranges):
+                self.wfile.write(head)
+                self.send_file_range(f, start, end - start + 1)
+            self.wfile.write(tail)
+
+    def send_zip(self, rel_path):
+        """/zip/<folder>: the whole folder as one streamed ZIP archive."""
         try:
             abs_path = _safe_join(rel_path)
         except PermissionError:
-            return b"<h3>Access denied</h3>"
+            self.send_error(403, "Forbidden")
+            return
+        if not os.path.isdir(abs_path):
+            self.send_error(404, "Folder not found")
+            return
+        name = os.path.basename(abs_path.rstrip(os.sep)) if rel_path.strip("/") else "files"
+        out = self.start_chunked("application/zip", headers=[
+            ("Content-Disposition", _content_disposition(f"{name}.zip")),
+            ("Cache-Control", "no-store"),
+        ])
+        if self.command == "HEAD":
+            return
+        out.buffer_size = ZIP_BUFFER_SIZE
+        _write_zip(out, abs_path)
+        out.close()
 
-        try:
-            entries = sorted(os.listdir(abs_path), key=lambda x: (not os.path.isdir(os.path.join(abs_path, x)), x.lower()))
-        except FileNotFoundError:
-            return b"<h3>Folder not found</h3>"
+    def send_compressed_file(self, f, file_path, ctype, size, etag, encoding, headers):
+        headers = headers + [("Content-Disposition", _content_disposition(os.path.basename(file_path)))]
+        if size > COMPRESS_CACHE_MAX_FILE:
+            # too big to keep around: compress on the fly, memory stays at one buffer
+            chunks = iter(lambda: f.read(COPY_CHUNK_SIZE), b"")
+            self.send_chunked(chunks, ctype, headers=headers, encoding=encoding)
+            return
+        body = _compressed_body(f, etag, encoding)
+        self.send_response(200)
+        self.send_header("Content-type", ctype)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-        file_items = ""
+    def read_json(self, limit=MAX_FIELD_SIZE):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if not 0 <= length <= limit:
+            self.close_connection = True
+            raise UploadError(400, "Invalid JSON body")
+        try:
+            data = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            raise UploadError(400, "Invalid JSON body")
+        if not isinstance(data, dict):
+            raise UploadError(400, "Invalid JSON body")
+        return data
 
-        # Back button if not root
-        if rel_path:
-            parent = urllib.parse.quote(os.path.dirname(rel_path))
-            file_items += f"""
-            <div class="file-card">
-                <a href='/files/{parent}'>⬅️ Back</a>
-            </div>
-            """
+    def handle_upload_session(self, method, parts):
+        """
+        /upload/session                      POST   {"filename", "size", "dir"?, "chunk_size"?} -> session
+        /upload/session/<id>                 GET    -> session incl. "received" chunk indices
+        /upload/session/<id>/<index>         PUT    raw chunk bytes
+        /upload/session/<id>/commit          POST   -> file moved into place
+        /upload/session/<id>                 DELETE -> session dropped
+        """
+        try:
+            if not parts:
+                if method != "POST":
+                    raise UploadError(405, "Method not allowed")
+                data = self.read_json()
+                session = upload_sessions.create(data.get("filename"), data.get("dir"), data.get("size"),
+                                                 data.get("chunk_size"))
+                self.send_json(session.to_json(), 201)
+                return
 
-        if not entries:
-            file_items += "<p>No files here.</p>"
-
-        for name in entries:
-            full_path = os.path.join(abs_path, name)
-            is_dir = os.path.isdir(full_path)
-            rel_child = os.path.join(rel_path, name).replace("\\", "/").lstrip("/")
-            safe_rel = urllib.parse.quote(rel_child)
-            icon = self.get_icon(name, full_path)
-
-            if is_dir:
-                size_str = ""
-                link = f"/files/{safe_rel}"
-                download_attr = ""
+            session = upload_sessions.get(parts[0])
+            action = parts[1] if len(parts) > 1 else None
+            if method == "GET" and action is None:
+                self.send_json(session.to_json())
+            elif method == "DELETE" and action is None:
+                upload_sessions.abort(session)
+                self.send_json({"message": "Upload cancelled"})
+            elif method == "POST" and action == "commit":
+                target = upload_sessions.commit(session)
+                rel = _rel_from_base(target)
+                self.send_json({"message": f"{rel} uploaded", "file": rel})
+            elif method == "PUT" and action is not None and action.isdigit():
+                try:
+                    length = int(self.headers.get("Content-Length"))
+                except (TypeError, ValueError):
+                    raise UploadError(411, "Length Required")
+                try:
+                    upload_sessions.write_chunk(session, int(action), length, self.rfile)
+                except UploadError:
+                    self.close_connection = True  # chunk body was not (fully) read
+                    raise
+                self.send_json({"received": len(session.received), "chunks": session.chunk_count})
             else:
-                size_str = f" ({self.format_size(os.path.getsize(full_path))})"
-                link = f"/download/{safe_rel}"
-                download_attr = " download"
-
-            date_str = self.format_date(full_path)
-            size_data = os.path.getsize(full_path) if not is_dir else 0
-            mtime_data = os.path.getmtime(full_path)
-
-            file_items += f"""
-            <div class="file-card" data-name="{name.lower()}" data-size="{size_data}" data-date="{mtime_data}">
-                <a href="{link}"{download_attr}>{icon} {name}{size_str} – <small>{date_str}</small></a>
-                <button class="delete-btn" onclick="deleteFile('{safe_rel}')">🗑 Delete</button>
-            </div>
-            """
+                raise UploadError(405, "Method not allowed")
+        except UploadError as e:
+            if method == "PUT":
+                self.close_connection = True  # e.g. unknown session: the chunk body is still unread
+            self.send_json({"message": str(e)}, e.status)
+        except OSError as e:
+            self.close_connection = True
+            self.send_json({"message": _upload_failed(e)[1]}, 500)
 
-        html = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <title>File Server</title>
-            <style>
-                :root {{
-                    --bg: #f4f6f9;
-                    --text: #222;
-                    --card: #fff;
-                }}
-                body {{
-                    font-family: Arial, sans-serif;
-                    background: var(--bg);
-                    color: var(--text);
-                    text-align: center;
-                    padding: 20px;
-                    transition: background 0.3s, color 0.3s;
-                }}
-                h2 {{ color: var(--text); }}
-                .file-card {{
-                    background: var(--card);
-                    margin: 10px auto;
-                    padding: 15px;
-                    border-radius: 12px;
-                    box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-                    width: 90%;
-                    max-width: 600px;
-                    display: flex;
-                    justify-content: space-between;
-                    align-items: center;
-                    transition: 0.2s;
-                }}
-                .file-card:hover {{
-                    transform: scale(1.02);
-                    box-shadow: 0 6px 12px rgba(0,0,0,0.15);
-                }}
-                a {{
-                    text-decoration: none;
-                    color: #007bff;
-                    font-weight: bold;
-                }}
-                a:hover {{ color: #0056b3; }}
-                .delete-btn {{
-                    background: #ff4d4d;
-                    border: none;
-                    padding: 8px 12px;
-                    border-radius: 8px;
-                    color: white;
-                    font-weight: bold;
-                    cursor: pointer;
-                }}
-                .delete-btn:hover {{ background: #cc0000; }}
-                .upload-link {{
-                    display: inline-block;
-                    margin-top: 20px;
-                    padding: 12px 20px;
-                    background: #28a745;
-                    color: white;
-                    border-radius: 10px;
-                    text-decoration: none;
-                    font-weight: bold;
-                }}
-                .upload-link:hover {{ background: #218838; }}
-                .theme-toggle {{
-                    margin: 20px;
-                    padding: 10px 18px;
-                    background: #333;
-                    color: white;
-                    border: none;
-                    border-radius: 10px;
-                    cursor: pointer;
-                }}
-                .search-bar, .sort-select {{
-                    margin: 10px;
-                    padding: 10px;
-                    border-radius: 8px;
-                    border: 1px solid #ccc;
-                    width: 200px;
-                }}
-            </style>
-        </head>
-        <body>
-            <h2>📂 Available Files {('/' + rel_path) if rel_path else ''}</h2>
-
-            <input type="text" class="search-bar" placeholder="🔍 Search files..." onkeyup="searchFiles()">
-            <select class="sort-select" onchange="sortFiles(this.value)">
-                <option value="name">Sort by Name</option>
-                <option value="size">Sort by Size</option>
-                <option value="date">Sort by Date</option>
-            </select>
-
-            <div id="file-list">
-                {file_items}
-            </div>
+    def handle_upload_blob(self, method, sha):
+        """
+        /upload/blob/<sha256>   GET  -> {"sha256", "size", "refs"} if the dedup store has it, else 404
+        /upload/blob/<sha256>   POST {"filename", "dir"?} -> that content placed there without re-sending it
+        """
+        try:
+            if dedup_store is None:
+                raise UploadError(404, "Dedup store is disabled (--dedup)")
+            if method == "POST":
+                data = self.read_json()
+            found = dedup_store.lookup(sha.lower())
+            if found is None:
+                raise UploadError(404, "Unknown content hash")
+            if method == "GET":
+                self.send_json({"sha256": sha.lower(), "size": found[0], "refs": found[1]},
+                               headers=[("Cache-Control", "no-store")])
+                return
+            filename, target_dir = _upload_target(data.get("filename"), data.get("dir"))
+            target = os.path.join(target_dir, filename)
+            dedup_store.link(sha.lower(), target)
+            _on_tree_change(target)
+            rel = _rel_from_base(target)
+            self.send_json({"message": f"{rel} uploaded", "file": rel, "size": found[0]}, 201)
+        except UploadError as e:
+            self.send_json({"message": str(e)}, e.status)
+        except OSError as e:
+            self.send_json({"message": _upload_failed(e)[1]}, 500)
 
-            <br>
-            <a class="upload-link" href="/upload">⬆️ Upload Files</a>
-            <br>
-            <button class="theme-toggle" onclick="toggleTheme()">🌙 Dark Mode</button>
-
-            <script>
-              const root = document.documentElement;
-              function setTheme(dark) {{
-                if (dark) {{
-                  root.style.setProperty('--bg', '#121212');
-                  root.style.setProperty('--text', '#f1f1f1');
-                  root.style.setProperty('--card', '#1e1e1e');
-                  document.querySelector('.theme-toggle').innerText = "☀️ Light Mode";
-                }} else {{
-                  root.style.setProperty('--bg', '#f4f6f9');
-                  root.style.setProperty('--text', '#222');
-                  root.style.setProperty('--card', '#fff');
-                  document.querySelector('.theme-toggle').innerText = "🌙 Dark Mode";
-                }}
-                localStorage.setItem("darkmode", dark);
-              }}
-              function toggleTheme() {{
-                const isDark = localStorage.getItem("darkmode") === "true";
-                setTheme(!isDark);
-              }}
-              window.onload = () => {{
-                const isDark = localStorage.getItem("darkmode") === "true";
-                setTheme(isDark);
-              }};
-
-              async function deleteFile(filename) {{
-                if (!confirm("Are you sure you want to delete " + filename + "?")) return;
-                let res = await fetch("/delete", {{
-                  method: "POST",
-                  headers: {{ "Content-Type": "application/json" }},
-                  body: JSON.stringify({{ "filename": filename }})
-                }});
-                let data = await res.json();
-                alert(data.message);
-                location.reload();
-              }}
-
-              function searchFiles() {{
-                let input = document.querySelector(".search-bar").value.toLowerCase();
-                document.querySelectorAll(".file-card").forEach(card => {{
-                  card.style.display = card.dataset.name.includes(input) ? "flex" : "none";
-                }});
-              }}
-
-              function sortFiles(type) {{
-                let list = document.getElementById("file-list");
-                let cards = Array.from(list.children);
-                cards.sort((a,b) => {{
-                  if (type=="name") return a.dataset.name.localeCompare(b.dataset.name);
-                  if (type=="size") return b.dataset.size - a.dataset.size;
-                  if (type=="date") return b.dataset.date - a.dataset.date;
-                }});
-                list.innerHTML="";
-                cards.forEach(c=>list.appendChild(c));
-              }}
-            </script>
-        </body>
-        </html>
+    def handle_upload_delta(self, method, rel_path, params):
         """
-        return html.encode("utf-8")
+        /upload/delta/<path>?block_size=N  GET  -> {"path", "version", "size", "block_size",
+                                                    "weak": [Adler-32 per block], "strong": [BLAKE2b-128 hex per block]}
+        /upload/delta/<path>               POST <recipe JSON>\n<literal bytes> -> new version swapped in
+            recipe: {"version", "block_size", "size", "sha256"?, "ops": [[first_block, count] | literal_length, ...]}
+        The client keeps the blocks whose weak + strong sums it finds anywhere in its copy
+        (rolling Adler-32, like rsync) and sends only the bytes in between.
+        """
+        try:
+            file_path = _safe_join(rel_path)
+        except PermissionError:
+            self.send_json({"message": "Access denied"}, 403)
+            return
+        try:
+            if method == "GET":
+                block_size = _delta_block_size(params.get("block_size", DELTA_BLOCK_SIZE))
+                sig_path, etag = _delta_signature(file_path, block_size)
+                encoding = self.pick_encoding("application/json")
+                headers = [("Cache-Control", "no-cache"), ("ETag", _variant_etag(etag, encoding))]
+                if self.check_not_modified(headers, None):
+                    return
+                with open(sig_path, "rb") as f:
+                    body = _compressed_body(f, etag, encoding) if encoding else f.read()
+                if encoding:
+                    headers.append(("Content-Encoding", encoding))
+                self.send_body(body, "application/json", headers=headers)
+                return
+            try:
+                length = int(self.headers.get("Content-Length"))
+            except (TypeError, ValueError):
+                raise UploadError(411, "Length Required")
+            line = self.rfile.readline(min(length, DELTA_MAX_RECIPE + 1))
+            if not line.endswith(b"\n"):
+                raise UploadError(400, "Recipe line missing or too long")
+            try:
+                recipe = json.loads(line)
+            except ValueError:
+                raise UploadError(400, "Invalid recipe JSON")
+            if not isinstance(recipe, dict):
+                raise UploadError(400, "Invalid recipe JSON")
+            size = _apply_delta(file_path, recipe, self.rfile, length - len(line))
+            _on_tree_change(file_path)
+            rel = _rel_from_base(file_path)
+            self.send_json({"message": f"{rel} updated", "file": rel, "size": size})
+        except RequestError as e:
+            if method == "POST":
+                self.close_connection = True  # the rest of the body may still be unread
+            self.send_json({"message": str(e)}, e.status)
+        except OSError as e:
+            self.close_connection = True
+            self.send_json({"message": _upload_failed(e)[1]}, 500)
+
+    def handle_upload(self):
+        try:
+            remaining = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            self.send_error(411, "Length Required")
+            return
+        try:
+            upload = MultipartUpload(self.headers.get('Content-Type', ''), remaining)
+        except MultipartError as e:
+            self.send_error(400, str(e))
+            return
+
+        try:
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, UPLOAD_BUFFER_SIZE))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                upload.feed(chunk)
+            saved = upload.finish()
+        except (MultipartError, OSError) as e:
+            done = upload.fail()
+            self.close_connection = True  # unread request body may still be on the socket
+            status, message = _upload_failed(e)
+            self.send_json({"message": message, "files": done}, status)
+            return
+
+        self.send_json({"message": f"{len(saved)} file(s) uploaded", "files": saved})
+
+    # ------------- Listing (with folders) -------------
+    def send_listing_page(self, rel_path):
+        listing, error = _get_listing(rel_path.strip("/"))
+        if error:
+            self.send_body(f"<h3>{error[1]}</h3>".encode(), status=error[0])
+            return
+        etag, mtime = listing.validators()
+        encoding = self.pick_encoding("text/html")
+        headers = self.cache_headers("files", etag, mtime, encoding, vary=True)
+        if self.check_not_modified(headers, mtime):
+            return
+        self.send_chunked(self.list_files(rel_path, listing), headers=headers, encoding=encoding)
+
+    def send_listing_json(self, rel_path, params):
+        """/api/list/<path>?sort=name|size|date&order=asc|desc&q=<substring>&limit=N&cursor=<token>"""
+        rel_path = rel_path.strip("/")
+        listing, error = _get_listing(rel_path)
+        if error:
+            self.send_json({"message": error[1]}, error[0])
+            return
+        try:
+            page, next_cursor, total = _list_page(listing, **_page_args(params, LISTING_PAGE_SIZE))
+        except ValueError as e:
+            self.send_json({"message": str(e)}, 400)
+            return
+        etag, mtime = listing.validators()
+        encoding = self.pick_encoding("application/json")
+        headers = self.cache_headers("api", etag, mtime, encoding, vary=True)
+        if self.check_not_modified(headers, mtime):
+            return
+        base = rel_path + "/" if rel_path else ""
+        self.send_json({
+            "path": rel_path,
+            "total": total,
+            "next_cursor": next_cursor,
+            "entries": [
+                {"name": e.name, "path": base + e.name, "type": "dir" if e.is_dir else "file",
+                 "size": e.size, "mtime": e.mtime, **({"files": e.files} if e.is_dir else {})}
+                for e in page
+            ],
+        }, headers=headers, encoding=encoding)
+
+    def send_search(self, params):
+        """/search?q=<text>&limit=N: whole-tree file / folder name search."""
+        try:
+            limit = max(1, min(int(params.get("limit", SEARCH_DEFAULT_LIMIT)), SEARCH_MAX_LIMIT))
+        except ValueError:
+            self.send_json({"message": "Invalid limit"}, 400)
+            return
+        q = params.get("q", "")
+        total, results = search_index.search(q, limit)
+        self.send_json({
+            "query": q,
+            "ready": search_index.ready,  # False while the startup scan is still running
+            "total": total,
+            "results": [{"path": rel, "name": os.path.basename(rel), "type": "dir" if is_dir else "file"}
+                        for rel, is_dir in results],
+        }, headers=[("Cache-Control", "no-store")], encoding=self.pick_encoding("application/json"))
+
+    def send_listing_fragment(self, rel_path, params):
+        """Just the cards of one page (used by the listing page's search / sort / "More files")."""
+        rel_path = rel_path.strip("/")
+        listing, error = _get_listing(rel_path)
+        if error:
+            self.send_error(*error)
+            return
+        try:
+            page, next_cursor, _ = _list_page(listing, **_page_args(params, LISTING_PAGE_SIZE))
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        etag, mtime = listing.validators()
+        encoding = self.pick_encoding("text/html")
+        headers = self.cache_headers("files", etag, mtime, encoding, vary=True)
+        headers.append(("X-Next-Cursor", next_cursor or ""))
+        if self.check_not_modified(headers, mtime):
+            return
+        self.send_chunked(self.iter_cards(page, rel_path), headers=headers, encoding=encoding)
 
     # ------------- Routes -------------
+    def do_HEAD(self):
+        """GET's status and headers without the body (not SimpleHTTPRequestHandler's, which serves the CWD)."""
+        self.do_GET()
+
     def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+
         # Root or folder browsing
-        if self.path == "/" or self.path == "/files":
-            rel_path = ""
-            self.send_response(200)
-            self.send_header("Content-type", "text/html; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(self.list_files(rel_path))
+        if path in ("/", "/files") or path.startswith("/files/"):
+            rel_path = urllib.parse.unquote(path[len("/files/"):]) if path.startswith("/files/") else ""
+            if params.get("fragment"):
+                self.send_listing_fragment(rel_path, params)
+            else:
+                self.send_listing_page(rel_path)
             return
 
-        if self.path.startswith("/files/"):
-            rel_path = urllib.parse.unquote(self.path[len("/files/"):])
-            self.send_response(200)
-            self.send_header("Content-type", "text/html; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(self.list_files(rel_path))
+        if path == "/api/list" or path.startswith("/api/list/"):
+            self.send_listing_json(urllib.parse.unquote(path[len("/api/list/"):]), params)
             return
 
-        if self.path.startswith("/download/"):
-            rel_path = urllib.parse.unquote(self.path[len("/download/"):])
-            try:
-                file_path = _safe_join(rel_path)
-            except PermissionError:
-                self.send_error(403, "Forbidden")
-                return
+        if path.startswith("/download/"):
+            rel_path = urllib.parse.unquote(path[len("/download/"):])
+            self.send_download(rel_path)
+            return
 
-            if os.path.exists(file_path) and os.path.isfile(file_path):
-                self.send_response(200)
-                self.send_header("Content-Disposition", f"attachment; filename={os.path.basename(file_path)}")
-                self.send_header("Content-Length", str(os.path.getsize(file_path)))
-                self.end_headers()
-                with open(file_path, "rb") as f:
-                    self.wfile.write(f.read())
-            else:
-                self.send_error(404, "File Not Found")
+        if path == "/zip" or path.startswith("/zip/"):
+            self.send_zip(urllib.parse.unquote(path[len("/zip/"):]))
             return
 
-        if self.path == "/upload":
+        if path == "/search":
+            self.send_search(params)
+            return
+
+        if path.startswith("/upload/session/"):
+            self.handle_upload_session("GET", path.split("/")[3:])
+            return
+
+        if path.startswith("/upload/blob/"):
+            self.handle_upload_blob("GET", path[len("/upload/blob/"):])
+            return
+
+        if path.startswith("/upload/delta/"):
+            self.handle_upload_delta("GET", urllib.parse.unquote(path[len("/upload/delta/"):]), params)
+            return
+
+        if path == "/metrics":
+            body = metrics.render().encode()
+            self.send_body(body, "text/plain; version=0.0.4; charset=utf-8", headers=[("Cache-Control", "no-store")],
+                           encoding=self.pick_encoding("text/plain", size=len(body)))
+            return
+
+        if path == "/upload":
             # original upload page (drag & drop + progress)
-            html = """
-            <html>
-            <head>
-            <meta charset="UTF-8">
-            <title>Upload Files</title>
-            <style>
-                :root { --bg:#f4f6f9; --text:#222; }
-                body {
-                    font-family: Arial, sans-serif;
-                    background: var(--bg);
-                    color: var(--text);
-                    text-align: center;
-                    padding: 40px;
-                    transition: background 0.3s, color 0.3s;
-                }
-                h2 { color: var(--text); }
-                input[type=file], button {
-                    margin: 10px;
-                    padding: 12px;
-                    border-radius: 10px;
-                    border: 1px solid #ccc;
-                }
-                button {
-                    background: #28a745;
-                    color: white;
-                    font-weight: bold;
-                    border: none;
-                    cursor: pointer;
-                }
-                button:hover { background: #218838; }
-                .drop-zone {
-                    margin: 20px auto;
-                    padding: 40px;
-                    border: 2px dashed #aaa;
-                    border-radius: 15px;
-                    background: #fafafa;
-                    color: #666;
-                    cursor: pointer;
-                    max-width: 700px;
-                }
-                .drop-zone.dragover {
-                    background: #dff0d8;
-                    border-color: #28a745;
-                }
-                .progress-container {
-                    width: 80%;
-                    margin: 10px auto;
-                    text-align: left;
-                    max-width: 700px;
-                }
-                .progress {
-                    width: 100%;
-                    background: #ddd;
-                    border-radius: 10px;
-                    height: 25px;
-                    overflow: hidden;
-                    margin-bottom: 5px;
-                }
-                .progress-bar {
-                    height: 100%;
-                    width: 0;
-                    background: #28a745;
-                    text-align: center;
-                    color: white;
-                    line-height: 25px;
-                }
-                .theme-toggle {
-                    margin: 20px;
-                    padding: 10px 18px;
-                    background: #333;
-                    color: white;
-                    border: none;
-                    border-radius: 10px;
-                    cursor: pointer;
-                }
-            </style>
-            </head>
-            <body>
-                <h2>⬆️ Upload Files</h2>
-                <input type="file" id="fileInput" multiple><br>
-                <div class="drop-zone" id="dropZone">Drag & Drop Files Here</div>
-                <button onclick="uploadFiles()">Upload</button>
-                <div id="progressArea"></div>
-                <br>
-                <a href="/"><button>⬅ Back</button></a>
-                <br>
-                <button class="theme-toggle" onclick="toggleTheme()">🌙 Dark Mode</button>
-                <script>
-                  const root = document.documentElement;
-                  function setTheme(dark) {
-                    if (dark) {
-                      root.style.setProperty('--bg', '#121212');
-                      root.style.setProperty('--text', '#f1f1f1');
-                      document.querySelector('.theme-toggle').innerText = "☀️ Light Mode";
-                    } else {
-                      root.style.setProperty('--bg', '#f4f6f9');
-                      root.style.setProperty('--text', '#222');
-                      document.querySelector('.theme-toggle').innerText = "🌙 Dark Mode";
-                    }
-                    localStorage.setItem("darkmode", dark);
-                  }
-                  function toggleTheme() {
-                    const isDark = localStorage.getItem("darkmode") === "true";
-                    setTheme(!isDark);
-                  }
-                  window.onload = () => {
-                    const isDark = localStorage.getItem("darkmode") === "true";
-                    setTheme(isDark);
-                  };
-
-                  function uploadFiles(files=null) {
-                    files = files || document.getElementById("fileInput").files;
-                    if (!files.length) { alert("Select files first!"); return; }
-                    let progressArea = document.getElementById("progressArea");
-                    progressArea.innerHTML = "";
-                    [...files].forEach(file => {
-                        let container = document.createElement("div");
-                        container.className="progress-container";
-                        container.innerHTML = `<b>${file.name}</b>
-                          <div class="progress"><div class="progress-bar" id="bar-${file.name.replace(/[^a-z0-9]/gi,'')}">0%</div></div>`;
-                        progressArea.appendChild(container);
-
-                        const xhr = new XMLHttpRequest();
-                        xhr.upload.addEventListener("progress", e => {
-                          if (e.lengthComputable) {
-                            let percent = (e.loaded / e.total) * 100;
-                            let bar = document.getElementById("bar-"+file.name.replace(/[^a-z0-9]/gi,''));
-                            bar.style.width = percent + "%";
-                            bar.innerText = Math.round(percent) + "%";
-                          }
-                        });
-                        xhr.onload = () => { if (xhr.status==200) console.log(file.name+" uploaded"); };
-                        xhr.open("POST","/upload");
-                        const formData = new FormData();
-                        formData.append("file",file);
-                        xhr.send(formData);
-                    });
-                  }
-
-                  let dropZone = document.getElementById("dropZone");
-                  dropZone.addEventListener("dragover", e => {
-                    e.preventDefault(); dropZone.classList.add("dragover");
-                  });
-                  dropZone.addEventListener("dragleave", e => {
-                    dropZone.classList.remove("dragover");
-                  });
-                  dropZone.addEventListener("drop", e => {
-                    e.preventDefault(); dropZone.classList.remove("dragover");
-                    uploadFiles(e.dataTransfer.files);
-                  });
-                </script>
-            </body>
-            </html>
-            """
-            self.send_response(200)
-            self.send_header("Content-type", "text/html; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(html.encode("utf-8"))
+            self.send_asset(UPLOAD_PAGE, "upload")
+            return
+
+        if path.startswith("/static/"):
+            asset = ASSETS.get(path)
+            if asset is None:
+                self.send_error(404, "Page Not Found")
+                return
+            self.send_asset(asset)
             return
 
         self.send_error(404, "Page Not Found")
 
     def do_POST(self):
-        # Upload (same behavior: save in BASE_DIR root)
+        # Upload: any number of files (+ optional "dir" field) in one multipart POST
         if self.path == "/upload":
-            ctype = self.headers.get('Content-Type', '')
-            if not ctype.startswith('multipart/form-data'):
-                self.send_error(400, "Bad Request")
-                return
-            boundary = ctype.split("boundary=")[-1].encode()
-            remainbytes = int(self.headers.get('Content-Length', 0))
+            self.handle_upload()
+            return
 
-            line = self.rfile.readline(); remainbytes -= len(line)
-            if boundary not in line:
-                self.send_error(400, "Content does not start with boundary")
-                return
+        # Resumable chunked uploads
+        if self.path == "/upload/session" or self.path.startswith("/upload/session/"):
+            self.handle_upload_session("POST", self.path.split("/")[3:])
+            return
 
-            # Content-Disposition line
-            line = self.rfile.readline(); remainbytes -= len(line)
-            # filename parse (simple)
-            try:
-                disp = line.decode(errors="ignore")
-                filename = disp.split("filename=")[1].strip().strip('"')
-            except Exception:
-                self.send_error(400, "Filename not found")
-                return
+        # Already-stored content (--dedup): place it by hash, no bytes sent
+        if self.path.startswith("/upload/blob/"):
+            self.handle_upload_blob("POST", self.path[len("/upload/blob/"):])
+            return
 
-            # Paths sanitize
-            filename = os.path.basename(filename)
-            filepath = os.path.join(BASE_DIR, filename)
-
-             # Skip two lines: Content-Type and blank
-            line = self.rfile.readline(); remainbytes -= len(line)
-            line = self.rfile.readline(); remainbytes -= len(line)
-
-            with open(filepath, "wb") as f:
-                preline = self.rfile.readline(); remainbytes -= len(preline)
-                while remainbytes > 0:
-                    line = self.rfile.readline(); remainbytes -= len(line)
-                    if boundary in line:
-                        preline = preline.rstrip(b"\r\n")
-                        f.write(preline)
-                        break
-                    else:
-                        f.write(preline)
-                        preline = line
-
-            self.send_response(200)
-            self.end_headers()
+        # Delta sync: only the changed blocks of an existing file
+        if self.path.startswith("/upload/delta/"):
+            self.handle_upload_delta("POST", urllib.parse.unquote(self.path[len("/upload/delta/"):]), {})
             return
 
         # Delete (file or empty folder)
         if self.path == "/delete":
-            length = int(self.headers.get('Content-Length', 0))
-            data = json.loads(self.rfile.read(length) or b"{}")
-            rel = urllib.parse.unquote(data.get("filename", "")).lstrip("/")
             try:
-                target = _safe_join(rel)
-            except PermissionError:
-                msg = "Access denied"
-                self.send_response(403)
-                self.send_header("Content-type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps({"message": msg}).encode())
+                data = self.read_json()
+            except UploadError as e:
+                self.send_json({"message": str(e)}, e.status)
                 return
+            status, message = _delete_path(data.get("filename", ""))
+            self.send_json({"message": message}, status)
+            return
+
+        self.send_error(404, "Page Not Found")
+
+    def do_PUT(self):
+        if self.path.startswith("/upload/session/"):
+            self.handle_upload_session("PUT", self.path.split("/")[3:])
+            return
+        self.send_error(404, "Page Not Found")
+
+    def do_DELETE(self):
+        if self.path.startswith("/upload/session/"):
+            self.handle_upload_session("DELETE", self.path.split("/")[3:])
+            return
+        self.send_error(404, "Page Not Found")
+
+# ------------- asyncio engine -------------
+class _AsyncBridgeReader:
+    """
+    rfile for a request bridged to MyHTTPRequestHandler: the already-read head first,
+    then the connection's StreamReader, driven from the worker thread.
+    """
+    def __init__(self, head, reader, loop):
+        self._head = io.BytesIO(head)
+        self._reader = reader
+        self._loop = loop
+
+    def _run(self, coro):
+        coro = asyncio.wait_for(coro, SOCKET_TIMEOUT)
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def readline(self, limit=-1):
+        line = self._head.readline(limit)
+        if line.endswith(b"\n") or (limit >= 0 and len(line) >= limit):
+            return line
+        return line + self._run(self._reader.readline())
+
+    def read(self, n=-1):
+        data = self._head.read(n)
+        if n is None or n < 0:
+            return data + self._run(self._reader.read(-1))
+        if len(data) < n:
+            data += self._run(self._read_exactly(n - len(data)))
+        return data
+
+    async def _read_exactly(self, n):
+        try:
+            return await self._reader.readexactly(n)
+        except asyncio.IncompleteReadError as e:
+            return e.partial  # EOF: short read, like a socket file
+
+class _AsyncBridgeWriter:
+    """wfile for a bridged request: every write is handed to the event loop and drained."""
+    def __init__(self, writer, loop):
+        self._writer = writer
+        self._loop = loop
+
+    async def _write(self, data):
+        self._writer.write(data)
+        await asyncio.wait_for(self._writer.drain(), SOCKET_TIMEOUT)
+
+    def write(self, data):
+        asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self._loop).result()
+        return len(data)
+
+    def flush(self):
+        pass
+
+class _BridgedRequestHandler(MyHTTPRequestHandler):
+    """
+    MyHTTPRequestHandler for exactly one request, run in the async engine's executor.
+    Routes the asyncio engine doesn't serve natively keep working unchanged through this.
+    """
+    def __init__(self, head, reader, writer, loop, client_address, server, started):
+        self.rfile = _AsyncBridgeReader(head, reader, loop)
+        self.wfile = _CountingWriter(_AsyncBridgeWriter(writer, loop), self.throttle if shaper.enabled else None)
+        if shaper.enabled:
+            self.rfile = _ShapedReader(self.rfile, self.throttle)
+        self.started = started
+        self.client_address = client_address
+        self.server = server
+        self.connection = self.request = None
+        self.directory = os.getcwd()
+        self.close_connection = True
+
+    def handle_one_request(self):
+        # timeouts are enforced on the event loop side (SOCKET_TIMEOUT per read / drain)
+        self.metered(lambda: http.server.SimpleHTTPRequestHandler.handle_one_request(self), self.started)
+
+    def parse_request(self):
+        ok = http.server.SimpleHTTPRequestHandler.parse_request(self)
+        self.start_flow(ok)
+        return ok
+
+class AsyncRequest(PageRenderer):
+    """
+    One request on the asyncio engine. Listing pages, downloads, static assets, multipart uploads
+    and /delete are served on the event loop (filesystem calls go to the executor); everything
+    else is bridged to MyHTTPRequestHandler.
+    """
+    server_version = MyHTTPRequestHandler.server_version
+    sys_version = MyHTTPRequestHandler.sys_version
+
+    def __init__(self, server, reader, writer, head, method, target, version, headers):
+        self.server = server
+        self.loop = server.loop
+        self.reader = reader
+        self.writer = writer
+        self.head = head
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.started = time.perf_counter()
+        self.status = None
+        self.bytes_out = 0
+        self.bridged = False
+        self.discard = False  # set once the head of a HEAD response is out
+        self.flow = _Flow((writer.get_extra_info("peername") or ("-",))[0], target) if shaper.enabled else None
+        self.close_connection = version == "HTTP/1.0"
+        conntype = headers.get("Connection", "").lower()
+        if conntype == "close":
+            self.close_connection = True
+        elif conntype == "keep-alive" and version == "HTTP/1.1":
+            self.close_connection = False
+
+    def run(self, fn, *args):
+        return self.loop.run_in_executor(self.server.executor, fn, *args)
+
+    # ------------- Response helpers -------------
+    def write(self, data):
+        if self.discard:
+            return
+        self.bytes_out += len(data)
+        self.writer.write(data)
+
+    async def drain(self):
+        await asyncio.wait_for(self.writer.drain(), SOCKET_TIMEOUT)
+
+    async def throttle(self, direction, n):
+        """Waits (without blocking the loop) until the shaper lets n more bytes through."""
+        if self.flow is not None:
+            wait = self.flow.delay(direction, n)
+            if wait:
+                await asyncio.sleep(wait)
+
+    async def write_shaped(self, data):
+        """write() + drain, SHAPE_SLICE at a time when rate limits are on."""
+        if self.flow is None:
+            self.write(data)
+            return
+        view = memoryview(data)
+        for i in range(0, len(view), SHAPE_SLICE):
+            piece = view[i:i + SHAPE_SLICE]
+            await self.throttle("down", len(piece))
+            self.write(piece)
+            await self.drain()
+
+    def write_head(self, status, headers):
+        self.status = status
+        lines = [f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}",
+                 f"Server: {self.server_version} {self.sys_version}",
+                 f"Date: {email.utils.formatdate(usegmt=True)}"]
+        lines += [f"{name}: {value}" for name, value in headers]
+        if self.close_connection:
+            lines.append("Connection: close")
+        self.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1", "strict"))
+        self.discard = self.method == "HEAD"  # the rest would be the body
+
+    async def send_body(self, body, content_type="text/html; charset=utf-8", status=200, headers=(), encoding=None):
+        if encoding:
+            body = await self.run(_compress, body, encoding)
+            headers = list(headers) + [("Content-Encoding", encoding)]
+        self.write_head(status, [("Content-type", content_type), *headers, ("Content-Length", str(len(body)))])
+        if self.method != "HEAD":
+            await self.write_shaped(body)
+        await self.drain()
+
+    async def send_json(self, obj, status=200, headers=(), encoding=None):
+        await self.send_body(json.dumps(obj).encode(), "application/json", status, headers, encoding)
+
+    async def send_error(self, status, message=None):
+        self.close_connection = True
+        phrase = http.HTTPStatus(status).phrase
+        body = (http.server.DEFAULT_ERROR_MESSAGE % {
+            "code": status, "message": escape(message or phrase, quote=False),
+            "explain": escape(http.HTTPStatus(status).description, quote=False),
+        }).encode("utf-8", "replace")
+        await self.send_body(body, http.server.DEFAULT_ERROR_CONTENT_TYPE, status)
+
+    async def send_asset(self, asset, route="asset"):
+        body, headers = asset.response(self.headers, route)
+        if await self.check_not_modified(headers, None):
+            return
+        await self.send_body(body, asset.ctype, headers=headers)
+
+    async def check_not_modified(self, headers, mtime):
+        if not _is_fresh(self.headers, headers, mtime):
+            return False
+        self.write_head(304, headers)
+        await self.drain()
+        return True
+
+    async def read_body(self, n):
+        """Up to n request body bytes (b"" at EOF); answers Expect: 100-continue first."""
+        if self.headers.get("Expect", "").lower() == "100-continue" and self.version == "HTTP/1.1":
+            del self.headers["Expect"]
+            self.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        await self.throttle("up", n)
+        return await asyncio.wait_for(self.reader.read(n), SOCKET_TIMEOUT)
+
+    async def send_chunked(self, chunks, content_type="text/html; charset=utf-8", status=200, headers=(), encoding=None):
+        """Body pieces are produced (and compressed) in the executor, one at a time, then drained."""
+        encoder = _Encoder(encoding) if encoding else None
+        if encoding:
+            headers = list(headers) + [("Content-Encoding", encoding)]
+        chunked = self.version != "HTTP/1.0"
+        if chunked:
+            headers = list(headers) + [("Transfer-Encoding", "chunked")]
+        else:
+            self.close_connection = True  # HTTP/1.0: end of body = end of connection
+        self.write_head(status, [("Content-type", content_type), *headers])
+        if self.discard:
+            return
+        out = _ChunkedWriter(self, chunked)
+
+        def next_piece():
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                if encoder and chunk:
+                    chunk = encoder.compress(chunk) + encoder.flush()
+                if chunk:
+                    return chunk
+            return None
+
+        while True:
+            piece = await self.run(next_piece)
+            if not piece:
+                break
+            await self.throttle("down", len(piece))
+            out.write(piece)
+            await self.drain()
+        if encoder:
+            out.write(encoder.finish())
+        out.close()
+        await self.drain()
 
-            if os.path.exists(target):
+    async def send_file_range(self, f, offset, count):
+        if count <= 0 or self.discard:
+            return
+        # loop.sendfile uses os.sendfile on plain sockets and falls back to read/write otherwise
+        step = SHAPE_SLICE if self.flow is not None else count
+        sent = 0
+        while sent < count:
+            n = min(step, count - sent)
+            await self.throttle("down", n)
+            done = await self.loop.sendfile(self.writer.transport, f, offset + sent, n)
+            sent += done
+            if done < n:
+                break
+        self.bytes_out += sent
+        if sent < count:
+            self.close_connection = True
+
+    # ------------- Routes -------------
+    async def handle(self):
+        try:
+            await self.route()
+        finally:
+            if not self.bridged:  # bridged requests are recorded by the handler itself
                 try:
-                    if os.path.isdir(target):
-                        # Only remove empty folder to stay safe
-                        os.rmdir(target)
-                        message = f"{rel} folder deleted"
-                    else:
-                        os.remove(target)
-                        message = f"{rel} deleted successfully"
-                except OSError:
-                    message = f"Cannot delete '{rel}': folder not empty or in use"
+                    bytes_in = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    bytes_in = 0
+                seconds = time.perf_counter() - self.started
+                metrics.observe_request(self.method, self.target, self.status, seconds, bytes_in, self.bytes_out)
+                access_log.record((self.writer.get_extra_info("peername") or ("-",))[0], self.method,
+                                  self.target, self.status, seconds, bytes_in, self.bytes_out)
+
+    async def route(self):
+        url = urllib.parse.urlsplit(self.target)
+        path = url.path
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+
+        if self.method in ("GET", "HEAD"):
+            if path in ("/", "/files") or path.startswith("/files/"):
+                rel_path = urllib.parse.unquote(path[len("/files/"):]) if path.startswith("/files/") else ""
+                await self.send_listing(rel_path, params)
+                return
+            if path.startswith("/download/"):
+                await self.send_download(urllib.parse.unquote(path[len("/download/"):]))
+                return
+            if path in ASSETS:
+                await self.send_asset(ASSETS[path])
+                return
+            if path == "/upload":
+                await self.send_asset(UPLOAD_PAGE, "upload")
+                return
+        elif self.method == "POST":
+            if path == "/upload":
+                await self.handle_upload()
+                return
+            if path == "/delete":
+                await self.handle_delete()
+                return
+        await self.bridge()
+
+    async def bridge(self):
+        self.bridged = True
+        handler = _BridgedRequestHandler(self.head, self.reader, self.writer, self.loop,
+                                         self.writer.get_extra_info("peername"), self.server, self.started)
+        await self.run(handler.handle_one_request)
+        self.close_connection = handler.close_connection
+
+    async def send_listing(self, rel_path, params):
+        fragment = params.get("fragment")
+        rel_path = rel_path.strip("/") if fragment else rel_path
+        listing, error = await self.run(_get_listing, rel_path.strip("/"))
+        if error:
+            if fragment:
+                await self.send_error(*error)
             else:
-                message = f"{rel} not found"
+                await self.send_body(f"<h3>{error[1]}</h3>".encode(), status=error[0])
+            return
+        # hashing the entries and sorting / filtering a page cost O(entries): not on the loop
+        etag, mtime = await self.run(listing.validators)
+        encoding = _pick_encoding(self.headers, "text/html")
+        headers = _cache_headers("files", etag, mtime, encoding, vary=True)
+        if fragment:
+            try:
+                args = _page_args(params, LISTING_PAGE_SIZE)
+                page, next_cursor, _ = await self.run(lambda: _list_page(listing, **args))
+            except ValueError as e:
+                await self.send_error(400, str(e))
+                return
+            headers.append(("X-Next-Cursor", next_cursor or ""))
+            body = self.iter_cards(page, rel_path)
+        else:
+            body = self.list_files(rel_path, listing)
+        if await self.check_not_modified(headers, mtime):
+            return
+        await self.send_chunked(body, headers=headers, encoding=encoding)
 
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps({"message": message}).encode())
+    async def send_download(self, rel_path):
+        try:
+            file_path = _safe_join(rel_path)
+            f, st = await self.run(_open_regular, file_path)
+        except PermissionError:
+            await self.send_error(403, "Forbidden")
+            return
+        except RequestError as e:
+            await self.send_error(e.status, str(e))
             return
+        with f:
+            size = st.st_size
+            etag, last_modified = _file_validators(st)
+            ctype = _guess_type(file_path)
+            encoding = _pick_encoding(self.headers, ctype, file_path, size) if "Range" not in self.headers else None
+            validators = _cache_headers("download", etag, st.st_mtime, encoding,
+                                        vary=_compressible(ctype, file_path))
+            if await self.check_not_modified(validators, st.st_mtime):
+                return
+            headers = validators + [("Content-Disposition", _content_disposition(os.path.basename(file_path)))]
+
+            if encoding:
+                if size > COMPRESS_CACHE_MAX_FILE:
+                    chunks = iter(lambda: f.read(COPY_CHUNK_SIZE), b"")
+                    await self.send_chunked(chunks, ctype, headers=headers, encoding=encoding)
+                else:
+                    body = await self.run(_compressed_body, f, etag, encoding)
+                    await self.send_body(body, ctype, headers=headers + [("Content-Encoding", encoding)])
+                return
+
+            ranges = _select_ranges(self.headers, size, etag, last_modified)
+            if ranges == []:
+                self.write_head(416, [("Content-Range", f"bytes */{size}"), ("Content-Length", "0")])
+                await self.drain()
+                return
+
+            headers.insert(0, ("Accept-Ranges", "bytes"))
+            if ranges is None:
+                self.write_head(200, headers + [("Content-type", ctype), ("Content-Length", str(size))])
+                await self.send_file_range(f, 0, size)
+                return
+
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                self.write_head(206, headers + [("Content-type", ctype),
+                                                ("Content-Range", f"bytes {start}-{end}/{size}"),
+                                                ("Content-Length", str(end - start + 1))])
+                await self.send_file_range(f, start, end - start + 1)
+                return
+
+            multipart_type, heads, tail, length = _byteranges(ranges, ctype, size)
+            self.write_head(206, headers + [("Content-type", multipart_type), ("Content-Length", str(length))])
+            for head, (start, end) in zip(heads, ranges):
+                self.write(head)
+                await self.send_file_range(f, start, end - start + 1)
+            self.write(tail)
+            await self.drain()
+
+    async def handle_upload(self):
+        try:
+            remaining = int(self.headers.get("Content-Length"))
+        except (TypeError, ValueError):
+            await self.send_error(411, "Length Required")
+            return
+        try:
+            upload = MultipartUpload(self.headers.get("Content-Type", ""), remaining)
+        except MultipartError as e:
+            await self.send_error(400, str(e))
+            return
+
+        try:
+            while remaining > 0:
+                chunk = await self.read_body(min(remaining, UPLOAD_BUFFER_SIZE))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                # the next read waits for the disk write, so a fast client can't outrun the disk
+                await self.run(upload.feed, chunk)
+            saved = await self.run(upload.finish)
+        except (MultipartError, OSError) as e:
+            done = await self.run(upload.fail)
+            self.close_connection = True  # unread request body may still be on the socket
+            status, message = _upload_failed(e)
+            await self.send_json({"message": message, "files": done}, status)
+            return
+
+        await self.send_json({"message": f"{len(saved)} file(s) uploaded", "files": saved})
+
+    async def read_json(self, limit=MAX_FIELD_SIZE):
+        try:
+            remaining = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            remaining = -1
+        if not 0 <= remaining <= limit:
+            self.close_connection = True
+            raise UploadError(400, "Invalid JSON body")
+        body = b""
+        while remaining > 0:
+            chunk = await self.read_body(remaining)
+            if not chunk:
+                break
+            body += chunk
+            remaining -= len(chunk)
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            raise UploadError(400, "Invalid JSON body")
+        if not isinstance(data, dict):
+            raise UploadError(400, "Invalid JSON body")
+        return data
+
+    async def handle_delete(self):
+        try:
+            data = await self.read_json()
+        except UploadError as e:
+            await self.send_json({"message": str(e)}, e.status)
+            return
+        status, message = await self.run(_delete_path, data.get("filename", ""))
+        await self.send_json({"message": message}, status)
+
+class AsyncHTTPServer:
+    """
+    asyncio backend: one event loop handles every connection and its keep-alive idle time;
+    blocking filesystem work goes to a bounded thread pool. Same routes as ThreadPoolHTTPServer.
+    """
+    def __init__(self, server_address, workers=MAX_WORKERS, backlog=ACCEPT_BACKLOG, sock=None):
+        self.server_address = server_address
+        self.backlog = backlog
+        self.sock = sock  # already listening (pre-fork worker), else bound in serve_forever
+        self.executor = concurrent.futures.ThreadPoolExecutor(max(1, workers), thread_name_prefix="http-worker")
+        self.loop = None
+        self.draining = False
+        self._connections = set()  # connection tasks
+        self._idle = set()         # ... of which waiting for their next request
+
+    async def serve_forever(self):
+        """Serves until SIGTERM, then drains: idle connections close, busy ones finish their request."""
+        self.loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        self.loop.add_signal_handler(signal.SIGTERM, stop.set)
+        if self.sock is not None:
+            server = await asyncio.start_server(self.handle_connection, sock=self.sock)
+        else:
+            host, port = self.server_address
+            server = await asyncio.start_server(self.handle_connection, host or None, port,
+                                                backlog=self.backlog, reuse_address=True)
+        await stop.wait()
+        server.close()
+        self.draining = True
+        for task in self._idle:
+            task.cancel()
+        if self._connections:
+            await asyncio.wait(self._connections, timeout=DRAIN_TIMEOUT)
+
+    def server_close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        metrics.inc("localserver_connections_total")
+        metrics.inc("localserver_active_connections")
+        try:
+            while True:
+                self._idle.add(task)
+                try:
+                    # idle keep-alive connections cost a coroutine, not a thread
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    return
+                except asyncio.LimitOverrunError:
+                    writer.write(b"HTTP/1.1 431 Request Header Fields Too Large\r\n"
+                                 b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+                    return
+                self._idle.discard(task)
+                request = self.parse_head(reader, writer, head)
+                if request is None:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    return
+                await request.handle()
+                if request.close_connection or self.draining:
+                    return
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        except Exception:
+            # same report socketserver's handle_error gives for the threaded engine
+            print("-" * 40, file=sys.stderr)
+            print("Exception occurred during processing of request from",
+                  writer.get_extra_info("peername"), file=sys.stderr)
+            traceback.print_exc()
+            print("-" * 40, file=sys.stderr)
+        finally:
+            metrics.inc("localserver_active_connections", value=-1)
+            self._connections.discard(task)
+            self._idle.discard(task)
+            writer.close()
+
+    def parse_head(self, reader, writer, head):
+        line, _, rest = head.partition(b"\r\n")
+        words = line.decode("iso-8859-1").split()
+        if len(words) != 3 or not words[2].startswith("HTTP/1."):
+            return None
+        method, target, version = words
+        try:
+            headers = http.client.parse_headers(io.BytesIO(rest))
+        except http.client.HTTPException:
+            return None
+        return AsyncRequest(self, reader, writer, head, method, target, version, headers)
+
+
+# ------------- Pre-fork supervisor -------------
+class Supervisor:
+    """
+    --processes N: one listening socket shared by N worker processes.
+    Each worker is a fresh `server.py --listen-fd` with its own GIL, caches and thread pool;
+    the kernel hands each accepted connection to whichever worker calls accept() first.
+    Crashed workers are restarted. SIGHUP starts a new set (re-reading server.py) and lets
+    the old set drain; SIGTERM / SIGINT drain all workers and exit.
+    """
+    def __init__(self, sock, processes, argv):
+        self.sock = sock
+        self.processes = processes
+        self.argv = argv
+        self.workers = {}   # slot -> (Popen, started)
+        self.retired = []   # draining after a reload
+        self._reload = self._stop = False
+
+    def spawn(self, slot):
+        fd = self.sock.fileno()
+        cmd = [sys.executable, os.path.abspath(__file__), *self.argv, "--listen-fd", str(fd)]
+        self.workers[slot] = (subprocess.Popen(cmd, pass_fds=(fd,)), time.monotonic())
+
+    def _on_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self._reload = True
+        else:
+            self._stop = True
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_signal)
+        for slot in range(self.processes):
+            self.spawn(slot)
+        while not self._stop:
+            if self._reload:
+                self._reload = False
+                old = [proc for proc, _ in self.workers.values()]
+                for slot in range(self.processes):
+                    self.spawn(slot)
+                # new workers are already accepting; the old ones stop accepting and finish up
+                for proc in old:
+                    proc.terminate()
+                self.retired += old
+                print(f"Reloading: {len(old)} worker(s) draining", file=sys.stderr)
+            for slot, (proc, started) in list(self.workers.items()):
+                # a worker that dies right after starting waits a bit, so a broken build doesn't spin
+                if proc.poll() is not None and time.monotonic() - started >= WORKER_RESTART_DELAY:
+                    print(f"Worker {proc.pid} exited with {proc.returncode}, restarting", file=sys.stderr)
+                    self.spawn(slot)
+            self.retired = [proc for proc in self.retired if proc.poll() is None]
+            time.sleep(0.2)
+
+        procs = self.retired + [proc for proc, _ in self.workers.values()]
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+        deadline = time.monotonic() + DRAIN_TIMEOUT + 5
+        for proc in procs:
+            try:
+                proc.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        self.sock.close()
+
+def _exit_with_parent(ppid):
+    """Worker side: if the supervisor goes away (even kill -9), drain and exit instead of lingering."""
+    while os.getppid() == ppid:
+        time.sleep(1)
+    os.kill(os.getpid(), signal.SIGTERM)
 
-        self.send_error(404, "Page Not Found")
 
 # ------------- Server -------------
-with socketserver.TCPServer((HOST, PORT), MyHTTPRequestHandler) as httpd:
-    print(f"Serving at http://127.0.0.1:{PORT}")
-    httpd.serve_forever()
+def _maintenance(worker):
+    """
+    Upload GC and the dedup reconcile work on shared files, so in pre-fork only one worker
+    runs them: whoever holds the lock. When it exits, a waiting sibling takes over.
+    """
+    if worker:
+        lock = open(os.path.join(_state_path(), "maintenance.lock"), "a")
+        _flock(lock.fileno())  # blocks until the current holder is gone; held for good after that
+    if dedup_store is not None:
+        dedup_store.reconcile()
+    upload_sessions.gc_forever()
+
+def start_background_services(worker=False, dedup=DEDUP):
+    global upload_sessions, dedup_store
+    if worker:
+        # pre-fork worker: share counters so /metrics on any worker covers them all
+        metrics.shared_dir = _state_path("metrics")
+        threading.Thread(target=metrics.flush_forever, name="metrics-flush", daemon=True).start()
+        # ... and changes made through this worker, so siblings' caches and indexes follow them
+        change_feed.start()
+        threading.Thread(target=change_feed.run_forever, name="change-feed", daemon=True).start()
+    upload_sessions = UploadSessions()
+    if dedup:
+        dedup_store = DedupStore()
+    threading.Thread(target=_maintenance, args=(worker,), name="maintenance", daemon=True).start()
+    threading.Thread(target=search_index.run_forever, name="search-index", daemon=True).start()
+    threading.Thread(target=folder_sizes.run_forever, name="folder-sizes", daemon=True).start()
+    threading.Thread(target=access_log.run_forever, name="access-log", daemon=True).start()
+    atexit.register(access_log.flush)
+
+def serve(args, sock=None):
+    """One server process (threaded or asyncio engine); SIGTERM stops accepting and drains."""
+    start_background_services(worker=sock is not None, dedup=args.dedup)
+    banner = f"Serving at http://127.0.0.1:{args.port}" if sock is None else f"Worker {os.getpid()} ready"
+
+    if args.engine == "asyncio":
+        server = AsyncHTTPServer((args.host, args.port), workers=args.workers, backlog=args.backlog, sock=sock)
+        print(f"{banner} (asyncio, {args.workers} fs threads)")
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    with ThreadPoolHTTPServer((args.host, args.port), MyHTTPRequestHandler,
+                              workers=args.workers, backlog=args.backlog, sock=sock) as httpd:
+        # shutdown() waits for serve_forever() to return, so it can't run in the handler itself
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=httpd.shutdown).start())
+        print(f"{banner} ({args.workers} workers)")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            return
+        httpd.drain()
+
+def main():
+    global BASE_DIR, UPLOAD_FSYNC, shaper, access_log
+    parser = argparse.ArgumentParser(description="Local file server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--dir", default=BASE_DIR, help="folder to serve and save uploads into")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="worker threads (per process)")
+    parser.add_argument("--backlog", type=int, default=ACCEPT_BACKLOG, help="accept backlog")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default=SERVER_ENGINE,
+                        help="serving backend")
+    parser.add_argument("--processes", type=int, default=PROCESSES,
+                        help="worker processes sharing the port (SIGHUP = graceful restart)")
+    parser.add_argument("--dedup", action="store_true", default=DEDUP,
+                        help="store identical uploads once (content-addressed, linked into place)")
+    parser.add_argument("--fsync", choices=("off", "file", "full"), default=UPLOAD_FSYNC,
+                        help="flush uploads to disk before they appear: file data, or data + folder entry")
+    parser.add_argument("--limit-down", type=_parse_rate, default=RATE_LIMIT_DOWN, metavar="RATE",
+                        help="total download bandwidth, bytes/s (K/M/G suffixes, 0 = unlimited)")
+    parser.add_argument("--limit-up", type=_parse_rate, default=RATE_LIMIT_UP, metavar="RATE",
+                        help="total upload bandwidth")
+    parser.add_argument("--client-limit-down", type=_parse_rate, default=CLIENT_RATE_LIMIT_DOWN, metavar="RATE",
+                        help="download bandwidth per client IP")
+    parser.add_argument("--client-limit-up", type=_parse_rate, default=CLIENT_RATE_LIMIT_UP, metavar="RATE",
+                        help="upload bandwidth per client IP")
+    parser.add_argument("--route-limit", type=_parse_route_rate, action="append", default=[], metavar="ROUTE=RATE",
+                        help="bandwidth of /download, /zip or /upload, e.g. /download=10M (repeatable)")
+    parser.add_argument("--access-log", default=ACCESS_LOG, metavar="PATH",
+                        help='JSON-lines access log file ("-" = stderr, "off" = none)')
+    parser.add_argument("--log-sample", type=_parse_sample, action="append", default=[], metavar="ROUTE=FRACTION",
+                        help="log only this fraction of a busy route's successful requests, e.g. /files=0.1")
+    parser.add_argument("--listen-fd", type=int, help=argparse.SUPPRESS)  # set by the supervisor
+    args = parser.parse_args()
+
+    BASE_DIR = os.path.abspath(args.dir)
+    UPLOAD_FSYNC = args.fsync
+    shaper = Shaper(args.limit_down, args.limit_up, args.client_limit_down, args.client_limit_up,
+                    routes={**ROUTE_RATE_LIMITS, **dict(args.route_limit)}, share=max(1, args.processes))
+    access_log = AccessLog(args.access_log, {**ACCESS_LOG_SAMPLE, **dict(args.log_sample)})
+    if not os.path.exists(BASE_DIR):
+        os.makedirs(BASE_DIR)
+
+    if args.listen_fd is not None:
+        # worker of a pre-fork supervisor: Ctrl-C is the supervisor's to handle (it drains us)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        threading.Thread(target=_exit_with_parent, args=(os.getppid(),), daemon=True).start()
+        serve(args, socket.socket(fileno=args.listen_fd))
+        return
+
+    if args.processes > 1:
+        if not hasattr(os, "fork"):
+            parser.error("--processes needs a POSIX system")
+        sock = socket.create_server((args.host, args.port), backlog=args.backlog)
+        print(f"Serving at http://127.0.0.1:{args.port} ({args.processes} processes, {args.engine})")
+        Supervisor(sock, args.processes, sys.argv[1:]).run()
+        return
+
+    serve(args)
+
+
+if __name__ == "__main__":
+    main()
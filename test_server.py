@@ -0,0 +1,808 @@
+"""
+Unit tests for the pure helpers in server.py (no server is started):
+
+    python -m pytest -q test_server.py
+    python -m unittest test_server
+"""
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import server
+
+
+class _Part:
+    def __init__(self, headers):
+        self.headers = headers
+        self.data = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        assert not self.closed
+        self.data += data
+
+    def close(self):
+        self.closed = True
+
+
+def _multipart(boundary, parts, preamble=b"", epilogue=b""):
+    """Body for [(headers dict, content bytes), ...]."""
+    body = preamble
+    for headers, content in parts:
+        body += b"--" + boundary + b"\r\n"
+        for name, value in headers.items():
+            body += f"{name}: {value}\r\n".encode()
+        body += b"\r\n" + content + b"\r\n"
+    return body + b"--" + boundary + b"--\r\n" + epilogue
+
+
+def _parse(boundary, chunks):
+    parts = []
+
+    def factory(headers):
+        parts.append(_Part(headers))
+        return parts[-1]
+
+    parser = server.MultipartParser(boundary, factory)
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser, parts
+
+
+def _random_split(data, rng):
+    chunks, pos = [], 0
+    while pos < len(data):
+        n = rng.choice((1, 2, 3, rng.randint(1, 64), rng.randint(1, len(data))))
+        chunks.append(data[pos:pos + n])
+        pos += n
+    return chunks
+
+
+class MultipartParserTest(unittest.TestCase):
+    BOUNDARY = b"----b0und4ry"
+    PARTS = [
+        ({"Content-Disposition": 'form-data; name="dir"'}, b"some/folder"),
+        ({"Content-Disposition": 'form-data; name="file"; filename="a.bin"',
+          "Content-Type": "application/octet-stream"},
+         # looks like the delimiter, almost: the parser must not cut the part here
+         b"\r\n------b0und4r\r\n--" + bytes(range(256)) * 4 + b"\r\n--"),
+        ({"Content-Disposition": 'form-data; name="file"; filename="empty.txt"'}, b""),
+    ]
+
+    def check(self, parser, parts):
+        self.assertTrue(parser.finished)
+        self.assertEqual(len(parts), len(self.PARTS))
+        for part, (headers, content) in zip(parts, self.PARTS):
+            self.assertTrue(part.closed)
+            self.assertEqual(part.headers["Content-Disposition"], headers["Content-Disposition"])
+            self.assertEqual(bytes(part.data), content)
+
+    def test_whole_body(self):
+        body = _multipart(self.BOUNDARY, self.PARTS)
+        self.check(*_parse(self.BOUNDARY, [body]))
+
+    def test_one_byte_at_a_time(self):
+        body = _multipart(self.BOUNDARY, self.PARTS)
+        self.check(*_parse(self.BOUNDARY, [body[i:i + 1] for i in range(len(body))]))
+
+    def test_random_splits(self):
+        body = _multipart(self.BOUNDARY, self.PARTS, preamble=b"ignored\r\n", epilogue=b"also ignored")
+        rng = random.Random(1234)
+        for _ in range(300):
+            self.check(*_parse(self.BOUNDARY, _random_split(body, rng)))
+
+    def test_random_contents(self):
+        # payloads made of delimiter fragments, so near-misses land on every chunk edge
+        rng = random.Random(99)
+        pieces = [b"\r", b"\n", b"-", b"--", b"\r\n--", self.BOUNDARY[:5], self.BOUNDARY[:-1], b"x"]
+        for _ in range(100):
+            contents = [b"".join(rng.choice(pieces) for _ in range(rng.randint(0, 50))) for _ in range(3)]
+            contents = [c for c in contents if b"\r\n--" + self.BOUNDARY not in b"\r\n" + c + b"\r\n"]
+            parts = [({"Content-Disposition": f'form-data; name="f{i}"'}, c) for i, c in enumerate(contents)]
+            body = _multipart(self.BOUNDARY, parts)
+            parser, got = _parse(self.BOUNDARY, _random_split(body, rng))
+            self.assertTrue(parser.finished)
+            self.assertEqual([bytes(p.data) for p in got], contents)
+
+    def test_transport_padding_after_boundary(self):
+        body = _multipart(self.BOUNDARY, self.PARTS).replace(self.BOUNDARY + b"\r\n", self.BOUNDARY + b"  \r\n")
+        self.check(*_parse(self.BOUNDARY, [body]))
+
+    def test_unfinished_body(self):
+        body = _multipart(self.BOUNDARY, self.PARTS)
+        closing = b"\r\n--" + self.BOUNDARY + b"--\r\n"
+        parser, parts = _parse(self.BOUNDARY, [body[:-len(closing)]])
+        self.assertEqual(len(parts), len(self.PARTS))
+        self.assertFalse(parser.finished)
+        self.assertFalse(parts[-1].closed)
+
+    def test_part_headers_too_large(self):
+        body = b"--" + self.BOUNDARY + b"\r\nX-Big: " + b"a" * (server.MAX_PART_HEADER_SIZE + 1)
+        with self.assertRaises(server.MultipartError):
+            _parse(self.BOUNDARY, [body])
+
+    def test_missing_boundary(self):
+        with self.assertRaises(server.MultipartError):
+            server.MultipartParser(b"", lambda headers: None)
+
+
+class RangeTest(unittest.TestCase):
+    def parse(self, header, size=1000):
+        return server._parse_range(header, size)
+
+    def test_single_ranges(self):
+        self.assertEqual(self.parse("bytes=0-99"), [(0, 99)])
+        self.assertEqual(self.parse("bytes=900-"), [(900, 999)])
+        self.assertEqual(self.parse("bytes=0-99999"), [(0, 999)])  # end clamped to the file
+
+    def test_suffix_ranges(self):
+        self.assertEqual(self.parse("bytes=-100"), [(900, 999)])
+        self.assertEqual(self.parse("bytes=-2000"), [(0, 999)])
+        self.assertEqual(self.parse("bytes=-0"), [])
+
+    def test_overlapping_and_adjacent_ranges_merge(self):
+        self.assertEqual(self.parse("bytes=30-,0-9,5-20"), [(0, 20), (30, 999)])
+        self.assertEqual(self.parse("bytes=0-1,2-3"), [(0, 3)])
+        self.assertEqual(self.parse("bytes=0-1,3-4"), [(0, 1), (3, 4)])
+        self.assertEqual(self.parse("bytes=-10,995-"), [(990, 999)])
+
+    def test_unsatisfiable(self):
+        self.assertEqual(self.parse("bytes=1000-"), [])
+        self.assertEqual(self.parse("bytes=1000-,2000-3000"), [])
+        self.assertEqual(self.parse("bytes=0-", size=0), [])
+        self.assertEqual(self.parse("bytes=1000-,0-0"), [(0, 0)])  # the satisfiable one is kept
+
+    def test_ignored(self):
+        for header in ("items=0-1", "bytes=", "bytes=abc", "bytes=5-1", "bytes=0-1;2-3", "bytes=x-5"):
+            self.assertIsNone(self.parse(header), header)
+        too_many = "bytes=" + ",".join(f"{i * 10}-{i * 10}" for i in range(server.MAX_RANGES + 1))
+        self.assertIsNone(self.parse(too_many))
+
+    def test_if_range(self):
+        headers = {"Range": "bytes=0-9", "If-Range": '"abc"'}
+        self.assertEqual(server._select_ranges(headers, 100, '"abc"', "lm"), [(0, 9)])
+        self.assertIsNone(server._select_ranges(headers, 100, '"def"', "lm"))
+        self.assertIsNone(server._select_ranges({}, 100, '"abc"', "lm"))
+
+
+def _listing(names_sizes, dirs=()):
+    """Listing snapshot as _scan_dir would build it: folders first, then by name."""
+    entries = [server.Entry(name, True, 0, 1.0, 0) for name in dirs]
+    entries += [server.Entry(name, False, size, float(size)) for name, size in names_sizes]
+    entries.sort(key=lambda e: (not e.is_dir, e.name.lower()))
+    return server.Listing("/x", (1, 1), entries)
+
+
+class ListPageTest(unittest.TestCase):
+    FILES = [(f"f{i:02d}", (i * 7) % 20) for i in range(20)]
+
+    def all_pages(self, listing, **kwargs):
+        names, cursor = [], None
+        while True:
+            page, cursor, total = server._list_page(listing, cursor=cursor, **kwargs)
+            names += [e.name for e in page]
+            if not cursor:
+                return names, total
+
+    def test_pages_cover_everything_once(self):
+        listing = _listing(self.FILES, dirs=["B", "a"])
+        names, total = self.all_pages(listing, limit=3)
+        self.assertEqual(total, 22)
+        self.assertEqual(names, ["a", "B"] + [name for name, _ in self.FILES])
+
+    def test_sort_by_size_keeps_folders_first(self):
+        listing = _listing(self.FILES, dirs=["d"])
+        names, _ = self.all_pages(listing, sort="size", limit=4)
+        sizes = dict(self.FILES)
+        self.assertEqual(names[0], "d")
+        self.assertEqual([sizes[n] for n in names[1:]], sorted(sizes.values(), reverse=True))
+        names, _ = self.all_pages(listing, sort="size", order="asc", limit=4)
+        self.assertEqual([sizes[n] for n in names[1:]], sorted(sizes.values()))
+
+    def test_filter(self):
+        listing = _listing(self.FILES + [("F1x", 3)])
+        names, total = self.all_pages(listing, q="F1", limit=2)
+        self.assertEqual(total, 11)
+        self.assertEqual(names, [f"f{i}" for i in range(10, 20)] + ["F1x"])
+
+    def test_cursor_after_deleted_entry(self):
+        for sort in ("name", "size", "date"):
+            before = _listing(self.FILES)
+            page, cursor, _ = server._list_page(before, sort=sort, limit=5)
+            ordered = [e.name for e in server._list_page(before, sort=sort, limit=100)[0]]
+            gone = page[-1].name
+            after = _listing([f for f in self.FILES if f[0] != gone])
+            page, _, _ = server._list_page(after, sort=sort, cursor=cursor, limit=5)
+            self.assertEqual([e.name for e in page], ordered[5:10], sort)
+
+    def test_cursor_after_added_entry(self):
+        before = _listing(self.FILES)
+        page, cursor, _ = server._list_page(before, limit=5)
+        after = _listing(self.FILES + [("a-new", 1)])  # sorts before the page already seen
+        page, _, _ = server._list_page(after, cursor=cursor, limit=5)
+        self.assertEqual([e.name for e in page], [f"f{i:02d}" for i in range(5, 10)])
+
+    def test_bad_arguments(self):
+        listing = _listing(self.FILES)
+        for kwargs in ({"sort": "owner"}, {"order": "up"}, {"cursor": "not-a-cursor"}):
+            with self.assertRaises(ValueError):
+                server._list_page(listing, **kwargs)
+        with self.assertRaises(ValueError):
+            server._page_args({"limit": "many"}, 10)
+        self.assertEqual(server._page_args({"limit": "0"}, 10)["limit"], 1)
+
+
+class ConditionalTest(unittest.TestCase):
+    def test_etag_matches(self):
+        self.assertTrue(server._etag_matches('"abc"', '"abc"'))
+        self.assertTrue(server._etag_matches('W/"abc"', '"abc"'))  # weak comparison
+        self.assertTrue(server._etag_matches('"abc"', 'W/"abc"'))
+        self.assertTrue(server._etag_matches(' * ', '"abc"'))
+        self.assertTrue(server._etag_matches('"x", W/"abc" ,"y"', '"abc"'))
+        self.assertFalse(server._etag_matches('"x", "y"', '"abc"'))
+        self.assertFalse(server._etag_matches('"abcd"', '"abc"'))
+
+    def test_not_modified_since(self):
+        mtime = 1700000000.75
+        self.assertTrue(server._not_modified_since("Tue, 14 Nov 2023 22:13:20 GMT", mtime))  # same second
+        self.assertTrue(server._not_modified_since("Wed, 15 Nov 2023 00:00:00 GMT", mtime))
+        self.assertFalse(server._not_modified_since("Tue, 14 Nov 2023 22:13:19 GMT", mtime))
+        self.assertFalse(server._not_modified_since("not a date", mtime))
+        self.assertFalse(server._not_modified_since("", mtime))
+
+    def test_if_none_match_wins_over_if_modified_since(self):
+        headers = server._cache_headers("download", '"abc"', 1700000000)
+        later = "Wed, 15 Nov 2023 00:00:00 GMT"
+        self.assertTrue(server._is_fresh({"If-None-Match": '"abc"'}, headers, 1700000000))
+        self.assertTrue(server._is_fresh({"If-Modified-Since": later}, headers, 1700000000))
+        self.assertFalse(server._is_fresh({"If-None-Match": '"old"', "If-Modified-Since": later},
+                                          headers, 1700000000))
+        self.assertFalse(server._is_fresh({}, headers, 1700000000))
+
+
+@mock.patch.object(server, "ENCODING_PREFERENCE", ["zstd", "br", "gzip"])
+class NegotiateEncodingTest(unittest.TestCase):
+    def test_preference_order_breaks_ties(self):
+        self.assertEqual(server._negotiate_encoding("gzip, br, zstd"), "zstd")
+        self.assertEqual(server._negotiate_encoding("gzip, deflate"), "gzip")
+
+    def test_q_values(self):
+        self.assertEqual(server._negotiate_encoding("zstd;q=0.5, gzip;q=0.9, br;q=0.1"), "gzip")
+        self.assertEqual(server._negotiate_encoding("GZIP;q=1.0, br;q=0.99"), "gzip")
+        self.assertEqual(server._negotiate_encoding("br;q=oops, gzip;q=0.2"), "gzip")  # bad q => 0
+
+    def test_q_zero_excludes(self):
+        self.assertEqual(server._negotiate_encoding("zstd;q=0, br;q=0, gzip"), "gzip")
+        self.assertIsNone(server._negotiate_encoding("gzip;q=0"))
+
+    def test_star(self):
+        self.assertEqual(server._negotiate_encoding("*"), "zstd")
+        self.assertEqual(server._negotiate_encoding("*;q=0.5, zstd;q=0"), "br")
+        self.assertIsNone(server._negotiate_encoding("*;q=0"))
+
+    def test_nothing_supported(self):
+        for header in ("", "identity", "deflate, compress", " , ;q=1"):
+            self.assertIsNone(server._negotiate_encoding(header), header)
+
+
+class _TempBase(unittest.TestCase):
+    """Runs each test against its own empty BASE_DIR."""
+    def setUp(self):
+        self.base = tempfile.mkdtemp(prefix="localserver-test-")
+        self.addCleanup(shutil.rmtree, self.base, True)
+        patcher = mock.patch.object(server, "BASE_DIR", self.base)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        server.listing_cache.clear()
+
+    def path(self, rel):
+        return os.path.join(self.base, rel)
+
+    def write(self, rel, data=b""):
+        os.makedirs(os.path.dirname(self.path(rel)), exist_ok=True)
+        with open(self.path(rel), "wb") as f:
+            f.write(data)
+
+    def read(self, rel):
+        with open(self.path(rel), "rb") as f:
+            return f.read()
+
+
+class UploadSessionsTest(_TempBase):
+    DATA = bytes(range(256)) * 1100  # 281600 bytes: two full chunks and a short one
+
+    def setUp(self):
+        super().setUp()
+        self.sessions = server.UploadSessions()
+        self.session = self.sessions.create("big.bin", "", len(self.DATA), server.UPLOAD_MIN_CHUNK_SIZE // 2)
+
+    def put(self, index, data=None):
+        size = self.session.chunk_size
+        if data is None:
+            data = self.DATA[index * size:(index + 1) * size]
+        self.sessions.write_chunk(self.session, index, len(data), io.BytesIO(data))
+
+    def assertStatus(self, status, fn, *args):
+        with self.assertRaises(server.UploadError) as ctx:
+            fn(*args)
+        self.assertEqual(ctx.exception.status, status)
+
+    def test_create(self):
+        self.assertEqual(self.session.chunk_size, server.UPLOAD_MIN_CHUNK_SIZE)  # clamped
+        self.assertEqual(self.session.chunk_count, 2)
+        part, _ = self.sessions._paths(self.session.id)
+        self.assertEqual(os.path.getsize(part), len(self.DATA))
+        self.assertStatus(400, self.sessions.create, "x", "", -1)
+        self.assertStatus(400, self.sessions.create, "", "", 10)
+
+    def test_write_chunk_checks_index_and_length(self):
+        self.assertStatus(400, self.put, 2)
+        self.assertStatus(400, self.put, -1, b"x")
+        self.assertStatus(400, self.put, 0, b"too short")
+        self.assertStatus(400, self.sessions.write_chunk, self.session, 1, self.session.chunk_length(1),
+                          io.BytesIO(b"ends early"))
+        self.assertEqual(self.session.received, set())
+
+    def test_commit_needs_every_chunk(self):
+        self.put(1)
+        self.assertStatus(409, self.sessions.commit, self.session)
+        self.assertFalse(os.path.exists(self.path("big.bin")))
+
+    def test_commit_out_of_order_is_byte_exact(self):
+        self.write("big.bin", b"old version")
+        self.put(1)
+        self.put(0)
+        self.put(1)  # a retried chunk just overwrites itself
+        target = self.sessions.commit(self.session)
+        self.assertEqual(target, self.path("big.bin"))
+        self.assertEqual(self.read("big.bin"), self.DATA)
+        self.assertEqual(os.listdir(self.sessions.dir), [])
+        self.assertStatus(404, self.sessions.get, self.session.id)
+
+    def test_resumes_from_saved_state(self):
+        self.put(0)
+        again = server.UploadSessions().get(self.session.id)  # e.g. after a restart
+        self.assertEqual(again.received, {0})
+
+    def test_garbage_collection(self):
+        fresh = self.sessions.create("fresh.bin", "", 10)
+        self.session.updated = time.time() - 3600
+        self.sessions._save(self.session)
+        self.sessions.collect_garbage(ttl=60)
+        self.assertEqual(sorted(os.listdir(self.sessions.dir)), sorted(
+            os.path.basename(p) for p in self.sessions._paths(fresh.id)))
+        self.assertStatus(404, self.sessions.get, self.session.id)
+
+
+class MultipartUploadTest(_TempBase):
+    BOUNDARY = b"xyz"
+
+    def upload(self, filename, content=b"data", fields=None):
+        parts = [({"Content-Disposition": f'form-data; name="{k}"'}, v.encode()) for k, v in (fields or {}).items()]
+        parts.append(({"Content-Disposition": f'form-data; name="file"; filename="{filename}"'}, content))
+        body = _multipart(self.BOUNDARY, parts)
+        upload = server.MultipartUpload("multipart/form-data; boundary=xyz", len(body))
+        upload.feed(body)
+        return upload.finish()
+
+    def test_saves_into_dir_field(self):
+        os.mkdir(self.path("sub"))
+        self.assertEqual(self.upload("a.txt", fields={"dir": "sub"}), ["sub/a.txt"])
+        self.assertEqual(self.read("sub/a.txt"), b"data")
+        self.assertEqual(self.upload("../../b.txt"), ["b.txt"])  # only the base name counts
+
+    def test_reserved_names_rejected(self):
+        for name in (".", "..", server.STATE_DIR_NAME, ".a.txt.1234" + server.UPLOAD_TMP_SUFFIX):
+            with self.assertRaises(server.MultipartError, msg=name):
+                self.upload(name)
+        with self.assertRaises(server.MultipartError):
+            self.upload("a.txt", fields={"dir": "../.."})
+        self.assertEqual(os.listdir(self.base), [])
+
+    def test_os_errors_hide_paths(self):
+        error = OSError(16, "Device or resource busy", self.path("x"), self.path(".."))
+        with mock.patch("sys.stderr", io.StringIO()) as log:
+            status, message = server._upload_failed(error)
+        self.assertEqual(status, 500)
+        self.assertNotIn(self.base, message)
+        self.assertIn(self.base, log.getvalue())
+        self.assertEqual(server._upload_failed(server.MultipartError("Folder not found")),
+                         (400, "Upload failed: Folder not found"))
+
+
+class ApplyDeltaTest(_TempBase):
+    BLOCK = server.DELTA_MIN_BLOCK_SIZE
+    OLD = bytes(range(256)) * 12 + b"tail" * 25  # three full blocks and a 100 byte one
+
+    def setUp(self):
+        super().setUp()
+        self.write("f.bin", self.OLD)
+        self.file = self.path("f.bin")
+
+    def apply(self, ops, body=b"", size=None, version=None):
+        if version is None:
+            version = server._file_validators(os.stat(self.file))[0]
+        if size is None:
+            size = len(body) + sum(min(n * self.BLOCK, len(self.OLD) - first * self.BLOCK)
+                                   for first, n in (op for op in ops if isinstance(op, list)))
+        recipe = {"version": version, "block_size": self.BLOCK, "size": size, "ops": ops}
+        return server._apply_delta(self.file, recipe, io.BytesIO(body), len(body))
+
+    def assertRejected(self, status, *args, **kwargs):
+        with self.assertRaises(server.UploadError) as ctx:
+            self.apply(*args, **kwargs)
+        self.assertEqual(ctx.exception.status, status)
+        self.assertEqual(self.read("f.bin"), self.OLD)
+        self.assertEqual(os.listdir(self.base), ["f.bin"])  # no temp file left behind
+
+    def test_copy_and_literal_ops(self):
+        self.assertEqual(self.apply([[1, 2], 3, [0, 1]], b"new"), 3 * self.BLOCK + 3)
+        self.assertEqual(self.read("f.bin"),
+                         self.OLD[self.BLOCK:3 * self.BLOCK] + b"new" + self.OLD[:self.BLOCK])
+
+    def test_copy_is_cut_at_end_of_file(self):
+        self.apply([3, [2, 10]], b"abc")
+        self.assertEqual(self.read("f.bin"), b"abc" + self.OLD[2 * self.BLOCK:])
+
+    def test_bad_ops(self):
+        self.assertRejected(400, [[4, 1]], size=self.BLOCK)  # starts past the end
+        self.assertRejected(400, [[-1, 1]], size=self.BLOCK)
+        self.assertRejected(400, [[0, 0]], size=0)
+        self.assertRejected(400, ["x"], size=0)
+        self.assertRejected(400, [5], b"abc", size=5)  # literal longer than the body
+        self.assertRejected(400, [[0, 1]], size=10)  # builds more than size
+        self.assertRejected(400, [2], b"abc", size=2)  # body bytes left over
+
+    def test_stale_version(self):
+        self.assertRejected(409, [[0, 1]], version='"older"')
+
+    def test_write_drops_cached_signatures(self):
+        sig_path, etag = server._delta_signature(self.file, self.BLOCK)
+        self.assertTrue(os.path.exists(sig_path))
+        self.assertEqual(server._delta_signature(self.file, self.BLOCK), (sig_path, etag))  # cached
+        self.apply([[0, 1]])
+        server._on_tree_change(self.file)  # as the /upload/delta/ handler does
+        self.assertFalse(os.path.exists(sig_path))
+        self.assertNotEqual(server._delta_signature(self.file, self.BLOCK)[1], etag)
+
+
+class SearchIndexTest(_TempBase):
+    def setUp(self):
+        super().setUp()
+        for rel in ("Docs/report-2023.pdf", "Docs/old/report-2019.pdf", "Docs/old/portfolio-archive.zip", "music/Report Song.mp3",
+                    "readme.txt"):
+            self.write(rel)
+        self.index = server.SearchIndex()
+        self.index.build()
+
+    def names(self, q, limit=50):
+        return [rel for rel, _ in self.index.search(q, limit)[1]]
+
+    def test_build(self):
+        self.assertTrue(self.index.ready)
+        self.assertEqual(len(self.index), 8)  # folders included
+        self.assertEqual(self.index.search("docs"), (1, [("Docs", True)]))
+
+    def test_substring_match_ranks_prefixes_first(self):
+        self.assertEqual(self.names("REPORT"), [  # shortest path first
+            "Docs/report-2023.pdf", "music/Report Song.mp3", "Docs/old/report-2019.pdf"])
+        self.assertEqual(self.names("port"), [
+            "Docs/old/portfolio-archive.zip", "Docs/report-2023.pdf", "music/Report Song.mp3",
+            "Docs/old/report-2019.pdf"])
+        self.assertEqual(self.names("-20"), ["Docs/report-2023.pdf", "Docs/old/report-2019.pdf"])
+        self.assertEqual(self.index.search("report", limit=1), (3, [("Docs/report-2023.pdf", False)]))
+        self.assertEqual(self.index.search("nothing like it"), (0, []))
+
+    def test_short_queries_match_prefixes_only(self):
+        self.assertEqual(self.names("r"), ["readme.txt", "Docs/report-2023.pdf", "music/Report Song.mp3",
+                                           "Docs/old/report-2019.pdf"])
+        self.assertEqual(self.names("mu"), ["music"])
+        self.assertEqual(self.names("df"), [])  # in "pdf", but not at the start of a name
+        self.assertEqual(self.index.search("  "), (0, []))
+
+    def test_updates(self):
+        self.write("new.txt")
+        self.index.update("new.txt")
+        os.rename(self.path("readme.txt"), self.path("README.md"))
+        self.index.update("readme.txt")
+        self.index.update("README.md")
+        shutil.rmtree(self.path("Docs/old"))
+        self.index.update("Docs/old")
+        self.assertEqual(self.names("new"), ["new.txt"])
+        self.assertEqual(self.names("re"), ["README.md", "Docs/report-2023.pdf", "music/Report Song.mp3"])
+        self.assertEqual(self.names("2019"), [])
+        self.assertEqual(len(self.index), 6)
+
+    def test_compaction_after_removals(self):
+        shutil.rmtree(self.path("Docs"))
+        self.index.update("Docs")
+        self.index.compact()  # below SEARCH_COMPACT_MIN: dead ids stay
+        self.assertEqual(len(self.index._items), 8)
+        with mock.patch.object(server, "SEARCH_COMPACT_MIN", 0):
+            self.index.compact()
+        self.assertEqual(len(self.index._items), 3)
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.names("report"), ["music/Report Song.mp3"])
+        self.assertEqual(self.names("r"), ["readme.txt", "music/Report Song.mp3"])
+        self.write("music/report.txt")
+        self.index.update("music/report.txt")
+        self.assertEqual(self.names("rep"), ["music/report.txt", "music/Report Song.mp3"])
+
+
+class FolderSizesTest(_TempBase):
+    def setUp(self):
+        super().setUp()
+        self.write("top.txt", b"x" * 10)
+        self.write("a/one", b"x" * 100)
+        self.write("a/b/two", b"x" * 1000)
+        self.write("a/b/three", b"x" * 3)
+        self.write(".a.part.1234" + server.UPLOAD_TMP_SUFFIX, b"x" * 99)  # hidden: not counted
+        self.sizes = server.FolderSizes()
+        self.sizes._walk("")
+        self.sizes.ready = True
+
+    def totals(self):
+        return {rel: self.sizes.get(rel) for rel in ("", "a", "a/b")}
+
+    def test_initial_scan(self):
+        self.assertEqual(self.totals(), {"": (1113, 4), "a": (1103, 3), "a/b": (1003, 2)})
+        self.assertEqual(self.sizes.get("nope"), (0, None))
+        self.assertEqual(server.FolderSizes().get(""), (0, None))  # not ready yet
+
+    def test_changes_add_up_to_the_root(self):
+        self.write("a/b/four", b"x" * 4)
+        self.sizes.changed(self.path("a/b"))
+        self.assertEqual(self.sizes._pending, {"a/b"})
+        self.sizes.refresh("a/b")  # what the background thread does with it
+        self.assertEqual(self.totals(), {"": (1117, 5), "a": (1107, 4), "a/b": (1007, 3)})
+        os.remove(self.path("a/b/two"))
+        self.sizes.refresh("a/b")
+        self.assertEqual(self.totals(), {"": (117, 4), "a": (107, 3), "a/b": (7, 2)})
+
+    def test_new_and_removed_subfolders(self):
+        self.write("a/c/d/five", b"x" * 5)
+        self.sizes.refresh("a/c/d")  # unknown: walked from the nearest known parent
+        self.assertEqual(self.sizes.get("a/c"), (5, 1))
+        self.assertEqual(self.sizes.get("a"), (1108, 4))
+        shutil.rmtree(self.path("a/b"))
+        self.sizes.refresh("a")
+        self.assertEqual(self.totals(), {"": (115, 3), "a": (105, 2), "a/b": (0, None)})
+
+    def test_save_and_load(self):
+        saved = os.path.join(server._state_path(), "folder_sizes.json")
+        self.sizes.save(saved)
+        self.assertFalse(self.sizes.dirty)
+        loaded = server.FolderSizes()
+        loaded.load(saved)
+        loaded.ready = True
+        self.assertEqual({rel: loaded.get(rel) for rel in ("", "a", "a/b")}, self.totals())
+        self.write("a/b/four", b"x" * 4)  # changed while the server was down
+        loaded.reconcile()
+        self.assertEqual(loaded.get(""), (1117, 5))
+        with open(saved, "w") as f:
+            f.write('{"a": [0, 1, 1]}')
+        with self.assertRaises(ValueError):
+            server.FolderSizes().load(saved)
+
+
+class FileSinkTest(_TempBase):
+    DATA = os.urandom(1024) * 2500  # 2.5 MB: a few full UPLOAD_WRITE_SIZE writes and a short one
+
+    def setUp(self):
+        super().setUp()
+        self.write("f.bin", b"old version")
+
+    def feed(self, sink, data):
+        for i in range(0, len(data), 65536):
+            sink.write(data[i:i + 65536])
+
+    def test_replaces_target_only_when_done(self):
+        before = os.stat(self.path("f.bin")).st_ino
+        sink = server._FileSink(self.path("f.bin"), size_hint=8 * len(self.DATA))  # preallocates
+        self.feed(sink, self.DATA)
+        self.assertEqual(self.read("f.bin"), b"old version")
+        self.assertEqual(len(os.listdir(self.base)), 2)
+        self.assertTrue(server._is_upload_temp(os.path.basename(sink.tmp)))
+        sink.close()
+        self.assertTrue(sink.done)
+        self.assertEqual(self.read("f.bin"), self.DATA)  # the preallocated tail was trimmed
+        self.assertNotEqual(os.stat(self.path("f.bin")).st_ino, before)  # a new file, renamed in
+        self.assertEqual(os.listdir(self.base), ["f.bin"])
+
+    def test_abort_leaves_old_file(self):
+        sink = server._FileSink(self.path("f.bin"), size_hint=len(self.DATA))
+        self.feed(sink, self.DATA[:len(self.DATA) // 2])
+        sink.abort()
+        self.assertFalse(sink.done)
+        self.assertEqual(self.read("f.bin"), b"old version")
+        self.assertEqual(os.listdir(self.base), ["f.bin"])
+
+    def test_aborted_new_file_leaves_nothing(self):
+        sink = server._FileSink(self.path("new.bin"))
+        sink.write(b"partial")
+        sink.abort()
+        self.assertEqual(os.listdir(self.base), ["f.bin"])
+
+
+class AccessLogTest(_TempBase):
+    def setUp(self):
+        super().setUp()
+        self.file = self.path("access.log")
+        patcher = mock.patch.object(server, "metrics", server.Metrics())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def records(self, log):
+        log.flush()
+        log.f.close()
+        with open(self.file) as f:
+            return [json.loads(line) for line in f]
+
+    def test_record(self):
+        log = server.AccessLog(self.file)
+        log.record("1.2.3.4", "GET", "/download/a%20b.txt", 200, 0.0125, 0, 42)
+        log.message("1.2.3.4", "hello")
+        request, message = self.records(log)
+        self.assertEqual(request["path"], "/download/a%20b.txt")
+        self.assertEqual(request["file"], self.path("a b.txt"))
+        self.assertEqual((request["route"], request["status"], request["bytes_out"]), ("/download", 200, 42))
+        self.assertEqual(request["duration_ms"], 12.5)
+        self.assertNotIn("sample_rate", request)
+        self.assertEqual(message["message"], "hello")
+
+    def test_off(self):
+        log = server.AccessLog("off")
+        log.record("-", "GET", "/", 200, 0, 0, 0)
+        self.assertEqual(len(log._buf), 0)
+
+    def test_sampling_keeps_errors(self):
+        log = server.AccessLog(self.file, sample={"/files": 0.25})
+        with mock.patch("random.random", side_effect=[0.1, 0.5, 0.9]):
+            for status in (200, 200, 200, 404, 500):
+                log.record("-", "GET", "/files/x", status, 0, 0, 0)
+            log.record("-", "GET", "/download/x", 200, 0, 0, 0)  # not sampled
+        self.assertEqual([(r["route"], r["status"], r.get("sample_rate")) for r in self.records(log)], [
+            ("/files", 200, 0.25), ("/files", 404, 0.25), ("/files", 500, 0.25), ("/download", 200, None)])
+
+    def test_full_buffer_drops_and_counts(self):
+        log = server.AccessLog(self.file, capacity=3)
+        for i in range(5):
+            log.record("-", "GET", f"/files/{i}", 200, 0, 0, 0)
+        self.assertEqual(server.metrics.snapshot()[("localserver_access_log_dropped_total", ())], 2)
+        self.assertEqual([r["path"] for r in self.records(log)], ["/files/0", "/files/1", "/files/2"])
+
+    @mock.patch.object(server, "ACCESS_LOG_MAX_BYTES", 300)
+    @mock.patch.object(server, "ACCESS_LOG_BACKUPS", 2)
+    def test_rotation_by_size(self):
+        log = server.AccessLog(self.file)
+        for i in range(5):
+            log.record("-", "GET", f"/files/{i}", 200, 0, 0, 0)
+            log.flush()  # each record alone is under 300 bytes, two are over
+        log.f.close()
+        self.assertEqual(sorted(os.listdir(self.base)), ["access.log", "access.log.1", "access.log.2",
+                                                         "access.log.lock"])
+        paths = []
+        for name in ("access.log.2", "access.log.1", "access.log"):
+            with open(self.path(name)) as f:
+                paths.append([json.loads(line)["path"] for line in f])
+        self.assertEqual(paths, [["/files/0", "/files/1"], ["/files/2", "/files/3"], ["/files/4"]])
+
+
+class ShapingTest(unittest.TestCase):
+    RATE = 16 * server.SHAPE_SLICE  # bytes/s: a slice every 1/16 s
+
+    def setUp(self):
+        self.now = 1000.0
+        for patcher in (mock.patch.object(server.time, "monotonic", lambda: self.now),
+                        mock.patch.object(server, "RATE_BURST", 0.5)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_refill(self):
+        bucket = server.TokenBucket(self.RATE)
+        self.assertEqual(bucket.take(self.RATE // 2), 0.0)  # the burst: half a second saved up
+        self.assertEqual(bucket.take(self.RATE // 4), 0.25)
+        self.assertEqual(bucket.take(self.RATE // 4), 0.5)  # lines up behind the earlier charge
+        self.now += 0.5
+        self.assertEqual(bucket.take(0), 0.0)
+        self.assertEqual(bucket.take(self.RATE // 8), 0.125)
+
+    def test_burst_cap(self):
+        bucket = server.TokenBucket(self.RATE)
+        self.now += 3600
+        self.assertEqual(bucket.take(self.RATE // 2), 0.0)
+        self.assertEqual(bucket.take(self.RATE // 16), 0.0625)  # an idle hour saved no more than 0.5 s
+        self.assertEqual(server.TokenBucket(10).burst, server.SHAPE_SLICE)  # room for one slice at least
+
+    def transfer(self, flows, seconds):
+        """Each flow sends SHAPE_SLICE at a time, sleeping its wait in between; returns slices per flow."""
+        ready = [self.now] * len(flows)
+        sent = [0] * len(flows)
+        end = self.now + seconds
+        while min(ready) < end:
+            i = min(range(len(flows)), key=lambda j: (ready[j], sent[j]))  # ties: concurrent, so take turns
+            self.now = ready[i]
+            ready[i] = self.now + flows[i].delay("down", server.SHAPE_SLICE)
+            sent[i] += 1
+        return sent
+
+    def test_flows_share_the_global_limit(self):
+        with mock.patch.object(server, "shaper", server.Shaper(down=self.RATE)):
+            flows = [server._Flow(ip, "/download/big.iso") for ip in ("10.0.0.1", "10.0.0.2", "10.0.0.3")]
+            sent = self.transfer(flows, 10)
+        self.assertLessEqual(max(sent) - min(sent), 1)
+        self.assertAlmostEqual(sum(sent), 16 * 10 + 8 + 3, delta=3)  # rate * 10 s + burst + priority slices
+
+    def test_per_client_limits(self):
+        with mock.patch.object(server, "shaper", server.Shaper(client_down=self.RATE)):
+            flows = [server._Flow(ip, "/zip/x") for ip in ("10.0.0.1", "10.0.0.1", "10.0.0.2")]
+            sent = self.transfer(flows, 10)
+        self.assertLessEqual(abs(sent[0] - sent[1]), 1)  # one client's two flows split its limit ...
+        self.assertAlmostEqual(sent[2], sent[0] + sent[1], delta=2)  # ... the other client has its own
+
+    def test_priority_bytes_never_wait(self):
+        with mock.patch.object(server, "shaper", server.Shaper(down=self.RATE)):
+            server.shaper.charge("down", "x", "/download", 10 * self.RATE)  # far behind
+            listing = server._Flow("10.0.0.1", "/api/list/")
+            self.assertEqual(listing.delay("down", 10 * self.RATE), 0.0)
+            download = server._Flow("10.0.0.1", "/download/a")
+            self.assertEqual(download.delay("down", server.PRIORITY_BYTES), 0.0)
+            self.assertGreater(download.delay("down", 1), 10)
+
+
+class ListingCacheTest(_TempBase):
+    """Server-made changes reach the cached listing at once, not after LISTING_CACHE_MAX_AGE."""
+    def setUp(self):
+        super().setUp()
+        self.write("sub/a.txt", b"a")
+        self.folder = self.path("sub")
+        self.mtime = time.time() - 60  # older than LISTING_CACHE_RACY_WINDOW, so it is cached
+
+    def names(self):
+        # the folder keeps its old mtime, so only the server's invalidation can tell the cache
+        os.utime(self.folder, (self.mtime, self.mtime))
+        return {e.name: e.size for e in server.listing_cache.get(self.folder).entries}
+
+    def upload(self, name, content):
+        body = _multipart(b"xyz", [({"Content-Disposition": 'form-data; name="dir"'}, b"sub"),
+                                   ({"Content-Disposition": f'form-data; name="file"; filename="{name}"'}, content)])
+        upload = server.MultipartUpload("multipart/form-data; boundary=xyz", len(body))
+        upload.feed(body)
+        upload.finish()
+
+    def test_cached_until_changed(self):
+        self.assertEqual(self.names(), {"a.txt": 1})
+        cached = server.listing_cache.get(self.folder)
+        self.assertIs(server.listing_cache.get(self.folder), cached)
+        self.write("sub/outside.txt")  # not through the server: waits for the mtime / max age
+        self.assertEqual(self.names(), {"a.txt": 1})
+
+    def test_upload_and_overwrite(self):
+        self.assertEqual(self.names(), {"a.txt": 1})
+        self.upload("b.txt", b"bb")
+        self.assertEqual(self.names(), {"a.txt": 1, "b.txt": 2})
+        self.upload("a.txt", b"longer")  # renamed over the old file
+        self.assertEqual(self.names(), {"a.txt": 6, "b.txt": 2})
+
+    def test_delete(self):
+        self.assertEqual(self.names(), {"a.txt": 1})
+        self.assertEqual(server._delete_path("sub/a.txt"), (200, "sub/a.txt deleted successfully"))
+        self.assertEqual(self.names(), {})
+
+    def test_session_commit(self):
+        self.assertEqual(self.names(), {"a.txt": 1})
+        sessions = server.UploadSessions()
+        session = sessions.create("c.bin", "sub", 3)
+        sessions.write_chunk(session, 0, 3, io.BytesIO(b"ccc"))
+        sessions.commit(session)  # the assembled file is renamed into sub/
+        self.assertEqual(self.names(), {"a.txt": 1, "c.bin": 3})
+
+
+if __name__ == "__main__":
+    unittest.main()